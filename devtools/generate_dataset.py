@@ -8,6 +8,7 @@ from devtools.generate_dataset_tools import (
 )
 
 from tools.ConnectionManager import get_db
+from tools.sessions import backfill_sessions
 
 N_USERS = 20
 CLICKS_PER_MINUTE = 1
@@ -17,21 +18,24 @@ SESSIONS_PER_YEAR = 10
 if __name__ == "__main__":
     print("writing fake data to database...")
     connection_manager = get_db()
-    cursor = connection_manager.connection.cursor()
-    cursor.execute(create_test_tables())
-    # generate users
-    users = []
-    for n in range(N_USERS):
-        fake_user = generate_fake_user()
-        user = post_fake_user_to_DB(cursor, fake_user)
-        users.append(user)
+    with connection_manager.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(create_test_tables())
+        # generate users
+        users = []
+        for n in range(N_USERS):
+            fake_user = generate_fake_user()
+            user = post_fake_user_to_DB(cursor, fake_user)
+            users.append(user)
 
-    for user in users:
-        dates = generate_dates(sessions_per_year=SESSIONS_PER_YEAR)
-        for date in dates:
-            list_of_fake_activities_in_session = generate_session(
-                date, user.user_id, CLICKS_PER_MINUTE, SESSION_LENGTH_HOURS
-            )
-            post_session(cursor, list_of_fake_activities_in_session)
+        for user in users:
+            dates = generate_dates(sessions_per_year=SESSIONS_PER_YEAR)
+            for date in dates:
+                list_of_fake_activities_in_session = generate_session(
+                    date, user.user_id, CLICKS_PER_MINUTE, SESSION_LENGTH_HOURS
+                )
+                post_session(cursor, list_of_fake_activities_in_session)
+        # the activities are inserted directly, so the sessions read by /avg_time/, /engagement_summary/ and /session_percentiles/ are built from them
+        n_sessions = backfill_sessions(conn)
+        print(f"{n_sessions} sessions written.")
     connection_manager.disconnect()
     print("Fake data generated and posted to database.")
@@ -5,6 +5,7 @@ import numpy as np
 import math
 
 from tools.db_operations import insert_item
+from tools.migrations import migration_script
 from tools.tools import short_uuid4_generator, long_uuid4_generator
 
 rng = np.random.default_rng()
@@ -18,21 +19,13 @@ def create_test_tables():
     commands = """
                 DROP TABLE IF EXISTS activities;
                 DROP TABLE IF EXISTS users;
-                CREATE TABLE users (
-                user_id INT PRIMARY KEY,
-                username TEXT NOT NULL,
-                email TEXT NOT NULL UNIQUE,
-                age SMALLINT,
-                country VARCHAR(2)
-                );
-                CREATE TABLE activities (
-                activity_id UUID PRIMARY KEY,
-                user_id INT REFERENCES users (user_id),
-                time TIMESTAMPTZ,
-                activity_type TEXT,
-                activity_details TEXT
-                );
+                DROP TABLE IF EXISTS activity_counts_hourly;
+                DROP TABLE IF EXISTS sessions;
+                DROP TABLE IF EXISTS active_users_hourly;
+                DROP TABLE IF EXISTS session_durations_hourly;
+                DROP TABLE IF EXISTS schema_migrations;
                 """
+    commands += migration_script()
     return commands
 
 
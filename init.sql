@@ -1,3 +1,4 @@
+-- Initial schema. Later changes (e.g. indexes) are applied by the migrations in tools/migrations.py, when the API starts.
 CREATE TABLE IF NOT EXISTS users (
     user_id INT PRIMARY KEY,
     username TEXT NOT NULL,
@@ -1,25 +1,86 @@
+from collections.abc import Awaitable, Callable
 from contextlib import asynccontextmanager
 
+import orjson
 import pandas as pd
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import PlainTextResponse
-from pydantic import PositiveInt, EmailStr
+import psycopg
+
+from fastapi import FastAPI, HTTPException, Body
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    PlainTextResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from psycopg.rows import dict_row
+from psycopg_pool import PoolTimeout
+from pydantic import PositiveInt, EmailStr, ValidationError
 from pydantic_extra_types.country import CountryAlpha2
-from src.models import User, Activity, SuperUser, SuperUserRoles, ActivityTypes
-from tools.db_operations import retrieve_items, insert_item, sql_to_dataframe
+from src.models import (
+    User,
+    Activity,
+    SuperUser,
+    SuperUserRoles,
+    ActivityTypes,
+    ResponseFormats,
+)
+from tools.db_operations import (
+    ACTIVITY_TYPES,
+    insert_item_async,
+    insert_item_if_absent_async,
+    copy_items_async,
+    sql_to_arrays_async,
+    create_activities_filter,
+    create_user_activities_query,
+)
+from tools.aggregation import (
+    activity_counts_over_time_async,
+    count_arrays_per_bucket,
+    count_arrays_per_time_bin,
+    uses_hourly_rollup,
+)
+from tools.active_users import active_users_over_time_async
+from tools.retention import MAX_RETENTION_PERIODS, retention_cohorts
+from tools.funnel import funnel_conversion
+from tools.session_percentiles import session_duration_percentiles_async
+from tools.engagement import engagement_summary, summarize_engagement
+from tools.sessions import (
+    average_activity_session_duration,
+    average_session_duration,
+    close_sessions_async,
+    read_sessions_async,
+)
 from tools.tools import (
     short_uuid4_generator,
     long_uuid4_generator,
-    filter_time,
+    resolve_time_window,
     polish_activity_types_list,
+    polish_funnel_steps,
     check_for_allowed_freq_string,
     validate_time_bin,
     validate_time_entries,
+    parse_keyset_cursor,
+    format_keyset_cursor,
 )
-from tools.ConnectionManager import get_db
+from tools.ConnectionManager import get_async_db
+from tools.migrations import apply_migrations_async
+from tools.partitions import create_future_partitions_async
+from tools.user_cache import UserIdCache
+from tools.result_cache import get_result_cache, window_key
+from tools.single_flight import SingleFlight
+from tools.hot_window import get_hot_window_store
+from tools.process_pool import JobTimeout, get_analytics_pool
+from tools.formats import MEDIA_TYPES, render_dataframe
 # import matplotlib.pyplot as plt #will be useful soon
 
+# pages of activities returned by GET /activities/, and rows fetched at a time when streaming them
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_BATCH_SIZE = 1000
+NDJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE
+
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
@@ -27,15 +88,113 @@ async def lifespan(application: FastAPI):
     lifespan function that yields a connection to the database that lasts until the code is shut down.
     :param application: FastAPI object, the app.
     """
-    # At startup - start connection to the SQL server
-    connection_manager = get_db()
+    # At startup - start connection to the SQL server, bring the schema up to date, create the partitions of the coming months, cache the registered user_ids, load the recent activities in memory, and prepare the worker processes of the aggregations
+    connection_manager = await get_async_db()
     application.state.connection_manager = connection_manager
+    user_ids = UserIdCache()
+    hot_window = get_hot_window_store()
+    async with connection_manager.connection() as conn:
+        await apply_migrations_async(conn)
+        async with conn.cursor() as cur:
+            await create_future_partitions_async(cur)
+            await user_ids.load_async(cur)
+            await hot_window.load_async(cur)
+    application.state.user_ids = user_ids
+    application.state.hot_window = hot_window
+    application.state.result_cache = get_result_cache()
+    application.state.single_flight = SingleFlight()
+    analytics_pool = get_analytics_pool()
+    application.state.analytics_pool = analytics_pool
     yield
-    # At shutdown - close the connection
-    connection_manager.disconnect()
+    # At shutdown - stop the worker processes, and close the connection
+    analytics_pool.shutdown()
+    await connection_manager.disconnect()
 
 
 app = FastAPI(lifespan=lifespan)
+# compress the large answers, for the clients accepting gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
+
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request, exc: PoolTimeout):
+    """
+    Answers with status code 503 when no database connection got free in time, instead of failing with an internal error.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "The database is busy. Please try again later."},
+    )
+
+
+@app.exception_handler(JobTimeout)
+async def job_timeout_handler(request, exc: JobTimeout):
+    """
+    Answers with status code 503 when an aggregation did not finish within the timeout of the jobs, instead of keeping the client waiting.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={
+            "detail": "The computation took too long. Please try again later, or with a shorter time period."
+        },
+    )
+
+
+async def cached_analytics(
+    key: tuple,
+    format: ResponseFormats,
+    start,
+    depends_until,
+    compute: Callable[[], Awaitable[pd.DataFrame]],
+) -> Response:
+    """
+    Helper function answering an analytics query from the result cache if possible. Otherwise, identical concurrent queries share a single computation, whose result is serialized in the requested format and then cached.
+    :param key: tuple identifying the query, with its normalized parameters.
+    :param format: ResponseFormats. The format of the answer.
+    :param start: datetime. Start of the time window the result depends on (excluded).
+    :param depends_until: datetime (optional). End of the time window the result depends on (included), or None if it depends on all the later activities.
+    :param compute: function without arguments returning the awaitable computing the result as a DataFrame.
+    :return: the Response, with the serialized result.
+    """
+    result_cache = app.state.result_cache
+    key = (*key, format)
+    body = result_cache.get(key)
+    if body is None:
+        version = result_cache.version
+
+        async def compute_and_store() -> bytes:
+            result = await compute()
+            body = await run_in_threadpool(render_dataframe, result, format)
+            result_cache.put(key, body, start, depends_until, version)
+            return body
+
+        # queries arriving after a write do not join a computation that may have missed it
+        body = await app.state.single_flight.run((key, version), compute_and_store)
+    return Response(content=body, media_type=MEDIA_TYPES[format])
+
+
+def hot_window_arrays(start, end) -> dict | None:
+    """
+    Helper function returning the activities of a time window from the in-memory store of the recent activities, if the window is recent enough to be in it.
+    :param start: datetime. Start of the time window (excluded).
+    :param end: datetime. End of the time window (included).
+    :return: dictionary of arrays, as returned by tools.db_operations.sql_to_arrays for the columns "time", "user_id" and "activity_type", or None if the database must be queried.
+    """
+    hot_window = app.state.hot_window
+    if not hot_window.covers(start):
+        return None
+    return hot_window.window_arrays(start, end)
+
+
+async def aggregate_arrays(func: Callable, arrays: dict, *args):
+    """
+    Helper function running an aggregation of activities off the event loop, in the worker processes of the analytics pool for the large ones, within the timeout of the jobs.
+    :param func: module-level function taking the dictionary of arrays and then args, e.g. tools.aggregation.count_arrays_per_bucket.
+    :param arrays: dictionary of arrays, as returned by hot_window_arrays or tools.db_operations.sql_to_arrays.
+    :param args: the other arguments of func.
+    :return: the result of func.
+    """
+    return await app.state.analytics_pool.run(func, arrays, *args)
 
 
 @app.get("/", response_class=PlainTextResponse)
@@ -49,8 +208,25 @@ async def root():
     return "Hello, I'm good!"
 
 
+@app.get("/stats/")
+def get_stats():
+    """
+    Returns the statistics of the database connection pool, of the cache and coalescing of the analytics queries, of the in-memory store of the recent activities, and of the worker processes of the aggregations.
+
+    ## returns
+    dictionary with the pool size, the connections available, the requests waiting, and the counters of the pool ("pool"), the size and hit/miss counters of the result cache ("result_cache"), the number of computations saved by sharing identical concurrent queries ("single_flight"), the number of activities held in memory and the start of the window they cover ("hot_window"), and the number of aggregations run in worker processes or in threads, and of the ones that timed out ("analytics_pool").
+    """
+    return {
+        "pool": app.state.connection_manager.get_stats(),
+        "result_cache": app.state.result_cache.get_stats(),
+        "single_flight": app.state.single_flight.get_stats(),
+        "hot_window": app.state.hot_window.get_stats(),
+        "analytics_pool": app.state.analytics_pool.get_stats(),
+    }
+
+
 @app.post("/users/")
-def post_user(
+async def post_user(
     username: str,
     email: EmailStr,
     age: PositiveInt = None,
@@ -76,13 +252,10 @@ def post_user(
     user = User(
         user_id=user_id, username=username, email=email, age=age, country=country
     )
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        emails = retrieve_items("email", "users", cur)
-        if email in emails:
+    async with app.state.connection_manager.connection() as conn, conn.cursor() as cur:
+        if not await insert_item_if_absent_async(user, "users", "email", cur):
             raise HTTPException(status_code=400, detail="Email already registered")
-        else:
-            insert_item(user, "users", cur)
+    app.state.user_ids.add(user.user_id)
 
     return user
 
@@ -154,15 +327,95 @@ async def post_activity(
         activity_type=activity_type,
         activity_details=activity_details,
     )
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        user_ids = retrieve_items("user_id", "users", cur)
-        if activity.user_id not in user_ids:
+    user_ids = app.state.user_ids
+    async with app.state.connection_manager.connection() as conn, conn.cursor() as cur:
+        if not await user_ids.exists_async(activity.user_id, cur):
+            raise HTTPException(status_code=404, detail="User ID not found")
+        try:
+            await insert_item_async(activity, "activities", cur)
+        except psycopg.errors.ForeignKeyViolation:
+            # the user was cached, but has been removed from the database since
+            user_ids.discard(activity.user_id)
             raise HTTPException(status_code=404, detail="User ID not found")
-        insert_item(activity, "activities", cur)
+        if activity.activity_type == ActivityTypes.logout:
+            await close_sessions_async(
+                cur, activity.user_id, activity.time, activity.time
+            )
+    app.state.hot_window.append([activity])
+    app.state.result_cache.invalidate(activity.time, activity.time)
     return activity
 
 
+@app.post("/activities/batch")
+async def post_activities_batch(
+    activities: list[dict] = Body(...),
+) -> dict:
+    """
+    Posts many activities to the API at once, and adds them to the database in a single COPY operation. Each activity is validated as in post_activity, and the existence of all the user_ids is checked with one query. Invalid activities are skipped, and reported in the response.
+
+    ## parameters
+    **activities** *list of objects in the request body*: each object has the keys "time", "user_id", "activity_type" and (optionally) "activity_details", with the same format as in post_activity.
+
+    ## returns
+    Object with the number of activities added to the database ("n_inserted"), and the list of the rejected ones ("errors"), each with its position in the request ("index") and the reason ("detail").
+    """
+    valid_activities = []
+    errors = []
+    for index, item in enumerate(activities):
+        try:
+            activity = Activity.model_validate(
+                {**item, "activity_id": long_uuid4_generator()}
+            )
+            valid_activities.append((index, activity))
+        except ValidationError as error:
+            errors.append(
+                {
+                    "index": index,
+                    "detail": error.errors(include_url=False, include_context=False),
+                }
+            )
+
+    user_ids = app.state.user_ids
+    batch_user_ids = {activity.user_id for _, activity in valid_activities}
+    async with app.state.connection_manager.connection() as conn, conn.cursor() as cur:
+        for attempt in range(2):
+            existing_user_ids = await user_ids.filter_existing_async(
+                batch_user_ids, cur
+            )
+            activities_to_copy = [
+                activity
+                for _, activity in valid_activities
+                if activity.user_id in existing_user_ids
+            ]
+            try:
+                await copy_items_async(activities_to_copy, "activities", cur)
+                break
+            except psycopg.errors.ForeignKeyViolation:
+                if attempt:
+                    raise
+                # some cached users have been removed from the database since: look them all up again
+                for user_id in batch_user_ids:
+                    user_ids.discard(user_id)
+
+        # write the sessions closed by the logouts of the batch, one query per user
+        logout_times = {}
+        for activity in activities_to_copy:
+            if activity.activity_type == ActivityTypes.logout:
+                logout_times.setdefault(activity.user_id, []).append(activity.time)
+        for user_id, times in logout_times.items():
+            await close_sessions_async(cur, user_id, min(times), max(times))
+    if activities_to_copy:
+        app.state.hot_window.append(activities_to_copy)
+        times = [activity.time for activity in activities_to_copy]
+        app.state.result_cache.invalidate(min(times), max(times))
+    for index, activity in valid_activities:
+        if activity.user_id not in existing_user_ids:
+            errors.append({"index": index, "detail": "User ID not found"})
+
+    errors.sort(key=lambda error: error["index"])
+    return {"n_inserted": len(activities_to_copy), "errors": errors}
+
+
 @app.get("/activity_types_grouped/")
 async def histogram_activity_types_grouped(
     time_bin: str = "hour",
@@ -174,6 +427,7 @@ async def histogram_activity_types_grouped(
     end_time: str = None,
     period_days: int = 30,
     period_hours: int = 0,
+    format: ResponseFormats = ResponseFormats.json,
 ):
     """
     Function giving information about activities per time bin, given a time period. The user provides a time bin (hours, days, months...) and the function returns the amount of the given activity types per time bin.
@@ -181,7 +435,7 @@ async def histogram_activity_types_grouped(
 
     ## Parameters
 
-    **time_bin** *string*: time bin to use when grouping activity types. It may take the values "hour", "day", "month", "year".
+    **time_bin** *string*: time bin to use when grouping activity types. It may take the values "second", "minute", "hour", "day", "month", "year".
 
 
     **activity1** to **activity4** *string*: The activity types to count. Each parameter may take the values "login", "logout", "purchase" and "click". If nothing is chosen, the default "login", "logout" and "purchase" are chosen.
@@ -189,29 +443,48 @@ async def histogram_activity_types_grouped(
     **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
 
     **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
     """
 
     # validate input
     validate_time_entries(period_days, period_hours, start_time, end_time)
     validate_time_bin(time_bin)
-
-    # Connect to database and extract dataframe
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        df = sql_to_dataframe("activities", cur)
-
-    # filter for time period and activity type
     activity_types = polish_activity_types_list(
         [activity1, activity2, activity3, activity4],
         default=["login", "purchase", "logout"],
     )
-    df = filter_time(df, start_time, end_time, period_days, period_hours)
-    subset = df[df["activity_type"].isin(activity_types)]
-    subset[time_bin] = getattr(df["time"].dt, time_bin)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "activity_types_grouped",
+        window_key(start_time, end_time, start, end),
+        tuple(sorted(activity_types)),
+        time_bin,
+    )
 
-    # group according to time bin
-    subset.groupby([subset[time_bin], "activity_type"]).size().unstack(fill_value=0)
-    return subset.to_html()  # TODO: fix output format later, and fix tests
+    async def compute() -> pd.DataFrame:
+        # take the activities in the time period from memory if recent enough, otherwise from the database
+        arrays = hot_window_arrays(start, end)
+        if arrays is None:
+            where, params = create_activities_filter(start, end, activity_types)
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                arrays = await sql_to_arrays_async(
+                    "activities", cur, ["time", "activity_type"], where, params
+                )
+
+        # group according to time bin
+        return await aggregate_arrays(
+            count_arrays_per_time_bin, arrays, activity_types, time_bin
+        )
+
+    return await cached_analytics(
+        key, format, start, end if end_time else None, compute
+    )
 
 
 @app.get("/total_activity_over_time/")
@@ -225,6 +498,7 @@ async def total_activity_over_time(
     period_days: int = 365,
     period_hours: int = 0,
     frequency: str = "MS",
+    format: ResponseFormats = ResponseFormats.json,
 ):
     """
     Function giving information about activities over time, given a time period and frequency. The user provides a frequency (hours, days, months, quarter...) and the function returns the amount of the given activity types per time unit.
@@ -239,33 +513,107 @@ async def total_activity_over_time(
     **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
 
     **frequency** *str*: the time unit to subdivide the period in. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "min" (minutes), "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "2D12h30min").
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
     """
 
     # validate input
     check_for_allowed_freq_string(frequency)
     validate_time_entries(period_days, period_hours, start_time, end_time)
-
-    # Connect to database and extract dataframe
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        df = sql_to_dataframe("activities", cur)
-
-    # filter for time period and activity type
     activity_types = polish_activity_types_list(
         [activity1, activity2, activity3, activity4],
         default=["login", "purchase", "logout"],
     )
-    subset = filter_time(df, start_time, end_time, period_days, period_hours)
-    subset = subset[subset["activity_type"].isin(activity_types)]
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "total_activity_over_time",
+        window_key(start_time, end_time, start, end),
+        tuple(sorted(activity_types)),
+        frequency,
+    )
+
+    async def compute() -> pd.DataFrame:
+        # count the activities per time bin in memory if recent enough, otherwise in the database
+        arrays = hot_window_arrays(start, end)
+        if arrays is not None:
+            return await aggregate_arrays(
+                count_arrays_per_bucket, arrays, activity_types, frequency
+            )
+        async with (
+            app.state.connection_manager.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            subset = await activity_counts_over_time_async(
+                cur, start, end, activity_types, frequency
+            )
 
-    # fill time bins
-    subset = subset.groupby(["time", "activity_type"]).size().reset_index(name="count")
-    subset = subset.pivot(index="time", columns="activity_type", values="count").fillna(
-        0
+        # TODO: in plot: stacked bars
+        return subset
+
+    return await cached_analytics(
+        key, format, start, end if end_time else None, compute
     )
-    subset = subset.groupby(pd.Grouper(freq=frequency)).sum()
-    # TODO: in plot: stacked bars
-    return subset.to_html()
+
+
+@app.get("/active_users/")
+async def active_users_over_time(
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 30,
+    period_hours: int = 0,
+    frequency: str = "D",
+    format: ResponseFormats = ResponseFormats.json,
+):
+    """
+    Function giving the number of distinct active users (users with at least one activity) per time unit, e.g. daily, weekly or monthly active users with the frequencies "D", "W" or "MS". The counts are estimated from HyperLogLog sketches of the users of each hour, so they are approximate (2.3% standard error), and the bounds of their 95% confidence interval are given with them. The whole hours overlapping the time period are counted.
+    For the time period, either provide start and end times, or end time and period (in days and hours).
+
+    ## Parameters
+
+    **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
+
+    **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **frequency** *str*: the time unit to subdivide the period in, made of whole hours. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "6h").
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
+
+    ## returns
+    the estimated number of active users ("active_users"), and the bounds of its 95% confidence interval ("active_users_low" and "active_users_high"), per time unit.
+    """
+
+    # validate input
+    check_for_allowed_freq_string(frequency)
+    if not uses_hourly_rollup(frequency):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Frequency {frequency} is not made of whole hours.",
+        )
+    validate_time_entries(period_days, period_hours, start_time, end_time)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = ("active_users", window_key(start_time, end_time, start, end), frequency)
+
+    async def compute() -> pd.DataFrame:
+        # Connect to database and merge the hourly sketches of each time bin
+        async with (
+            app.state.connection_manager.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            return await active_users_over_time_async(cur, start, end, frequency)
+
+    # the result depends on the whole hours overlapping the window
+    hour = pd.Timedelta(hours=1)
+    depends_from = pd.Timestamp(start).tz_convert("UTC").floor("h") - pd.Timedelta(
+        1, "us"
+    )
+    depends_until = None
+    if end_time:
+        depends_until = pd.Timestamp(end).tz_convert("UTC").floor("h") + hour
+    return await cached_analytics(key, format, depends_from, depends_until, compute)
 
 
 @app.get("/purchases/")
@@ -275,6 +623,7 @@ async def avg_purchases(
     period_days: int = 30,
     period_hours: int = 0,
     frequency: str = "MS",
+    format: ResponseFormats = ResponseFormats.json,
 ):
     """
     Function giving information about the average number of purchases per login, given a time period and frequency. The user provides a frequency (hours, days, months, quarter...) and the function returns the average number of purchases per login per chosen time unit.
@@ -287,33 +636,43 @@ async def avg_purchases(
     **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
 
     **frequency** *str*: the time unit to subdivide the period in. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "min" (minutes), "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "2D12h30min").
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
     """
 
     # validate input
     check_for_allowed_freq_string(frequency)
     validate_time_entries(period_days, period_hours, start_time, end_time)
-
-    # Connect to database and extract dataframe
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        df = sql_to_dataframe("activities", cur)
-
-    # filter for time period and activity type
     activity_types = ["login", "purchase"]
-    subset = filter_time(df, start_time, end_time, period_days, period_hours)
-    subset = subset[subset["activity_type"].isin(activity_types)]
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
 
-    # fill time bins
-    subset = subset.groupby(["time", "activity_type"]).size().reset_index(name="count")
-    subset = subset.pivot(index="time", columns="activity_type", values="count").fillna(
-        0
-    )
-    subset = subset.groupby(pd.Grouper(freq=frequency)).sum()
+    # answer from the cache, or from a running computation of the same query
+    key = ("purchases", window_key(start_time, end_time, start, end), frequency)
 
-    # calculate purchases per login per time bin
-    subset["avg_purchases_per_login"] = subset["purchase"] / subset["login"]
-
-    return subset.to_html()
+    async def compute() -> pd.DataFrame:
+        # count the logins and purchases per time bin in memory if recent enough, otherwise in the database
+        arrays = hot_window_arrays(start, end)
+        if arrays is not None:
+            subset = await aggregate_arrays(
+                count_arrays_per_bucket, arrays, activity_types, frequency
+            )
+        else:
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                subset = await activity_counts_over_time_async(
+                    cur, start, end, activity_types, frequency
+                )
+        subset = subset.reindex(columns=activity_types, fill_value=0)
+
+        # calculate purchases per login per time bin
+        subset["avg_purchases_per_login"] = subset["purchase"] / subset["login"]
+        return subset
+
+    return await cached_analytics(
+        key, format, start, end if end_time else None, compute
+    )
 
 
 @app.get("/avg_time/")
@@ -323,9 +682,11 @@ async def avg_time_spent(
     period_days: int = 30,
     period_hours: int = 0,
     frequency: str = "MS",
+    session_timeout_minutes: PositiveInt = None,
+    format: ResponseFormats = ResponseFormats.json,
 ):
     """
-    Function giving information about the average time spent per user session (calculated as time between logout and login). The user provides a frequency (hours, days, months, quarter...) and the function returns the average number of purchases per login per chosen time unit.
+    Function giving information about the average time spent per user session (calculated as time between login and logout). Each login is paired with the next logout of the same user. The user provides a frequency (hours, days, months, quarter...) and the function returns the average session duration, and the number of sessions, per chosen time unit.
     For the time period, either provide start and end times, or end time and period (in days and hours).
 
     ## Parameters
@@ -335,69 +696,449 @@ async def avg_time_spent(
     **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
 
     **frequency** *str*: the time unit to subdivide the period in. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "min" (minutes), "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "2D12h30min").
+
+    **session_timeout_minutes** *int (optional)*: a session without logout, or with a longer period of inactivity, ends at its last activity before the gap. If not given, the sessions stored at logout time (with a 30 minutes timeout) are used, otherwise they are recomputed from the activities.
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
     """
 
     # validate input
     check_for_allowed_freq_string(frequency)
     validate_time_entries(period_days, period_hours, start_time, end_time)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "avg_time",
+        window_key(start_time, end_time, start, end),
+        frequency,
+        session_timeout_minutes,
+    )
 
-    # Connect to database and extract dataframe
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        df = sql_to_dataframe("activities", cur)
-
-    # filter for time period
-    subset = filter_time(df, start_time, end_time, period_days, period_hours)
-
-    # create new dataframe with session information (user_id, login_time, logout_time, duration)
-    subset = subset[["time", "user_id", "activity_type"]]
-    logins = subset[subset["activity_type"] == "login"].reset_index(drop=True)
-    logouts = subset[subset["activity_type"] == "logout"].reset_index(drop=True)
-    sessions = pd.DataFrame(
-        {
-            "user_id": logins["user_id"],
-            "login_time": logins["time"],
-            "logout_time": logouts["time"],
-        }
+    async def compute() -> pd.DataFrame:
+        if session_timeout_minutes is None:
+            # read the stored sessions with a login in the time period
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                sessions = await read_sessions_async(cur, start, end)
+
+            # average the duration of the sessions per time bin
+            return await run_in_threadpool(
+                average_session_duration, sessions, frequency
+            )
+
+        # take the activities in the time period from memory if recent enough, otherwise from the database, then group them into sessions and average their duration per time bin off the event loop
+        arrays = hot_window_arrays(start, end)
+        if arrays is None:
+            where, params = create_activities_filter(start, end)
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                arrays = await sql_to_arrays_async(
+                    "activities",
+                    cur,
+                    ["time", "user_id", "activity_type"],
+                    where,
+                    params,
+                )
+        timeout = pd.Timedelta(minutes=session_timeout_minutes)
+        return await aggregate_arrays(
+            average_activity_session_duration, arrays, timeout, frequency
+        )
+
+    # stored sessions with a login in the window are closed by later logouts
+    depends_until = end if end_time and session_timeout_minutes else None
+    return await cached_analytics(key, format, start, depends_until, compute)
+
+
+@app.get("/engagement_summary/")
+async def engagement_summary_over_time(
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 30,
+    period_hours: int = 0,
+    frequency: str = "MS",
+    session_timeout_minutes: PositiveInt = None,
+    format: ResponseFormats = ResponseFormats.json,
+):
+    """
+    Function giving the main engagement metrics per time unit in a single answer, for a dashboard: the number of activities of each type (as /total_activity_over_time/), the average number of purchases per login (as /purchases/), and the average duration and number of the user sessions (as /avg_time/). All the activity types are counted at once, and the sessions are read from the stored ones, or, with session_timeout_minutes, recomputed from a single scan of the activities that also gives the counts.
+    For the time period, either provide start and end times, or end time and period (in days and hours).
+
+    ## Parameters
+
+    **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
+
+    **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **frequency** *str*: the time unit to subdivide the period in. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "min" (minutes), "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "2D12h30min").
+
+    **session_timeout_minutes** *int (optional)*: a session without logout, or with a longer period of inactivity, ends at its last activity before the gap. If not given, the sessions stored at logout time (with a 30 minutes timeout) are used, otherwise they are recomputed from the activities.
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
+
+    ## returns
+    per time unit, the number of activities of each type ("click", "login", "logout", "purchase"), the purchases per login ("avg_purchases_per_login"), the average session duration ("duration") and the number of sessions ("n_sessions").
+    """
+
+    # validate input
+    check_for_allowed_freq_string(frequency)
+    validate_time_entries(period_days, period_hours, start_time, end_time)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "engagement_summary",
+        window_key(start_time, end_time, start, end),
+        frequency,
+        session_timeout_minutes,
     )
-    sessions["duration"] = sessions["logout_time"] - sessions["login_time"]
-    sessions = sessions.set_index("login_time")
-    sessions = sessions.groupby(pd.Grouper(freq=frequency)).mean()
 
-    return sessions.to_html()
+    async def compute() -> pd.DataFrame:
+        arrays = hot_window_arrays(start, end)
+        if session_timeout_minutes is not None:
+            # take the activities in the time period from memory if recent enough, otherwise from the database in a single scan, then count and group them into sessions off the event loop
+            if arrays is None:
+                where, params = create_activities_filter(start, end)
+                async with (
+                    app.state.connection_manager.connection() as conn,
+                    conn.cursor() as cur,
+                ):
+                    arrays = await sql_to_arrays_async(
+                        "activities",
+                        cur,
+                        ["time", "user_id", "activity_type"],
+                        where,
+                        params,
+                    )
+            timeout = pd.Timedelta(minutes=session_timeout_minutes)
+            return await aggregate_arrays(
+                engagement_summary, arrays, frequency, timeout
+            )
+
+        # count all the activity types at once, in memory if recent enough, otherwise in the database, and read the stored sessions with a login in the time period
+        async with (
+            app.state.connection_manager.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            if arrays is not None:
+                counts = await aggregate_arrays(
+                    count_arrays_per_bucket, arrays, ACTIVITY_TYPES, frequency
+                )
+            else:
+                counts = await activity_counts_over_time_async(
+                    cur, start, end, ACTIVITY_TYPES, frequency
+                )
+            sessions = await read_sessions_async(cur, start, end)
+        return await run_in_threadpool(
+            summarize_engagement, counts, sessions, frequency
+        )
+
+    # stored sessions with a login in the window are closed by later logouts
+    depends_until = end if end_time and session_timeout_minutes else None
+    return await cached_analytics(key, format, start, depends_until, compute)
+
+
+@app.get("/session_percentiles/")
+async def session_percentiles(
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 30,
+    period_hours: int = 0,
+    frequency: str = "D",
+    format: ResponseFormats = ResponseFormats.json,
+):
+    """
+    Function giving the median, 90th and 99th percentiles of the duration of the user sessions (login to logout) per time unit of their login. The percentiles are estimated from the stored sessions, counted per hour in logarithmic bins of duration, so they are approximate, within 1% of the exact durations. The whole hours overlapping the time period are counted.
+    For the time period, either provide start and end times, or end time and period (in days and hours).
+
+    ## Parameters
+
+    **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
+
+    **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **frequency** *str*: the time unit to subdivide the period in, made of whole hours. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "h" (hours), "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). Combinations are also possible (e.g. "6h").
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
+
+    ## returns
+    the number of sessions ("n_sessions"), and the percentiles of their duration ("p50", "p90" and "p99"), per time unit.
+    """
+
+    # validate input
+    check_for_allowed_freq_string(frequency)
+    if not uses_hourly_rollup(frequency):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Frequency {frequency} is not made of whole hours.",
+        )
+    validate_time_entries(period_days, period_hours, start_time, end_time)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "session_percentiles",
+        window_key(start_time, end_time, start, end),
+        frequency,
+    )
+
+    async def compute() -> pd.DataFrame:
+        # Connect to database and merge the hourly duration bins of each time bin
+        async with (
+            app.state.connection_manager.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            return await session_duration_percentiles_async(cur, start, end, frequency)
+
+    # the result depends on the whole hours overlapping the window, and the sessions with a login in them are closed by later logouts
+    depends_from = pd.Timestamp(start).tz_convert("UTC").floor("h") - pd.Timedelta(
+        1, "us"
+    )
+    return await cached_analytics(key, format, depends_from, None, compute)
+
+
+@app.get("/retention/")
+async def retention(
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 180,
+    period_hours: int = 0,
+    frequency: str = "W",
+    format: ResponseFormats = ResponseFormats.json,
+):
+    """
+    Function giving the retention of the users, e.g. weekly or monthly with the frequencies "W" or "MS". The users are grouped in cohorts by the time unit of their first activity in the time period, and for each cohort the function returns its number of users, and the fraction of them active in each of the following time units.
+    For the time period, either provide start and end times, or end time and period (in days and hours).
+
+    ## Parameters
+
+    **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
+
+    **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **frequency** *str*: the time unit to subdivide the period in. It follows Panda's offset aliases scheme (https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases). Some of the mostly used strings are "D" (day), "W" (week), "MS" (month start), "QS" (quarter start) and "YS" (year start). The period can be divided in at most 1000 time units.
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
+
+    ## returns
+    one row per cohort, with the number of users of the cohort ("cohort_size"), and the fraction of them active 0, 1, 2... time units later ("0", "1", "2"...), null for the time units after the end of the period.
+    """
+
+    # validate input
+    check_for_allowed_freq_string(frequency)
+    validate_time_entries(period_days, period_hours, start_time, end_time)
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+    if len(pd.date_range(start, end, freq=frequency)) + 1 > MAX_RETENTION_PERIODS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"The time period can be divided in at most {MAX_RETENTION_PERIODS} time units. Please choose a longer frequency, or a shorter period.",
+        )
+
+    # answer from the cache, or from a running computation of the same query
+    key = ("retention", window_key(start_time, end_time, start, end), frequency)
+
+    async def compute() -> pd.DataFrame:
+        # take the activities in the time period from memory if recent enough, otherwise from the database
+        arrays = hot_window_arrays(start, end)
+        if arrays is None:
+            where, params = create_activities_filter(start, end)
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                arrays = await sql_to_arrays_async(
+                    "activities", cur, ["time", "user_id"], where, params
+                )
+
+        # group the users in cohorts, and follow their activity off the event loop
+        return await aggregate_arrays(retention_cohorts, arrays, frequency)
+
+    return await cached_analytics(
+        key, format, start, end if end_time else None, compute
+    )
+
+
+@app.get("/funnel/")
+async def funnel(
+    step1: str = None,
+    step2: str = None,
+    step3: str = None,
+    step4: str = None,
+    step5: str = None,
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 30,
+    period_hours: int = 0,
+    within_minutes: PositiveInt = None,
+    same_session: bool = False,
+    session_timeout_minutes: PositiveInt = 30,
+    format: ResponseFormats = ResponseFormats.json,
+):
+    """
+    Function giving the conversion of the users through a funnel, i.e. an ordered list of activity types, such as login, click and purchase. A user reaches a step if they did the activities of all the steps up to it in the given order, in the time period, and optionally within a given time or within one session.
+    For the time period, either provide start and end times, or end time and period (in days and hours).
+
+    ## Parameters
+
+    **step1** to **step5** *string*: The activity types of the steps of the funnel, in order. Each parameter may take the values "login", "logout", "purchase" and "click", and the same type may appear more than once. Steps left empty are skipped. If no step is given, the funnel is "login", "click", "purchase".
+
+    **start_time** and **end_time** *string in the YYYY-MM-DDTHH:MM:SSZ format*: Start and end times for the time period under consideration.
+
+    **period_days** and **period_hours** *int*: If only end_time is provided, the start time is calculated from this time difference.
+
+    **within_minutes** *int (optional)*: maximum time between the first and the last step.
+
+    **same_session** *bool*: if true, all the steps must happen in the same session, which ends at a logout, at the next login, or at a period of inactivity longer than session_timeout_minutes (default 30).
+
+    **format** *string*: format of the answer. "json" (default) gives {"index": [...], "columns": {name: [...]}}, with times in the ISO 8601 format and durations in seconds; "arrow" gives an Arrow IPC stream; "html" gives an HTML table. Large answers are gzip-compressed for clients accepting it.
+
+    ## returns
+    one row per step, with its activity type, the number of users reaching it ("users"), and their fraction of the users of the first step ("conversion") and of the previous step ("step_conversion").
+    """
+
+    # validate input
+    validate_time_entries(period_days, period_hours, start_time, end_time)
+    steps = polish_funnel_steps(
+        [step1, step2, step3, step4, step5], default=["login", "click", "purchase"]
+    )
+    start, end = resolve_time_window(start_time, end_time, period_days, period_hours)
+
+    # answer from the cache, or from a running computation of the same query
+    key = (
+        "funnel",
+        window_key(start_time, end_time, start, end),
+        tuple(steps),
+        within_minutes,
+        session_timeout_minutes if same_session else None,
+    )
+
+    async def compute() -> pd.DataFrame:
+        # take the activities in the time period from memory if recent enough, otherwise from the database. Only the types of the steps matter, unless all activities are needed to find the periods of inactivity ending the sessions.
+        arrays = hot_window_arrays(start, end)
+        if arrays is None:
+            activity_types = None if same_session else sorted(set(steps))
+            where, params = create_activities_filter(start, end, activity_types)
+            async with (
+                app.state.connection_manager.connection() as conn,
+                conn.cursor() as cur,
+            ):
+                arrays = await sql_to_arrays_async(
+                    "activities",
+                    cur,
+                    ["time", "user_id", "activity_type"],
+                    where,
+                    params,
+                )
+
+        # match the steps off the event loop
+        within = (
+            None if within_minutes is None else pd.Timedelta(minutes=within_minutes)
+        )
+        timeout = pd.Timedelta(minutes=session_timeout_minutes)
+        return await aggregate_arrays(
+            funnel_conversion, arrays, steps, within, same_session, timeout
+        )
+
+    return await cached_analytics(
+        key, format, start, end if end_time else None, compute
+    )
 
 
 @app.get("/activities/")
 async def read_activities_by_userid(
     user_id: PositiveInt,
+    limit: PositiveInt = None,
+    after: str = None,
+    stream: bool = False,
 ) -> list[dict]:
     """
-    Function returning a list of activities filtered by user_id.
+    Function returning the activities of a user, in order of time. The activities are read a page at a time: when a page is full, the X-Next-After header of the response gives the cursor to pass as "after" to get the next page. With stream=true, all the activities are sent at once as newline-delimited JSON, read in batches from the database, so that memory use does not depend on the number of activities.
 
     ## parameters
     **user_id** *integer*: user_id of the user we want to filter for activities.
 
+    **limit** *integer (optional)*: maximum number of activities to return. Default 1000, at most 10000. Without limit, a stream has all the activities.
+
+    **after** *string (optional)*: cursor, in the form "<time>,<activity_id>". Only the activities after it are returned.
+
+    **stream** *bool*: if true, the activities are streamed as newline-delimited JSON (one activity per line).
+
     ## returns
-    list of Activity objects.
-    """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
-        user_ids = retrieve_items("user_id", "users", cur)
-        if user_id not in user_ids:
-            raise HTTPException(status_code=404, detail="User ID not found.")
-        user_id_activities = retrieve_items("user_id", "activities", cur)
-        if user_id not in user_id_activities:
-            raise HTTPException(
-                status_code=404, detail=f"No activities by {user_id=} found."
-            )
+    list of Activity objects, or one Activity object per line if streamed.
+    """
+    user_ids = app.state.user_ids
+    if after is not None:
+        after = parse_keyset_cursor(after)
+
+    if stream:
+        # the status is sent before the activities: check the user first
+        async with (
+            app.state.connection_manager.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            if not await user_ids.exists_async(user_id, cur):
+                raise HTTPException(status_code=404, detail="User ID not found.")
+        query, params = create_user_activities_query(user_id, after, limit)
+        return StreamingResponse(
+            stream_activities(query, params), media_type="application/x-ndjson"
+        )
+
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit can be at most {MAX_PAGE_SIZE}. Use stream=true to read all the activities.",
+        )
+    query, params = create_user_activities_query(user_id, after, limit)
+    async with (
+        app.state.connection_manager.connection() as conn,
+        conn.cursor(row_factory=dict_row) as cur,
+    ):
+        await cur.execute(query, params)
+        activities = await cur.fetchall()
+        if not activities:
+            # only look up the user when there is nothing to return
+            if not await user_ids.exists_async(user_id, cur):
+                raise HTTPException(status_code=404, detail="User ID not found.")
+            if after is None:
+                raise HTTPException(
+                    status_code=404, detail=f"No activities by {user_id=} found."
+                )
+
+    headers = {}
+    if len(activities) == limit:
+        last = activities[-1]
+        headers["X-Next-After"] = format_keyset_cursor(
+            last["time"], last["activity_id"]
+        )
+    return Response(
+        content=orjson.dumps(activities, option=orjson.OPT_UTC_Z),
+        media_type="application/json",
+        headers=headers,
+    )
+
 
-        query = f"""SELECT * FROM activities WHERE user_id = {user_id}"""
-        act_list = cur.execute(query, {"user_id": user_id}).fetchall()
-        act_list = [
-            dict((cur.description[i][0], value) for i, value in enumerate(row))
-            for row in act_list
-        ]
-    return act_list
+async def stream_activities(query: str, params: dict):
+    """
+    Asynchronous generator reading activities through a server-side cursor, and yielding them as newline-delimited JSON, a batch at a time. The connection is held until the stream ends, or the client goes away.
+    :param query: the SQL query, as returned by create_user_activities_query.
+    :param params: the dictionary of parameters to be passed along with the query.
+    """
+    async with (
+        app.state.connection_manager.connection() as conn,
+        conn.transaction(),
+        conn.cursor(name="activities_stream", row_factory=dict_row) as cur,
+    ):
+        await cur.execute(query, params)
+        while activities := await cur.fetchmany(STREAM_BATCH_SIZE):
+            yield b"".join(
+                orjson.dumps(activity, option=NDJSON_OPTIONS) for activity in activities
+            )
 
 
 # # plot something for just one user (work in progress, but it shows that the code works)
@@ -29,6 +29,16 @@ class SuperUserRoles(str, Enum):
     support = "support"
 
 
+class ResponseFormats(str, Enum):
+    """
+    Enum class. List of possible formats of the answers of the analytics endpoints.
+    """
+
+    json = "json"
+    arrow = "arrow"
+    html = "html"
+
+
 class User(BaseModel, validate_assignment=True):
     """
     User model, called by the post_user function in application.py.
@@ -3,7 +3,8 @@ import pytest
 from dotenv import dotenv_values
 from src.application import app
 from src.models import Activity
-from tools.ConnectionManager import ConnectionManager
+from tools.ConnectionManager import ConnectionManager, db_connection_config
+from tools.migrations import migration_script
 from fastapi.testclient import TestClient
 import os
 
@@ -11,7 +12,7 @@ import os
 @pytest.fixture(scope="session")
 def db_connection():
     """
-    Establishes postgresql connection for the whole session
+    Establishes a pool of postgresql connections for the whole session
     :return: Connection_Manager object
     """
     env_path = ".env"
@@ -37,21 +38,23 @@ def db_connection():
 
     connection_manager = ConnectionManager(testdb_connection_config)
     connection_manager.connect()
-    connection_manager.connection.autocommit = True
-
-    return connection_manager
+    yield connection_manager
+    connection_manager.disconnect()
 
 
 @pytest.fixture(scope="session")
-def client_test(db_connection):
+def client_test(db_connection, create_test_tables):
     """
-    Establishes a connection between the client and the API.
+    Establishes a connection between the client and the API. The lifespan of the API runs against the test database, so that the API opens its own asynchronous pool of connections there.
     :param db_connection: fixture
+    :param create_test_tables: fixture
     :return: the client
     """
-    client_ = TestClient(app)
-    app.state.connection_manager = db_connection
-    return client_
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+    db_connection_config.update(db_connection.connection_config)
+    with TestClient(app) as client_:
+        yield client_
 
 
 @pytest.fixture(scope="session")
@@ -63,21 +66,13 @@ def create_test_tables():
     commands = """
                 DROP TABLE IF EXISTS activities;
                 DROP TABLE IF EXISTS users;
-                CREATE TABLE users (
-                user_id INT PRIMARY KEY,
-                username TEXT NOT NULL,
-                email TEXT NOT NULL UNIQUE,
-                age SMALLINT,
-                country VARCHAR(2)
-                );
-                CREATE TABLE activities (
-                activity_id UUID PRIMARY KEY,
-                user_id INT REFERENCES users (user_id),
-                time TIMESTAMPTZ,
-                activity_type TEXT,
-                activity_details TEXT
-                );
+                DROP TABLE IF EXISTS activity_counts_hourly;
+                DROP TABLE IF EXISTS sessions;
+                DROP TABLE IF EXISTS active_users_hourly;
+                DROP TABLE IF EXISTS session_durations_hourly;
+                DROP TABLE IF EXISTS schema_migrations;
                 """
+    commands += migration_script()
     return commands
 
 
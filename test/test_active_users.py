@@ -0,0 +1,112 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from src.models import Activity
+from tools.active_users import active_users_over_time, rebuild_active_users
+from tools.db_operations import insert_item
+from tools.tools import long_uuid4_generator
+
+START = datetime.datetime(2020, 3, 1, tzinfo=datetime.UTC)
+END = datetime.datetime(2020, 5, 1, tzinfo=datetime.UTC)
+
+# distinct users per day or per month, counted exactly
+EXACT_COUNT_QUERY = """
+                SELECT date_trunc(%(unit)s, time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', count(DISTINCT user_id)
+                FROM activities
+                WHERE time > %(start_time)s AND time <= %(end_time)s
+                GROUP BY 1
+                ORDER BY 1
+                """
+
+
+@pytest.fixture(scope="module")
+def many_users(db_connection, create_test_tables):
+    """
+    Fixture filling the test database with 5000 users and 40000 activities in March and April 2020, the first users being the most active ones.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        cur.execute("SELECT setseed(0.42)")
+        cur.execute(
+            """
+            INSERT INTO users (user_id, username, email, age)
+            SELECT g, 'user', 'user' || g || '@mail.com', 30 FROM generate_series(1, 5000) g
+            """
+        )
+        cur.execute(
+            """
+            INSERT INTO activities (activity_id, user_id, time, activity_type)
+            SELECT gen_random_uuid(), 1 + floor(5000 * random() ^ 3)::int,
+            %(start)s::timestamptz + random() * (%(end)s::timestamptz - %(start)s::timestamptz), 'click'
+            FROM generate_series(1, 40000)
+            """,
+            {"start": START, "end": END},
+        )
+
+
+@pytest.mark.parametrize(("frequency", "unit"), [("D", "day"), ("MS", "month")])
+def test_active_users_within_bounds(db_connection, many_users, frequency, unit):
+    """
+    Tests that the estimated numbers of active users, merged from the hourly sketches, are close to the exact ones, and within the bounds given with them.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        result = active_users_over_time(cur, START, END, frequency)
+        params = {"unit": unit, "start_time": START, "end_time": END}
+        exact = pd.Series(dict(cur.execute(EXACT_COUNT_QUERY, params).fetchall()))
+    exact.index = pd.to_datetime(exact.index, utc=True)
+    assert result.index.equals(exact.index.rename("time"))
+    relative_error = (result["active_users"] - exact).abs() / exact
+    assert relative_error.max() < 0.08
+    inside = (result["active_users_low"] <= exact) & (
+        exact <= result["active_users_high"]
+    )
+    assert inside.mean() >= 0.9
+
+
+def test_rebuild_active_users(db_connection, many_users):
+    """
+    Tests that rebuilding the sketches from the activities gives the same sketches as the ones kept up to date at insertion.
+    """
+    query = "SELECT bucket, sketch FROM active_users_hourly ORDER BY bucket"
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        sketches = cur.execute(query).fetchall()
+        assert len(sketches) == 61 * 24
+        assert rebuild_active_users(conn, START, END) == len(sketches)
+        assert cur.execute(query).fetchall() == sketches
+        cur.execute("DELETE FROM active_users_hourly")
+        assert rebuild_active_users(conn) == len(sketches)
+        assert cur.execute(query).fetchall() == sketches
+
+
+def test_active_users_small_counts(db_connection, create_test_tables):
+    """
+    Tests that each inserted activity updates the sketch of its hour, that a few users are counted exactly, and that the empty buckets count no users.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        cur.execute(
+            "INSERT INTO users (user_id, username, email, age) VALUES (1, 'one', 'one@mail.com', 30), (2, 'two', 'two@mail.com', 30)"
+        )
+        for user_id, time in [
+            (1, "2020-04-23T12:10:00Z"),
+            (2, "2020-04-23T12:50:00Z"),
+            (1, "2020-04-23T13:10:00Z"),
+            (1, "2020-04-23T15:10:00Z"),
+        ]:
+            activity = Activity(
+                activity_id=long_uuid4_generator(),
+                time=time,
+                user_id=user_id,
+                activity_type="click",
+            )
+            insert_item(activity, "activities", cur)
+        start = datetime.datetime(2020, 4, 23, 12, 30, tzinfo=datetime.UTC)
+        result = active_users_over_time(cur, start, END, "h")
+        assert result["active_users"].tolist() == [2, 1, 0, 1]
+        assert result["active_users_low"].tolist() == [1, 0, 0, 0]
+        result = active_users_over_time(cur, start, END, "D")
+        assert result["active_users"].tolist() == [2]
+        result = active_users_over_time(cur, END, END + datetime.timedelta(1), "D")
+        assert len(result) == 0
@@ -0,0 +1,228 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models import User, Activity
+from tools.aggregation import (
+    activity_counts_over_time,
+    count_activities_per_bucket,
+    create_bucket_count_query,
+    sql_bucket_expression,
+    time_bin_values,
+    uses_hourly_rollup,
+)
+from tools.db_operations import (
+    insert_item,
+    copy_items,
+    arrays_to_dataframe,
+    sql_to_arrays,
+    create_activities_filter,
+)
+from tools.rollup import rebuild_hourly_rollup
+from tools.tools import long_uuid4_generator
+
+ACTIVITY_COLUMNS = ["time", "user_id", "activity_type"]
+
+
+@pytest.fixture(scope="module")
+def random_activities(db_connection, create_test_tables, mock_data_user):
+    """
+    Fixture filling the test database with a user and 300 activities spread over 2020, and returning the time window containing them.
+    """
+    rng = np.random.default_rng(42)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        for seconds, activity_type in zip(
+            rng.integers(0, 366 * 24 * 60 * 60, 300),
+            rng.choice(["login", "logout", "click", "purchase"], 300),
+        ):
+            time = start + datetime.timedelta(seconds=int(seconds))
+            activity = Activity(
+                activity_id=long_uuid4_generator(),
+                time=time.isoformat(),
+                user_id=mock_data_user["user_id"],
+                activity_type=activity_type,
+            )
+            insert_item(activity, "activities", cur)
+    return start, start + datetime.timedelta(days=366)
+
+
+@pytest.mark.parametrize(
+    "frequency", ["MS", "QS", "YS", "ME", "QE", "YE", "W", "D", "h", "1h30min", "5D"]
+)
+def test_sql_counts_match_pandas(db_connection, random_activities, frequency):
+    """
+    Tests that the counts made by the database are the same as the ones made with pandas, whatever the session time zone.
+    """
+    start, end = random_activities
+    start = start + datetime.timedelta(days=3, hours=5, minutes=17)
+    end = end - datetime.timedelta(hours=2, minutes=43)
+    activity_types = ["login", "purchase", "click"]
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute("SET TIME ZONE 'America/New_York'")
+        where, params = create_activities_filter(start, end, activity_types)
+        expected = count_activities_per_bucket(
+            arrays_to_dataframe(
+                sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+            ),
+            frequency,
+        )
+        result = activity_counts_over_time(cur, start, end, activity_types, frequency)
+        cur.execute("SET TIME ZONE 'UTC'")
+    pd.testing.assert_frame_equal(result, expected, check_freq=False)
+
+
+def test_empty_counts(db_connection, random_activities):
+    """
+    Tests that a window without activities gives an empty table.
+    """
+    start = datetime.datetime(2019, 1, 1, tzinfo=datetime.UTC)
+    end = datetime.datetime(2019, 2, 1, tzinfo=datetime.UTC)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        result = activity_counts_over_time(cur, start, end, ["login"], "D")
+    assert len(result) == 0
+
+
+@pytest.mark.parametrize("frequency", ["B", "SME", "CBME", "bh", "2MS", "W-MON"])
+def test_frequencies_without_sql_bucket(frequency):
+    """
+    Tests that the frequencies that Postgres cannot reproduce fall back to pandas.
+    """
+    assert sql_bucket_expression(frequency) is None
+    assert create_bucket_count_query(frequency, "TRUE", {}) is None
+
+
+@pytest.mark.parametrize(
+    "time_bin", ["second", "minute", "hour", "day", "month", "year"]
+)
+def test_time_bin_values_match_pandas(time_bin):
+    """
+    Tests that the calendar fields extracted from times in microseconds are the ones of the pandas .dt accessor, including before 1970 and on leap days.
+    """
+    rng = np.random.default_rng(3)
+    times = rng.integers(-(2 * 10**15), 2 * 10**15, 10000)
+    times[:2] = [
+        pd.Timestamp("2020-02-29T23:59:59.999999Z").value // 1000,
+        pd.Timestamp("1969-12-31T23:59:59Z").value // 1000,
+    ]
+    expected = getattr(pd.to_datetime(times, unit="us", utc=True), time_bin)
+    np.testing.assert_array_equal(time_bin_values(times, time_bin), expected)
+
+
+def test_unknown_time_bin():
+    """
+    Tests that an unknown calendar field is refused, instead of falling back to another one.
+    """
+    with pytest.raises(ValueError):
+        time_bin_values(np.array([0]), "week")
+
+
+def test_fallback_counts(db_connection, random_activities):
+    """
+    Tests that the pandas fallback, fed by the binary export, counts the same as on the full DataFrame.
+    """
+    start, end = random_activities
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        where, params = create_activities_filter(start, end, ["login", "click"])
+        expected = count_activities_per_bucket(
+            arrays_to_dataframe(
+                sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+            ),
+            "W-MON",
+        )
+        result = activity_counts_over_time(cur, start, end, ["login", "click"], "W-MON")
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize(
+    "frequency, expected",
+    [("h", True), ("3h", True), ("D", True), ("MS", True), ("W", True)]
+    + [("1h30min", False), ("30min", False), ("B", False)],
+)
+def test_uses_hourly_rollup(frequency, expected):
+    """
+    Tests that the rollup is only used for frequencies made of whole hours.
+    """
+    assert uses_hourly_rollup(frequency) == expected
+
+
+def test_rollup_within_one_hour(db_connection, random_activities):
+    """
+    Tests that a window shorter than an hour, where the rollup cannot be used, is counted from the activities table only once.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT time FROM activities ORDER BY time LIMIT 1")
+        time = cur.fetchone()[0]
+        start = time - datetime.timedelta(seconds=1)
+        for end in [time, time + datetime.timedelta(hours=1, seconds=1)]:
+            where, params = create_activities_filter(start, end, None)
+            expected = count_activities_per_bucket(
+                arrays_to_dataframe(
+                    sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+                ),
+                "h",
+            )
+            result = activity_counts_over_time(
+                cur, start, end, ["login", "logout", "click", "purchase"], "h"
+            )
+            assert result.to_numpy().sum() == expected.to_numpy().sum() >= 1
+
+
+def hourly_counts(cur) -> dict:
+    """
+    Helper function returning the hourly rollup as a dictionary {(bucket, activity_type): count}, without the empty counts.
+    """
+    cur.execute("SELECT bucket, activity_type, count FROM activity_counts_hourly")
+    return {(bucket, type_): count for bucket, type_, count in cur if count}
+
+
+def test_rollup_maintenance(
+    db_connection, create_test_tables, mock_data_user, mock_data_activity
+):
+    """
+    Tests that the hourly rollup follows the inserts (single and bulk), updates and deletions of activities, and that a rebuild gives the same counts.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+        hour = datetime.datetime(2020, 4, 23, 12, tzinfo=datetime.UTC)
+        assert hourly_counts(cur) == {(hour, "login"): 1}
+
+        activities = [
+            Activity(
+                activity_id=long_uuid4_generator(),
+                time=(hour + datetime.timedelta(minutes=20 * i)).isoformat(),
+                user_id=mock_data_user["user_id"],
+                activity_type="click",
+            )
+            for i in range(4)
+        ]
+        copy_items(activities, "activities", cur)
+        next_hour = hour + datetime.timedelta(hours=1)
+        assert hourly_counts(cur) == {
+            (hour, "login"): 1,
+            (hour, "click"): 3,
+            (next_hour, "click"): 1,
+        }
+
+        cur.execute(
+            "UPDATE activities SET activity_type = 'purchase' WHERE activity_id = %s",
+            (activities[0].activity_id,),
+        )
+        cur.execute(
+            "DELETE FROM activities WHERE activity_id = %s",
+            (mock_data_activity["activity_id"],),
+        )
+        expected = {(hour, "click"): 2, (hour, "purchase"): 1, (next_hour, "click"): 1}
+        assert hourly_counts(cur) == expected
+
+        cur.execute("UPDATE activity_counts_hourly SET count = 100")
+        rebuild_hourly_rollup(conn, hour, hour)
+        assert hourly_counts(cur) == {**expected, (next_hour, "click"): 100}
+        rebuild_hourly_rollup(conn)
+        assert hourly_counts(cur) == expected
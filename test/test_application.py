@@ -1,7 +1,13 @@
+import datetime
+import json
+
+import pyarrow as pa
 import pytest
 from src.application import app
 from src.models import User, Activity
-from tools.db_operations import insert_item
+from tools.db_operations import insert_item, copy_items, retrieve_items
+from tools.process_pool import AnalyticsPool
+from tools.tools import long_uuid4_generator
 
 
 def test_client_startup(client_test) -> None:
@@ -14,6 +20,18 @@ def test_client_startup(client_test) -> None:
     assert response.text == "Hello, I'm good!"
 
 
+def test_pool_stats(client_test) -> None:
+    """
+    Tests that the statistics of the connection pool are exposed, and that connections are given back to the pool after each request.
+    """
+    response = client_test.get("/stats/")
+    assert response.status_code == 200
+    stats = response.json()["pool"]
+    assert stats["pool_size"] >= stats["pool_min"]
+    assert stats["pool_size"] <= stats["pool_max"]
+    assert stats["pool_available"] == stats["pool_size"]
+
+
 # def test_db_connection():
 #     """
 #     tests that connection to the database is established.
@@ -33,12 +51,13 @@ def test_client_startup(client_test) -> None:
 #         conn.close()
 
 
-def test_post_user(mock_data_user, create_test_tables, client_test) -> None:
+def test_post_user(
+    mock_data_user, create_test_tables, client_test, db_connection
+) -> None:
     """
     tests that a valid user data is posted to the API, and returns status_code 200.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
 
     response = client_test.post(
@@ -54,12 +73,11 @@ def test_post_user(mock_data_user, create_test_tables, client_test) -> None:
     assert response.status_code == 200
 
 
-def test_duplicate_id(mock_data_user, create_test_tables) -> None:
+def test_duplicate_id(mock_data_user, create_test_tables, db_connection) -> None:
     """
     Tests that a second user with the same user_id and different email as the first one, will not be passed to the database.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user1 = User(**mock_data_user)
         user2 = User(**mock_data_user)
@@ -69,12 +87,13 @@ def test_duplicate_id(mock_data_user, create_test_tables) -> None:
             insert_item(user2, "users", cur)
 
 
-def test_duplicate_email(mock_data_user, create_test_tables, client_test) -> None:
+def test_duplicate_email(
+    mock_data_user, create_test_tables, client_test, db_connection
+) -> None:
     """
     Tests that a second user with the same email and different user_id as the first one, will not be passed to the API or the database.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user1 = User(**mock_data_user)
         user2 = User(**mock_data_user)
@@ -98,13 +117,12 @@ def test_post_superuser(mock_data_superuser_complete, client_test) -> None:
 
 
 def test_post_activity(
-    mock_data_user, mock_data_activity, create_test_tables, client_test
+    mock_data_user, mock_data_activity, create_test_tables, client_test, db_connection
 ) -> None:
     """
     Tests that a valid activity will be passed to the API.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -123,13 +141,12 @@ def test_post_activity(
 
 
 def test_post_activity_no_userid(
-    mock_data_user, mock_data_activity, create_test_tables, client_test
+    mock_data_user, mock_data_activity, create_test_tables, client_test, db_connection
 ) -> None:
     """
     Failtests that an error is raised if one tries to post an activity with a user_id not present in the database.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -148,6 +165,55 @@ def test_post_activity_no_userid(
     assert response.json()["detail"] == "User ID not found"
 
 
+def test_post_activities_batch(
+    mock_data_user,
+    mock_data_activity,
+    mock_data_activity2,
+    create_test_tables,
+    client_test,
+    db_connection,
+) -> None:
+    """
+    Tests that the valid activities of a batch are added to the database, and the invalid ones are reported with their position.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        user = User(**mock_data_user)
+        insert_item(user, "users", cur)
+
+    batch = [
+        mock_data_activity,
+        {**mock_data_activity, "activity_type": "jump"},
+        {**mock_data_activity2, "user_id": mock_data_user["user_id"] + 1},
+        mock_data_activity2,
+    ]
+    response = client_test.post("/activities/batch", json=batch)
+    data = response.json()
+    assert response.status_code == 200
+    assert data["n_inserted"] == 2
+    assert [error["index"] for error in data["errors"]] == [1, 2]
+    assert data["errors"][1]["detail"] == "User ID not found"
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        activity_types = retrieve_items("activity_type", "activities", cur)
+    assert sorted(activity_types) == ["login", "purchase"]
+
+
+def test_post_activity_removed_user(
+    mock_data_user, mock_data_activity, create_test_tables, client_test, db_connection
+) -> None:
+    """
+    Failtests that an activity by a user still in the user_id cache, but not in the database anymore, is answered with 404.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+    app.state.user_ids.add(mock_data_activity["user_id"])
+
+    response = client_test.post("/activities/", params={**mock_data_activity})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "User ID not found"
+    assert mock_data_activity["user_id"] not in app.state.user_ids.user_ids
+
+
 def test_histogram_activity_types_grouped(
     create_test_tables,
     mock_data_activity,
@@ -155,9 +221,9 @@ def test_histogram_activity_types_grouped(
     mock_data_activity3,
     client_test,
     mock_data_user,
+    db_connection,
 ):
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -175,13 +241,18 @@ def test_histogram_activity_types_grouped(
             "activity1": "login",
             "activity2": "logout",
             "activity3": "purchase",
-            "period_days": "30",
+            "start_time": "2020-04-23T00:00:00Z",
+            "end_time": "2020-04-24T00:00:00Z",
+            "period_days": "0",
             "period_hours": "0",
         },
     )
 
     assert response.status_code == 200
-    # TODO: expand test with expected result, when the main function's output is fixed
+    assert response.json() == {
+        "index": [12, 14, 16],
+        "columns": {"login": [1, 0, 0], "logout": [0, 0, 1], "purchase": [0, 1, 0]},
+    }
 
 
 def test_total_activity_over_time(
@@ -191,9 +262,9 @@ def test_total_activity_over_time(
     mock_data_activity3,
     client_test,
     mock_data_user,
+    db_connection,
 ):
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -218,6 +289,349 @@ def test_total_activity_over_time(
     # TODO: expand test with expected result, when the main function's output is fixed
 
 
+def test_active_users(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_user,
+    mock_data_user2,
+    client_test,
+    db_connection,
+):
+    """
+    Tests that the active users are counted per time unit, with their error bounds, and that only the frequencies made of whole hours are accepted.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(User(**mock_data_user2), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+        insert_item(Activity(**mock_data_activity2), "activities", cur)
+    app.state.result_cache.clear()
+
+    params = {
+        "start_time": "2020-04-20T00:00:00Z",
+        "end_time": "2020-04-27T00:00:00Z",
+        "period_days": 0,
+        "frequency": "D",
+    }
+    response = client_test.get("/active_users/", params=params)
+    assert response.status_code == 200
+    columns = response.json()["columns"]
+    assert columns["active_users"] == [1]
+    assert columns["active_users_low"] <= [1] <= columns["active_users_high"]
+
+    response = client_test.post(
+        "/activities/",
+        params={
+            "time": "2020-04-23T18:00:00Z",
+            "user_id": mock_data_user2["user_id"],
+            "activity_type": "login",
+        },
+    )
+    assert response.status_code == 200
+    response = client_test.get("/active_users/", params=params)
+    assert response.json()["columns"]["active_users"] == [2]
+
+    response = client_test.get(
+        "/active_users/", params={**params, "frequency": "30min"}
+    )
+    assert response.status_code == 400
+    # the second user is dropped with the tables by the next tests
+    app.state.user_ids.discard(mock_data_user2["user_id"])
+
+
+def test_engagement_summary(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_activity3,
+    mock_data_user,
+    client_test,
+    db_connection,
+):
+    """
+    Tests that the engagement summary gives the same metrics as the separate endpoints for the same time period.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+        insert_item(Activity(**mock_data_activity2), "activities", cur)
+        insert_item(Activity(**mock_data_activity3), "activities", cur)
+    app.state.result_cache.clear()
+
+    for time, activity_type in [
+        ("2020-04-23T12:10:00Z", "purchase"),
+        ("2020-04-23T12:20:00Z", "logout"),
+        ("2020-04-24T09:00:00Z", "login"),
+    ]:
+        response = client_test.post(
+            "/activities/",
+            params={
+                "time": time,
+                "user_id": mock_data_user["user_id"],
+                "activity_type": activity_type,
+            },
+        )
+        assert response.status_code == 200
+    params = {
+        "start_time": "2020-04-20T00:00:00Z",
+        "end_time": "2020-04-27T00:00:00Z",
+        "period_days": 0,
+        "frequency": "D",
+    }
+    response = client_test.get("/engagement_summary/", params=params)
+    assert response.status_code == 200
+    summary = response.json()
+
+    totals = client_test.get(
+        "/total_activity_over_time/",
+        params={
+            **params,
+            "activity1": "click",
+            "activity2": "login",
+            "activity3": "logout",
+            "activity4": "purchase",
+        },
+    ).json()
+    assert summary["index"] == totals["index"]
+    for activity_type, counts in totals["columns"].items():
+        assert summary["columns"][activity_type] == counts
+    purchases = client_test.get("/purchases/", params=params).json()
+    assert (
+        summary["columns"]["avg_purchases_per_login"]
+        == purchases["columns"]["avg_purchases_per_login"]
+    )
+    # the stored sessions: the last login has no logout yet
+    avg_time = client_test.get("/avg_time/", params=params).json()
+    assert avg_time["index"] == summary["index"][:1]
+    assert summary["columns"]["n_sessions"] == avg_time["columns"]["n_sessions"] + [0]
+    assert summary["columns"]["duration"] == avg_time["columns"]["duration"] + [None]
+
+    # the sessions recomputed from the activities, read once for all the metrics
+    params["session_timeout_minutes"] = 30
+    recomputed = client_test.get("/engagement_summary/", params=params).json()
+    avg_time = client_test.get("/avg_time/", params=params).json()
+    assert recomputed["index"] == avg_time["index"] == summary["index"]
+    assert recomputed["columns"]["click"] == summary["columns"]["click"]
+    assert recomputed["columns"]["n_sessions"] == [1, 1]
+    assert recomputed["columns"]["duration"] == avg_time["columns"]["duration"]
+
+
+def test_session_percentiles(
+    create_test_tables,
+    mock_data_user,
+    client_test,
+    db_connection,
+):
+    """
+    Tests that the percentiles of the session durations follow the sessions closed by posted logouts, and that only the frequencies made of whole hours are accepted.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+    app.state.result_cache.clear()
+
+    params = {
+        "start_time": "2020-04-23T00:00:00Z",
+        "end_time": "2020-04-24T00:00:00Z",
+        "period_days": 0,
+    }
+    response = client_test.get("/session_percentiles/", params=params)
+    assert response.status_code == 200
+    assert response.json()["index"] == []
+
+    for time, activity_type in [
+        ("2020-04-23T12:00:00Z", "login"),
+        ("2020-04-23T12:10:00Z", "logout"),
+        ("2020-04-23T13:00:00Z", "login"),
+        ("2020-04-23T13:20:00Z", "logout"),
+    ]:
+        response = client_test.post(
+            "/activities/",
+            params={
+                "time": time,
+                "user_id": mock_data_user["user_id"],
+                "activity_type": activity_type,
+            },
+        )
+        assert response.status_code == 200
+    response = client_test.get("/session_percentiles/", params=params)
+    columns = response.json()["columns"]
+    assert columns["n_sessions"] == [2]
+    assert abs(columns["p50"][0] - 600) <= 6
+    assert abs(columns["p99"][0] - 1200) <= 12
+
+    response = client_test.get(
+        "/session_percentiles/", params={**params, "frequency": "30min"}
+    )
+    assert response.status_code == 400
+
+
+def test_retention(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_user,
+    mock_data_user2,
+    client_test,
+    db_connection,
+):
+    """
+    Tests that the users are grouped in weekly cohorts by their first activity, with the fraction of them active in the following weeks, and that too many time units are refused.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(User(**mock_data_user2), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+        insert_item(Activity(**mock_data_activity2), "activities", cur)
+    app.state.result_cache.clear()
+
+    for time, user_id in [
+        ("2020-04-24T09:00:00Z", mock_data_user2["user_id"]),
+        ("2020-05-05T09:00:00Z", mock_data_user["user_id"]),
+    ]:
+        response = client_test.post(
+            "/activities/",
+            params={"time": time, "user_id": user_id, "activity_type": "login"},
+        )
+        assert response.status_code == 200
+    params = {
+        "start_time": "2020-04-20T00:00:00Z",
+        "end_time": "2020-05-11T00:00:00Z",
+        "period_days": 0,
+        "frequency": "W",
+    }
+    response = client_test.get("/retention/", params=params)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["index"] == ["2020-04-26T00:00:00+00:00"]
+    assert result["columns"] == {
+        "cohort_size": [2],
+        "0": [1.0],
+        "1": [0.0],
+        "2": [0.5],
+    }
+
+    response = client_test.get("/retention/", params={**params, "frequency": "min"})
+    assert response.status_code == 400
+    # the second user is dropped with the tables by the next tests
+    app.state.user_ids.discard(mock_data_user2["user_id"])
+
+
+def test_analytics_pool(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_user,
+    client_test,
+    db_connection,
+):
+    """
+    Tests that the aggregations give the same answer in a worker process as in a thread, and that an aggregation over the timeout is answered with status code 503.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+        insert_item(Activity(**mock_data_activity2), "activities", cur)
+    app.state.result_cache.clear()
+    params = {
+        "start_time": "2020-04-01T00:00:00Z",
+        "end_time": "2020-06-01T00:00:00Z",
+        "period_days": 0,
+        "frequency": "W",
+    }
+    in_thread = client_test.get("/retention/", params=params)
+    assert in_thread.status_code == 200
+
+    default_pool = app.state.analytics_pool
+    pools = [
+        AnalyticsPool(workers=1, min_rows=0),
+        AnalyticsPool(workers=0, timeout_seconds=0),
+    ]
+    try:
+        app.state.analytics_pool = pools[0]
+        app.state.result_cache.clear()
+        in_process = client_test.get("/retention/", params=params)
+        assert in_process.status_code == 200
+        assert in_process.json() == in_thread.json()
+        assert client_test.get("/stats/").json()["analytics_pool"]["offloaded"] == 1
+
+        app.state.analytics_pool = pools[1]
+        app.state.result_cache.clear()
+        response = client_test.get("/retention/", params=params)
+        assert response.status_code == 503
+    finally:
+        app.state.analytics_pool = default_pool
+        for pool in pools:
+            pool.shutdown()
+
+
+def test_funnel(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_user,
+    mock_data_user2,
+    client_test,
+    db_connection,
+):
+    """
+    Tests the conversion of the users through the default login, click and purchase funnel, with a time limit and within sessions, and that invalid steps are refused.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(User(**mock_data_user2), "users", cur)
+    app.state.result_cache.clear()
+
+    for time, user_id, activity_type in [
+        ("2020-04-23T12:00:00Z", mock_data_user["user_id"], "login"),
+        ("2020-04-23T12:10:00Z", mock_data_user["user_id"], "click"),
+        ("2020-04-23T12:20:00Z", mock_data_user["user_id"], "logout"),
+        ("2020-04-23T13:00:00Z", mock_data_user["user_id"], "purchase"),
+        ("2020-04-23T12:00:00Z", mock_data_user2["user_id"], "login"),
+        ("2020-04-23T12:05:00Z", mock_data_user2["user_id"], "purchase"),
+    ]:
+        response = client_test.post(
+            "/activities/",
+            params={"time": time, "user_id": user_id, "activity_type": activity_type},
+        )
+        assert response.status_code == 200
+    params = {
+        "start_time": "2020-04-23T00:00:00Z",
+        "end_time": "2020-04-24T00:00:00Z",
+        "period_days": 0,
+    }
+    response = client_test.get("/funnel/", params=params)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["index"] == [1, 2, 3]
+    assert result["columns"]["activity_type"] == ["login", "click", "purchase"]
+    assert result["columns"]["users"] == [2, 1, 1]
+    assert result["columns"]["conversion"] == [1.0, 0.5, 0.5]
+    assert result["columns"]["step_conversion"] == [1.0, 0.5, 1.0]
+
+    response = client_test.get("/funnel/", params={**params, "within_minutes": 30})
+    assert response.json()["columns"]["users"] == [2, 1, 0]
+    response = client_test.get("/funnel/", params={**params, "same_session": True})
+    assert response.json()["columns"]["users"] == [2, 1, 0]
+    response = client_test.get(
+        "/funnel/", params={**params, "step1": "login", "step2": "purchase"}
+    )
+    assert response.json()["columns"]["users"] == [2, 2]
+
+    response = client_test.get(
+        "/funnel/", params={**params, "step1": "login", "step2": "buy"}
+    )
+    assert response.status_code == 400
+    # the second user is dropped with the tables by the next tests
+    app.state.user_ids.discard(mock_data_user2["user_id"])
+
+
 def test_avg_purchases(
     create_test_tables,
     mock_data_activity,
@@ -225,9 +639,9 @@ def test_avg_purchases(
     mock_data_activity3,
     client_test,
     mock_data_user,
+    db_connection,
 ):
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -259,9 +673,9 @@ def test_avg_time_spent(
     mock_data_activity3,
     client_test,
     mock_data_user,
+    db_connection,
 ):
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -283,14 +697,208 @@ def test_avg_time_spent(
     # TODO: expand test with expected result, when the main function's output is fixed
 
 
+def test_logout_closes_session(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_activity3,
+    client_test,
+    mock_data_user,
+    db_connection,
+):
+    """
+    Tests that posting a logout writes the session it closes to the sessions table, which is then used by /avg_time/.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+
+    # the purchase and the logout follow the login within the session timeout
+    activities = [
+        mock_data_activity,
+        {**mock_data_activity2, "time": "2020-04-23T12:20:01Z"},
+        {**mock_data_activity3, "time": "2020-04-23T12:40:01Z"},
+    ]
+    for activity in activities:
+        response = client_test.post("/activities/", params={**activity})
+        assert response.status_code == 200
+
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id, duration, purchased, timed_out FROM sessions")
+        rows = cur.fetchall()
+    assert rows == [
+        (mock_data_user["user_id"], datetime.timedelta(minutes=40), True, False)
+    ]
+
+    response = client_test.get(
+        "/avg_time/",
+        params={
+            "start_time": "2020-04-01T00:00:00Z",
+            "end_time": "2020-05-01T00:00:00Z",
+            "period_days": 0,
+            "frequency": "MS",
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["columns"] == {"duration": [2400.0], "n_sessions": [1]}
+
+
+def test_result_cache(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    client_test,
+    mock_data_user,
+    db_connection,
+):
+    """
+    Tests that repeated analytics queries are answered from the cache, and that posting an activity in their time window invalidates them.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+    app.state.result_cache.clear()
+
+    params = {
+        "start_time": "2020-04-01T00:00:00Z",
+        "end_time": "2020-05-01T00:00:00Z",
+        "period_days": 0,
+        "frequency": "MS",
+    }
+    first = client_test.get("/purchases/", params=params)
+    second = client_test.get("/purchases/", params=params)
+    assert first.status_code == 200
+    assert second.text == first.text
+    stats = client_test.get("/stats/").json()
+    assert (stats["result_cache"]["hits"], stats["result_cache"]["entries"]) == (1, 1)
+    assert stats["single_flight"]["in_flight"] == 0
+
+    response = client_test.post("/activities/", params={**mock_data_activity2})
+    assert response.status_code == 200
+    assert client_test.get("/stats/").json()["result_cache"]["entries"] == 0
+    third = client_test.get("/purchases/", params=params)
+    assert third.text != first.text
+
+
+def test_response_formats(
+    create_test_tables,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_activity3,
+    client_test,
+    mock_data_user,
+    db_connection,
+):
+    """
+    Tests that the analytics are answered as columnar JSON by default, and as Arrow IPC or HTML on request, and that large answers are gzip-compressed.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        for activity in [mock_data_activity, mock_data_activity2, mock_data_activity3]:
+            insert_item(Activity(**activity), "activities", cur)
+    app.state.result_cache.clear()
+
+    params = {
+        "start_time": "2020-04-23T00:00:00Z",
+        "end_time": "2020-04-24T00:00:00Z",
+        "period_days": 0,
+        "frequency": "h",
+    }
+    response = client_test.get("/total_activity_over_time/", params=params)
+    assert response.headers["content-type"] == "application/json"
+    data = response.json()
+    assert data["index"][0] == "2020-04-23T12:00:00+00:00"
+    assert data["columns"]["login"][:3] == [1, 0, 0]
+
+    response = client_test.get(
+        "/total_activity_over_time/", params={**params, "format": "arrow"}
+    )
+    table = pa.ipc.open_stream(response.content).read_pandas()
+    assert table["login"].tolist() == data["columns"]["login"]
+    assert response.headers["content-encoding"] == "gzip"
+
+    response = client_test.get(
+        "/total_activity_over_time/", params={**params, "format": "html"}
+    )
+    assert response.headers["content-type"].startswith("text/html")
+    assert response.text.startswith("<table")
+
+    response = client_test.get(
+        "/total_activity_over_time/", params={**params, "format": "csv"}
+    )
+    assert response.status_code == 422
+
+
+def test_hot_window(create_test_tables, client_test, mock_data_user, db_connection):
+    """
+    Tests that the analytics on the recent activities are answered from memory: the activities posted through the API are counted, while an activity written to the database behind the API is only seen by the windows older than the store.
+    """
+    now = datetime.datetime.now(datetime.UTC)
+    user_id = mock_data_user["user_id"]
+
+    def iso(hours_ago: int) -> str:
+        time = now - datetime.timedelta(hours=hours_ago)
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        app.state.hot_window.load(cur)
+    app.state.result_cache.clear()
+
+    batch = [
+        {"time": iso(hours_ago), "user_id": user_id, "activity_type": activity_type}
+        for hours_ago, activity_type in [(5, "login"), (4, "purchase"), (3, "logout")]
+    ]
+    response = client_test.post("/activities/batch", json=batch)
+    assert response.json()["n_inserted"] == 3
+    response = client_test.post(
+        "/activities/",
+        params={"time": iso(2), "user_id": user_id, "activity_type": "login"},
+    )
+    assert response.status_code == 200
+    assert client_test.get("/stats/").json()["hot_window"]["n_activities"] == 4
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        activity = Activity(
+            activity_id=long_uuid4_generator(),
+            time=iso(1),
+            user_id=user_id,
+            activity_type="login",
+        )
+        insert_item(activity, "activities", cur)
+
+    params = {"activity1": "login", "activity2": "purchase", "frequency": "D"}
+    response = client_test.get(
+        "/total_activity_over_time/", params={**params, "period_days": 1}
+    )
+    assert response.status_code == 200
+    columns = response.json()["columns"]
+    assert (sum(columns["login"]), sum(columns["purchase"])) == (2, 1)
+    response = client_test.get(
+        "/total_activity_over_time/", params={**params, "period_days": 60}
+    )
+    columns = response.json()["columns"]
+    assert (sum(columns["login"]), sum(columns["purchase"])) == (3, 1)
+
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        app.state.hot_window.load(cur)
+
+
 def test_filter_activities_by_user_id(
-    mock_data_user, mock_data_activity, create_test_tables, client_test, mock_data_user2
+    mock_data_user,
+    mock_data_activity,
+    create_test_tables,
+    client_test,
+    mock_data_user2,
+    db_connection,
 ) -> None:
     """
     Tests that the read_activities_by_userid works given valid input.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
@@ -312,14 +920,97 @@ def test_filter_activities_by_user_id(
     assert response.status_code == 200
 
 
+def test_activities_pages_and_stream(
+    mock_data_user, create_test_tables, client_test, db_connection
+) -> None:
+    """
+    Tests that the pages of activities follow each other through the keyset cursor, also among activities at the same time, and that the stream gives the same activities.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        activities = [
+            Activity(
+                activity_id=long_uuid4_generator(),
+                time=f"2020-04-23T12:00:{second // 2:02}Z",
+                user_id=mock_data_user["user_id"],
+                activity_type="click",
+            )
+            for second in range(25)
+        ]
+        copy_items(activities, "activities", cur)
+    expected = [
+        str(activity.activity_id)
+        for activity in sorted(activities, key=lambda a: (a.time, a.activity_id))
+    ]
+
+    # the cursor is pasted in the query string as it is, not encoded by the client
+    url = f"/activities/?user_id={mock_data_user['user_id']}&limit=10"
+    pages = []
+    while True:
+        response = client_test.get(url)
+        assert response.status_code == 200
+        pages.append([activity["activity_id"] for activity in response.json()])
+        if "X-Next-After" not in response.headers:
+            break
+        url = f"/activities/?user_id={mock_data_user['user_id']}&limit=10&after={response.headers['X-Next-After']}"
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == expected
+
+    response = client_test.get(
+        "/activities/",
+        params={"user_id": mock_data_user["user_id"], "stream": True},
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [activity["activity_id"] for activity in lines] == expected
+    assert lines[0]["time"] == "2020-04-23T12:00:00Z"
+
+
+@pytest.mark.parametrize(
+    "params, status_code",
+    [
+        ({"after": "yesterday"}, 400),
+        ({"after": "2020-04-23T12:00:00,00000000-0000-0000-0000-000000000000"}, 400),
+        ({"limit": 10001}, 400),
+        (
+            {"after": "2030-01-01T00:00:00+00:00,00000000-0000-0000-0000-000000000000"},
+            200,
+        ),
+    ],
+)
+def test_activities_pages_invalid(
+    mock_data_user,
+    mock_data_activity,
+    create_test_tables,
+    client_test,
+    db_connection,
+    params,
+    status_code,
+) -> None:
+    """
+    Tests that malformed cursors and too large pages are refused, and that a cursor after the last activity gives an empty page.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(Activity(**mock_data_activity), "activities", cur)
+
+    response = client_test.get(
+        "/activities/", params={"user_id": mock_data_user["user_id"], **params}
+    )
+    assert response.status_code == status_code
+    if status_code == 200:
+        assert response.json() == []
+
+
 def test_fail_filter_activities_user_id_not_found(
-    mock_data_user, mock_data_activity, create_test_tables, client_test
+    mock_data_user, mock_data_activity, create_test_tables, client_test, db_connection
 ) -> None:
     """
     Failtests that the read_activities_by_userid function in application.py will throw an error if there is no userid matching the query.
     """
-    conn = app.state.connection_manager.connection
-    with conn.cursor() as cur:
+    with db_connection.connection() as conn, conn.cursor() as cur:
         cur.execute(create_test_tables)
         user = User(**mock_data_user)
         insert_item(user, "users", cur)
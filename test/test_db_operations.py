@@ -0,0 +1,167 @@
+import asyncio
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models import User, Activity
+from tools.ConnectionManager import AsyncConnectionManager
+from tools.db_operations import (
+    insert_item,
+    insert_item_async,
+    insert_item_if_absent,
+    retrieve_items,
+    sql_to_arrays,
+    sql_to_arrays_async,
+    arrays_to_dataframe,
+    binary_copy_to_arrays,
+    create_activities_filter,
+)
+
+ACTIVITY_COLUMNS = ["time", "user_id", "activity_type"]
+
+
+def test_sql_to_arrays_filtered(
+    db_connection,
+    create_test_tables,
+    mock_data_user,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_activity3,
+):
+    """
+    Tests that the activities filter is applied by the database, on both time window and activity types.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        for mock_data in [mock_data_activity, mock_data_activity2, mock_data_activity3]:
+            insert_item(Activity(**mock_data), "activities", cur)
+
+        start = datetime.datetime.fromisoformat("2020-04-23T12:00:01Z")
+        end = datetime.datetime.fromisoformat("2020-04-23T16:00:01Z")
+        where, params = create_activities_filter(start, end)
+        df = arrays_to_dataframe(
+            sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+        )
+        assert sorted(df["activity_type"]) == ["logout", "purchase"]
+
+        where, params = create_activities_filter(start, end, ["logout", "click"])
+        df = arrays_to_dataframe(
+            sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+        )
+        assert df["activity_type"].tolist() == ["logout"]
+        assert str(df["time"].dtype) == "datetime64[ns, UTC]"
+
+
+def test_insert_item_if_absent(db_connection, create_test_tables, mock_data_user):
+    """
+    Tests that a user with an already registered email is not inserted, and that no exception is raised.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        user1 = User(**mock_data_user)
+        user2 = User(**mock_data_user)
+        user2.user_id = user1.user_id - 1
+        assert insert_item_if_absent(user1, "users", "email", cur)
+        assert not insert_item_if_absent(user2, "users", "email", cur)
+        assert cur.execute("SELECT count(*) FROM users").fetchone()[0] == 1
+
+
+def test_async_operations(
+    db_connection,
+    create_test_tables,
+    mock_data_user,
+    mock_data_activity,
+    mock_data_activity2,
+):
+    """
+    Tests that the asynchronous variants write and read the same rows as the synchronous ones.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+
+    async def run():
+        connection_manager = AsyncConnectionManager(db_connection.connection_config)
+        await connection_manager.connect()
+        try:
+            async with connection_manager.connection() as conn, conn.cursor() as cur:
+                await insert_item_async(User(**mock_data_user), "users", cur)
+                for mock_data in [mock_data_activity, mock_data_activity2]:
+                    await insert_item_async(Activity(**mock_data), "activities", cur)
+                where, params = create_activities_filter(
+                    datetime.datetime.fromisoformat("2020-04-23T12:00:01Z"),
+                    datetime.datetime.fromisoformat("2020-04-23T16:00:01Z"),
+                )
+                arrays = await sql_to_arrays_async(
+                    "activities", cur, ACTIVITY_COLUMNS, where, params
+                )
+        finally:
+            await connection_manager.disconnect()
+        return arrays
+
+    df = arrays_to_dataframe(asyncio.run(run()))
+    assert df["activity_type"].tolist() == ["purchase"]
+    assert df["user_id"].tolist() == [mock_data_user["user_id"]]
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        assert retrieve_items("user_id", "users", cur) == [mock_data_user["user_id"]]
+        assert len(retrieve_items("activity_id", "activities", cur)) == 2
+
+
+def test_sql_to_arrays(
+    db_connection,
+    create_test_tables,
+    mock_data_user,
+    mock_data_activity,
+    mock_data_activity2,
+    mock_data_activity3,
+):
+    """
+    Tests that the binary export decodes into the same values as the rows read with a plain query.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        for mock_data in [mock_data_activity, mock_data_activity2, mock_data_activity3]:
+            insert_item(Activity(**mock_data), "activities", cur)
+        columns = ACTIVITY_COLUMNS
+        arrays = sql_to_arrays("activities", cur, columns)
+        rows = cur.execute("SELECT time, user_id, activity_type FROM activities")
+        expected = pd.DataFrame(rows.fetchall(), columns=columns)
+
+        assert arrays["time"].dtype == np.int64
+        assert arrays["user_id"].dtype == np.int32
+        assert arrays["activity_type"].tolist() == [1, 3, 2]
+        df = arrays_to_dataframe(arrays)
+        assert isinstance(df["activity_type"].dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(
+            df.astype({"user_id": "int64", "activity_type": "object"}),
+            expected.astype({"time": "datetime64[ns, UTC]"}),
+        )
+
+        where, params = create_activities_filter(
+            datetime.datetime.fromisoformat("2030-01-01T00:00:00Z"),
+            datetime.datetime.fromisoformat("2031-01-01T00:00:00Z"),
+        )
+        arrays = sql_to_arrays("activities", cur, columns, where, params)
+        assert all(len(values) == 0 for values in arrays.values())
+
+        # rows written without the API may have NULL values, which are left out instead of failing the export
+        cur.execute(
+            "UPDATE activities SET user_id = NULL WHERE activity_type = 'login'"
+        )
+        cur.execute(
+            "UPDATE activities SET activity_type = NULL WHERE activity_type = 'logout'"
+        )
+        arrays = sql_to_arrays("activities", cur, columns)
+        assert arrays["activity_type"].tolist() == [3]
+        arrays = sql_to_arrays("activities", cur, ["time", "user_id"])
+        assert len(arrays["time"]) == 2
+
+    with pytest.raises(ValueError):
+        # header, then a row with a NULL (length -1) user_id, then the trailer
+        binary_copy_to_arrays(
+            b"PGCOPY\n\xff\r\n\x00" + bytes(8) + b"\x00\x01" + b"\xff" * 6,
+            ["user_id"],
+        )
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tools.aggregation import count_arrays_per_bucket
+from tools.db_operations import ACTIVITY_TYPES
+from tools.engagement import engagement_summary
+from tools.sessions import average_session_duration, sessionize
+
+
+@pytest.mark.parametrize("frequency", ["D", "2D", "6h", "W", "MS", "ME"])
+def test_engagement_summary(frequency):
+    """
+    Tests that the summary gives the same counts, purchases per login and session durations as the separate computations, in the same time buckets.
+    """
+    rng = np.random.default_rng(24)
+    n_activities = 20000
+    arrays = {
+        "time": np.sort(
+            rng.integers(1704067200 * 10**6, 1709251200 * 10**6, n_activities)
+        ),
+        "user_id": rng.integers(0, 500, n_activities).astype(np.int32),
+        "activity_type": rng.integers(0, len(ACTIVITY_TYPES), n_activities).astype(
+            np.int8
+        ),
+    }
+    summary = engagement_summary(arrays, frequency, pd.Timedelta(minutes=30))
+
+    counts = count_arrays_per_bucket(arrays, ACTIVITY_TYPES, frequency)
+    pd.testing.assert_frame_equal(
+        summary[ACTIVITY_TYPES], counts.rename_axis(columns=None)
+    )
+    pd.testing.assert_series_equal(
+        summary["avg_purchases_per_login"],
+        counts["purchase"] / counts["login"],
+        check_names=False,
+    )
+    durations = average_session_duration(
+        sessionize(arrays, pd.Timedelta(minutes=30)), frequency
+    )
+    durations = durations[durations["n_sessions"] > 0]
+    with_sessions = summary[summary["n_sessions"] > 0]
+    assert with_sessions["n_sessions"].tolist() == durations["n_sessions"].tolist()
+    assert with_sessions["duration"].tolist() == durations["duration"].tolist()
+
+
+def test_engagement_summary_without_sessions():
+    """
+    Tests the summary of activities without logins, and of no activities.
+    """
+    arrays = {
+        "time": np.array([0, 10**6, 2 * 86400 * 10**6]),
+        "user_id": np.array([1, 1, 2], dtype=np.int32),
+        "activity_type": np.array(
+            [ACTIVITY_TYPES.index("click")] * 2 + [ACTIVITY_TYPES.index("purchase")],
+            dtype=np.int8,
+        ),
+    }
+    summary = engagement_summary(arrays, "D")
+    assert summary["click"].tolist() == [2, 0, 0]
+    assert summary["purchase"].tolist() == [0, 0, 1]
+    assert summary["n_sessions"].tolist() == [0, 0, 0]
+    assert summary["duration"].isna().all()
+
+    empty = {key: values[:0] for key, values in arrays.items()}
+    summary = engagement_summary(empty, "D")
+    assert summary.empty
+    assert "n_sessions" in summary.columns
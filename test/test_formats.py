@@ -0,0 +1,68 @@
+import orjson
+import pandas as pd
+import pyarrow as pa
+
+from src.models import ResponseFormats
+from tools.formats import dataframe_to_columnar, render_dataframe
+
+
+def mock_result() -> pd.DataFrame:
+    """
+    Helper function returning a DataFrame like the answers of the analytics endpoints, with a time index, counts, averages and durations.
+    """
+    index = pd.date_range("2020-01-01", periods=3, freq="D", tz="UTC", name="time")
+    return pd.DataFrame(
+        {
+            "login": [2, 0, 1],
+            "avg_purchases_per_login": [0.5, float("nan"), 1.0],
+            "duration": pd.to_timedelta([90, None, 30], unit="s"),
+        },
+        index=index,
+    )
+
+
+def test_columnar_json():
+    """
+    Tests that times are written in UTC, durations in seconds, and missing values as null.
+    """
+    data = orjson.loads(render_dataframe(mock_result(), ResponseFormats.json))
+    assert data["index"] == [
+        "2020-01-01T00:00:00+00:00",
+        "2020-01-02T00:00:00+00:00",
+        "2020-01-03T00:00:00+00:00",
+    ]
+    assert data["columns"] == {
+        "login": [2, 0, 1],
+        "avg_purchases_per_login": [0.5, None, 1.0],
+        "duration": [90.0, None, 30.0],
+    }
+
+
+def test_columnar_object_columns():
+    """
+    Tests that text columns and indexes are converted to lists, with null for missing values.
+    """
+    df = pd.DataFrame({"activity_type": ["login", None]}, index=["a", "b"])
+    assert dataframe_to_columnar(df) == {
+        "index": ["a", "b"],
+        "columns": {"activity_type": ["login", None]},
+    }
+
+
+def test_arrow_round_trip():
+    """
+    Tests that the Arrow IPC stream gives back the DataFrame, with its index and dtypes.
+    """
+    df = mock_result()
+    body = render_dataframe(df, ResponseFormats.arrow)
+    pd.testing.assert_frame_equal(
+        pa.ipc.open_stream(body).read_pandas(), df, check_freq=False
+    )
+
+
+def test_html():
+    """
+    Tests that the HTML format is the table given by DataFrame.to_html.
+    """
+    df = mock_result()
+    assert render_dataframe(df, ResponseFormats.html).decode() == df.to_html()
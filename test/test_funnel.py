@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tools.db_operations import ACTIVITY_TYPES
+from tools.funnel import funnel_conversion
+from tools.sessions import TIE_BREAK
+
+MINUTE = 60 * 10**6
+
+
+def naive_funnel_users(
+    arrays: dict, steps: list, within: int | None, same_session: bool, timeout: int
+) -> list:
+    """
+    Helper function counting the users reaching each step of a funnel with a loop over the users and their attempts, as a reference for funnel_conversion. within and timeout are in microseconds.
+    """
+    activities = pd.DataFrame(arrays)
+    activities["tie_break"] = TIE_BREAK[activities["activity_type"]]
+    activities = activities.sort_values(["user_id", "time", "tie_break"], kind="stable")
+    codes = [ACTIVITY_TYPES.index(step) for step in steps]
+    users = np.zeros(len(steps), dtype=np.int64)
+    for _, user in activities.groupby("user_id"):
+        times = user["time"].tolist()
+        types = user["activity_type"].tolist()
+        # session number of each activity
+        sessions = [0]
+        for i in range(1, len(times)):
+            new_session = (
+                types[i] == ACTIVITY_TYPES.index("login")
+                or types[i - 1] == ACTIVITY_TYPES.index("logout")
+                or times[i] - times[i - 1] > timeout
+            )
+            sessions.append(sessions[-1] + new_session)
+        best = 0
+        for start in range(len(times)):
+            if types[start] != codes[0]:
+                continue
+            depth, position = 1, start
+            for code in codes[1:]:
+                following = [
+                    i
+                    for i in range(position + 1, len(times))
+                    if types[i] == code
+                    and (within is None or times[i] - times[start] <= within)
+                    and (not same_session or sessions[i] == sessions[start])
+                ]
+                if not following:
+                    break
+                depth, position = depth + 1, following[0]
+            best = max(best, depth)
+        users[:best] += 1
+    return users.tolist()
+
+
+@pytest.mark.parametrize(
+    ("steps", "within_minutes", "same_session"),
+    [
+        (["login", "click", "purchase"], None, False),
+        (["login", "click", "purchase"], 20, False),
+        (["login", "click", "purchase"], None, True),
+        (["click", "click", "purchase", "logout"], 60, True),
+        (["purchase"], None, False),
+    ],
+)
+def test_funnel_conversion_random(steps, within_minutes, same_session):
+    """
+    Tests that the vectorized funnel matches a loop over the attempts of each user, with and without time limit and sessions.
+    """
+    rng = np.random.default_rng(22)
+    n_activities = 3000
+    arrays = {
+        "time": rng.integers(0, 3 * 24 * 60, n_activities) * MINUTE,
+        "user_id": rng.integers(0, 100, n_activities).astype(np.int32),
+        "activity_type": rng.choice(
+            len(ACTIVITY_TYPES), n_activities, p=[0.5, 0.2, 0.2, 0.1]
+        ).astype(np.int8),
+    }
+    within = None if within_minutes is None else pd.Timedelta(minutes=within_minutes)
+    timeout = pd.Timedelta(minutes=30)
+    result = funnel_conversion(arrays, steps, within, same_session, timeout)
+    expected = naive_funnel_users(
+        arrays,
+        steps,
+        None if within is None else within_minutes * MINUTE,
+        same_session,
+        30 * MINUTE,
+    )
+    assert result["users"].tolist() == expected
+    assert result["activity_type"].tolist() == steps
+    assert result.index.tolist() == list(range(1, len(steps) + 1))
+
+
+def test_funnel_conversion_small():
+    """
+    Tests the conversion fractions of a few users, that the steps must come in order, and an empty funnel.
+    """
+    login, click, purchase = (
+        ACTIVITY_TYPES.index(t) for t in ["login", "click", "purchase"]
+    )
+    arrays = {
+        "time": np.array([0, 1, 2, 0, 1, 0, 1]) * MINUTE,
+        "user_id": np.array([1, 1, 1, 2, 2, 3, 3], dtype=np.int32),
+        "activity_type": np.array(
+            [login, click, purchase, login, click, purchase, login], dtype=np.int8
+        ),
+    }
+    result = funnel_conversion(arrays, ["login", "click", "purchase"])
+    assert result["users"].tolist() == [3, 2, 1]
+    np.testing.assert_allclose(result["conversion"], [1, 2 / 3, 1 / 3])
+    np.testing.assert_allclose(result["step_conversion"], [1, 2 / 3, 1 / 2])
+
+    empty = {key: values[:0] for key, values in arrays.items()}
+    result = funnel_conversion(empty, ["login", "purchase"])
+    assert result["users"].tolist() == [0, 0]
+    assert result["conversion"].isna().all()
@@ -0,0 +1,174 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models import User, Activity
+from tools.aggregation import (
+    activity_counts_over_time,
+    count_arrays_per_bucket,
+    count_arrays_per_time_bin,
+)
+from tools.db_operations import (
+    insert_item,
+    arrays_to_dataframe,
+    sql_to_arrays,
+    create_activities_filter,
+)
+from tools.hot_window import HotWindowStore, to_microseconds
+from tools.tools import long_uuid4_generator
+
+NOW = datetime.datetime(2021, 1, 1, tzinfo=datetime.UTC)
+
+ACTIVITY_COLUMNS = ["time", "user_id", "activity_type"]
+
+
+def make_activity(user_id: int, time: datetime.datetime, activity_type: str):
+    """
+    Helper function creating an activity of a user at a given time.
+    """
+    return Activity(
+        activity_id=long_uuid4_generator(),
+        time=time.isoformat(),
+        user_id=user_id,
+        activity_type=activity_type,
+    )
+
+
+def empty_store() -> HotWindowStore:
+    """
+    Helper function creating a store of one day, loaded at NOW from an empty table.
+    """
+    store = HotWindowStore(window=datetime.timedelta(days=1))
+    store.covered_from = to_microseconds(NOW - datetime.timedelta(days=1))
+    return store
+
+
+@pytest.fixture(scope="module")
+def random_activities(db_connection, create_test_tables, mock_data_user):
+    """
+    Fixture filling the test database with a user and 300 activities spread over 2020, and returning the time window containing them.
+    """
+    rng = np.random.default_rng(7)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        for seconds, activity_type in zip(
+            rng.integers(0, 366 * 24 * 60 * 60, 300),
+            rng.choice(["login", "logout", "click", "purchase"], 300),
+        ):
+            time = start + datetime.timedelta(seconds=int(seconds))
+            activity = make_activity(mock_data_user["user_id"], time, activity_type)
+            insert_item(activity, "activities", cur)
+    return start, start + datetime.timedelta(days=366)
+
+
+@pytest.fixture(scope="module")
+def loaded_store(db_connection, random_activities):
+    """
+    Fixture loading the activities of 2020 in a HotWindowStore, whose window ends on 2021-01-01.
+    """
+    store = HotWindowStore(window=datetime.timedelta(days=400))
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        store.load(cur, now=NOW)
+    return store
+
+
+@pytest.mark.parametrize(
+    "frequency", ["MS", "QS", "YS", "ME", "QE", "YE", "W", "D", "h", "1h30min", "5D"]
+)
+def test_store_counts_match_database(
+    db_connection, random_activities, loaded_store, frequency
+):
+    """
+    Tests that the counts made from the store are the same as the ones made by the database.
+    """
+    start, end = random_activities
+    start = start + datetime.timedelta(days=3, hours=5, minutes=17)
+    end = end - datetime.timedelta(hours=2, minutes=43)
+    activity_types = ["login", "purchase", "click"]
+    assert loaded_store.covers(start, now=NOW)
+    arrays = loaded_store.window_arrays(start, end)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        expected = activity_counts_over_time(cur, start, end, activity_types, frequency)
+    result = count_arrays_per_bucket(arrays, activity_types, frequency)
+    pd.testing.assert_frame_equal(result, expected, check_freq=False)
+
+
+@pytest.mark.parametrize(
+    "time_bin", ["second", "minute", "hour", "day", "month", "year"]
+)
+def test_store_time_bins_match_pandas(
+    db_connection, random_activities, loaded_store, time_bin
+):
+    """
+    Tests that the counts per time bin made from the store are the same as the ones made with pandas.
+    """
+    start, end = random_activities
+    activity_types = ["login", "logout"]
+    where, params = create_activities_filter(start, end, activity_types)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        df = arrays_to_dataframe(
+            sql_to_arrays("activities", cur, ACTIVITY_COLUMNS, where, params)
+        )
+    expected = (
+        df.groupby(
+            [getattr(df["time"].dt, time_bin).rename(time_bin), df["activity_type"]],
+            observed=True,
+        )
+        .size()
+        .unstack(fill_value=0)
+    )
+    expected.columns = expected.columns.astype(str)
+    result = count_arrays_per_time_bin(
+        loaded_store.window_arrays(start, end), activity_types, time_bin
+    )
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_append_out_of_order():
+    """
+    Tests that activities appended out of order are found by time, that activities older than the window are skipped, and that the arrays handed out before are left untouched.
+    """
+    store = empty_store()
+    hour = datetime.timedelta(hours=1)
+    store.append([make_activity(1, NOW - 3 * hour, "login")])
+    before = store.window_arrays(NOW - 24 * hour, NOW)
+    store.append(
+        [
+            make_activity(2, NOW - 5 * hour, "click"),
+            make_activity(1, NOW - 2 * hour, "logout"),
+            make_activity(3, NOW - 30 * hour, "purchase"),
+        ]
+    )
+    assert len(store) == 3
+    assert before["user_id"].tolist() == [1]
+
+    arrays = store.window_arrays(NOW - 6 * hour, NOW - 2 * hour)
+    assert arrays["user_id"].tolist() == [2, 1, 1]
+    assert arrays["activity_type"].tolist() == [0, 1, 2]
+    assert np.all(np.diff(arrays["time"]) >= 0)
+    # start excluded, end included
+    arrays = store.window_arrays(NOW - 5 * hour, NOW - 3 * hour)
+    assert arrays["user_id"].tolist() == [1]
+
+
+def test_evict():
+    """
+    Tests that the activities older than the window are dropped as time goes by, and that the windows starting before the covered time are not answered from the store.
+    """
+    store = empty_store()
+    hours = [23, 20, 10, 1]
+    store.append(
+        [make_activity(1, NOW - datetime.timedelta(hours=h), "click") for h in hours]
+    )
+    assert store.covers(NOW - datetime.timedelta(hours=24), now=NOW)
+    assert not store.covers(NOW - datetime.timedelta(hours=25), now=NOW)
+
+    later = NOW + datetime.timedelta(hours=5)
+    assert not store.covers(NOW - datetime.timedelta(hours=23), now=later)
+    assert store.covers(NOW - datetime.timedelta(hours=19), now=later)
+    assert len(store) == 2
+    assert store.get_stats()["covered_from"] == pd.Timestamp("2020-12-31 05:00Z")
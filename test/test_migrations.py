@@ -0,0 +1,93 @@
+import psycopg
+import pytest
+
+from tools.migrations import MIGRATIONS, apply_migrations
+
+
+def test_apply_migrations(db_connection):
+    """
+    Tests that the migrations build the schema on an empty database, and are not applied twice.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DROP TABLE IF EXISTS activities, users, activity_counts_hourly, sessions, active_users_hourly, session_durations_hourly, schema_migrations CASCADE"
+        )
+        assert apply_migrations(conn) == [version for version, _, _ in MIGRATIONS]
+        assert apply_migrations(conn) == []
+        cur.execute("SELECT version FROM schema_migrations ORDER BY version")
+        assert [row[0] for row in cur.fetchall()] == [v for v, _, _ in MIGRATIONS]
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'activities'")
+        indexes = {row[0] for row in cur.fetchall()}
+    assert {
+        "activities_user_id_time_activity_id_idx",
+        "activities_activity_type_time_idx",
+        "activities_time_brin_idx",
+    } <= indexes
+
+
+def test_apply_migrations_existing_database(db_connection, mock_data_user):
+    """
+    Tests that the migrations can be applied to a database created before them (e.g. with init.sql), keeping its data.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DROP TABLE IF EXISTS activities, users, activity_counts_hourly, sessions, active_users_hourly, session_durations_hourly, schema_migrations CASCADE"
+        )
+        # schema without indexes nor schema_migrations, as built by init.sql
+        cur.execute(MIGRATIONS[0][2])
+        cur.execute(
+            "INSERT INTO users (user_id, username, email, age) VALUES (%(user_id)s, %(username)s, %(email)s, %(age)s)",
+            mock_data_user,
+        )
+        cur.execute(
+            "INSERT INTO activities (activity_id, user_id, time, activity_type) VALUES (gen_random_uuid(), %(user_id)s, '2020-04-23T12:00:00Z', 'login')",
+            mock_data_user,
+        )
+        assert apply_migrations(conn) == [version for version, _, _ in MIGRATIONS]
+        cur.execute("SELECT count(*) FROM users")
+        assert cur.fetchone()[0] == 1
+        # the activities are moved to the partition of their month
+        cur.execute("SELECT tableoid::regclass::text FROM activities")
+        assert cur.fetchall() == [("activities_2020_04",)]
+
+
+def test_partitioning_rejects_activities_without_time(db_connection, mock_data_user):
+    """
+    Tests that the partitioning of activities stops with an explicit error, and changes nothing, if some activities have no time.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DROP TABLE IF EXISTS activities, users, activity_counts_hourly, sessions, active_users_hourly, session_durations_hourly, schema_migrations CASCADE"
+        )
+        cur.execute(MIGRATIONS[0][2])
+        cur.execute(
+            "INSERT INTO users (user_id, username, email, age) VALUES (%(user_id)s, %(username)s, %(email)s, %(age)s)",
+            mock_data_user,
+        )
+        cur.execute(
+            "INSERT INTO activities (activity_id, user_id, activity_type) VALUES (gen_random_uuid(), %(user_id)s, 'login')",
+            mock_data_user,
+        )
+        with pytest.raises(psycopg.errors.RaiseException, match="without time"):
+            apply_migrations(conn)
+        cur.execute("SELECT max(version) FROM schema_migrations")
+        assert cur.fetchone()[0] == 5
+        cur.execute("SELECT count(*) FROM activities WHERE time IS NULL")
+        assert cur.fetchone()[0] == 1
+
+
+def test_failed_migration_is_rolled_back(db_connection, create_test_tables):
+    """
+    Tests that a failing migration is not recorded, and leaves no partial change.
+    """
+    broken = MIGRATIONS + [
+        (10_000, "broken", "CREATE TABLE half_done (x INT); SELECT 1/0;")
+    ]
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        with pytest.raises(psycopg.errors.DivisionByZero):
+            apply_migrations(conn, broken)
+        cur.execute("SELECT to_regclass('half_done') IS NULL")
+        assert cur.fetchone()[0]
+        cur.execute("SELECT max(version) FROM schema_migrations")
+        assert cur.fetchone()[0] == MIGRATIONS[-1][0]
@@ -0,0 +1,150 @@
+import datetime
+
+import pytest
+
+from src.models import User, Activity
+from tools.db_operations import (
+    insert_item,
+    copy_items,
+    create_activities_filter,
+    create_user_activities_query,
+)
+from tools.partitions import (
+    PARTITION_MONTHS_AHEAD,
+    create_future_partitions,
+    detach_partitions,
+    list_partitions,
+)
+from tools.tools import long_uuid4_generator
+
+
+def scanned_tables(cur, query: str, params: dict) -> set:
+    """
+    Helper function returning the names of the tables read by a query, according to its plan.
+    """
+    cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+    plan = cur.fetchone()[0][0]["Plan"]
+    tables = set()
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if "Relation Name" in node:
+            tables.add(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return tables
+
+
+@pytest.fixture()
+def monthly_activities(db_connection, create_test_tables, mock_data_user):
+    """
+    Fixture filling the test database with one activity per day of the first half of 2020, stored in the default partition, and then creating the partitions of those months.
+    """
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+    activities = [
+        Activity(
+            activity_id=long_uuid4_generator(),
+            time=(start + datetime.timedelta(days=day, hours=12)).isoformat(),
+            user_id=mock_data_user["user_id"],
+            activity_type="click",
+        )
+        for day in range(182)
+    ]
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        cur.execute("DROP TABLE IF EXISTS activities_2020_01, activities_2020_02")
+        insert_item(User(**mock_data_user), "users", cur)
+        copy_items(activities, "activities", cur)
+        cur.execute("SELECT count(*) FROM activities_default")
+        assert cur.fetchone()[0] == len(activities)
+        cur.execute(
+            "SELECT create_activity_partitions('2020-01-01T00:00:00Z', '2020-06-30T00:00:00Z')"
+        )
+        assert cur.fetchone()[0] == 6
+    return activities
+
+
+def test_partitions_created(db_connection, monthly_activities):
+    """
+    Tests that creating the partitions moves the activities out of the default partition, without changing the hourly counts, and that the coming months have their partitions.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM activities_default")
+        assert cur.fetchone()[0] == 0
+        cur.execute(
+            "SELECT tableoid::regclass::text, count(*) FROM activities GROUP BY 1 ORDER BY 1"
+        )
+        assert cur.fetchall() == [
+            ("activities_2020_01", 31),
+            ("activities_2020_02", 29),
+            ("activities_2020_03", 31),
+            ("activities_2020_04", 30),
+            ("activities_2020_05", 31),
+            ("activities_2020_06", 30),
+        ]
+        cur.execute("SELECT sum(count) FROM activity_counts_hourly")
+        assert cur.fetchone()[0] == len(monthly_activities)
+
+        assert create_future_partitions(cur) == 0
+        now = datetime.datetime.now(datetime.UTC)
+        months = {(start.year, start.month) for _, start, _ in list_partitions(cur)}
+        for months_ahead in range(PARTITION_MONTHS_AHEAD + 1):
+            month = now.month - 1 + months_ahead
+            assert (now.year + month // 12, month % 12 + 1) in months
+
+
+def test_partition_pruning(db_connection, monthly_activities):
+    """
+    Tests that a 30-day window only reads the partitions of the months it overlaps.
+    """
+    start = datetime.datetime(2020, 3, 10, tzinfo=datetime.UTC)
+    where, params = create_activities_filter(
+        start, start + datetime.timedelta(days=30), ["click"]
+    )
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        tables = scanned_tables(
+            cur, f"SELECT count(*) FROM activities WHERE {where}", params
+        )
+    assert tables == {"activities_2020_03", "activities_2020_04"}
+
+    # the pages after a keyset cursor skip the months before it
+    query, params = create_user_activities_query(
+        monthly_activities[0].user_id,
+        (datetime.datetime(2020, 5, 20, tzinfo=datetime.UTC), long_uuid4_generator()),
+        100,
+    )
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        tables = scanned_tables(cur, query, params)
+    assert "activities_2020_04" not in tables
+    assert {"activities_2020_05", "activities_2020_06"} <= tables
+
+
+def test_detach_partitions(db_connection, monthly_activities):
+    """
+    Tests that detaching the old months removes their activities, hourly counts and sessions, and keeps or drops their tables.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO sessions VALUES (%(user_id)s, '2020-01-05T12:00:00Z', '2020-01-05T12:30:00Z', '30 minutes', 0, FALSE, FALSE)",
+            {"user_id": monthly_activities[0].user_id},
+        )
+        assert detach_partitions(
+            conn, datetime.datetime(2020, 2, 15, tzinfo=datetime.UTC)
+        ) == ["activities_2020_01"]
+        assert detach_partitions(
+            conn, datetime.datetime(2020, 3, 1, tzinfo=datetime.UTC), drop=True
+        ) == ["activities_2020_02"]
+        cur.execute("SELECT min(time) FROM activities")
+        assert cur.fetchone()[0] == datetime.datetime(
+            2020, 3, 1, 12, tzinfo=datetime.UTC
+        )
+        cur.execute("SELECT min(bucket) FROM activity_counts_hourly")
+        assert cur.fetchone()[0] == datetime.datetime(
+            2020, 3, 1, 12, tzinfo=datetime.UTC
+        )
+        cur.execute("SELECT count(*) FROM sessions")
+        assert cur.fetchone()[0] == 0
+        cur.execute(
+            "SELECT to_regclass('activities_2020_01') IS NOT NULL, to_regclass('activities_2020_02') IS NULL"
+        )
+        assert cur.fetchone() == (True, True)
+        cur.execute("DROP TABLE activities_2020_01")
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tools.process_pool
+from tools.aggregation import count_arrays_per_bucket
+from tools.process_pool import (
+    AnalyticsPool,
+    JobTimeout,
+    arrays_to_shared_memory,
+    shared_memory_to_arrays,
+)
+
+
+def random_arrays(n: int) -> dict:
+    """
+    Helper function generating n random activities of 2020, as arrays.
+    """
+    rng = np.random.default_rng(7)
+    start = pd.Timestamp("2020-01-01", tz="UTC").value // 1000
+    return {
+        "time": np.sort(rng.integers(start, start + 366 * 86400 * 10**6, n)),
+        "user_id": rng.integers(0, 1000, n).astype(np.int32),
+        "activity_type": rng.integers(0, 4, n).astype(np.int8),
+    }
+
+
+def sleep_then_count(arrays: dict, seconds: float) -> int:
+    """
+    Job sleeping before counting the activities, to test the timeout.
+    """
+    time.sleep(seconds)
+    return len(arrays["time"])
+
+
+def test_shared_memory_round_trip():
+    """
+    Tests that arrays of different types and sizes, empty ones included, are read back unchanged and read-only from their shared memory block.
+    """
+    arrays = {**random_arrays(1001), "empty": np.array([], dtype=np.float64)}
+    block, layout = arrays_to_shared_memory(arrays)
+    try:
+        shared = shared_memory_to_arrays(block, layout)
+        assert shared.keys() == arrays.keys()
+        for key, array in arrays.items():
+            assert shared[key].dtype == array.dtype
+            np.testing.assert_array_equal(shared[key], array)
+            assert not shared[key].flags.writeable
+        del shared
+    finally:
+        block.close()
+        block.unlink()
+
+
+def test_jobs_in_worker_processes(monkeypatch):
+    """
+    Tests that a job run in a worker process gives the same result as a direct call, and that its shared memory block is removed afterwards.
+    """
+    names = []
+
+    def record_block(arrays):
+        block, layout = arrays_to_shared_memory(arrays)
+        names.append(block.name)
+        return block, layout
+
+    monkeypatch.setattr(tools.process_pool, "arrays_to_shared_memory", record_block)
+    arrays = random_arrays(10_000)
+    pool = AnalyticsPool(workers=1, min_rows=0)
+    try:
+        result = asyncio.run(
+            pool.run(count_arrays_per_bucket, arrays, ["login", "purchase"], "W")
+        )
+    finally:
+        pool.shutdown()
+    expected = count_arrays_per_bucket(arrays, ["login", "purchase"], "W")
+    pd.testing.assert_frame_equal(result, expected)
+    stats = pool.get_stats()
+    assert (stats["offloaded"], stats["in_threads"], stats["running"]) == (1, 0, 0)
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=names[0])
+
+
+def test_small_jobs_run_in_threads():
+    """
+    Tests that the jobs on fewer activities than min_rows, and all the jobs without workers, run in threads.
+    """
+    arrays = random_arrays(100)
+    for pool in [AnalyticsPool(workers=0, min_rows=0), AnalyticsPool(workers=1)]:
+        try:
+            assert asyncio.run(pool.run(sleep_then_count, arrays, 0)) == 100
+        finally:
+            pool.shutdown()
+        assert (pool.get_stats()["offloaded"], pool.get_stats()["in_threads"]) == (0, 1)
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_job_timeout(workers):
+    """
+    Tests that a job not done within the timeout raises JobTimeout, in a worker process as in a thread.
+    """
+    pool = AnalyticsPool(workers=workers, timeout_seconds=0.2, min_rows=0)
+    try:
+        with pytest.raises(JobTimeout):
+            asyncio.run(pool.run(sleep_then_count, random_arrays(100), 5))
+    finally:
+        pool.shutdown()
+    assert (pool.get_stats()["timeouts"], pool.get_stats()["running"]) == (1, 0)
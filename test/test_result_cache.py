@@ -0,0 +1,87 @@
+import datetime
+
+from tools.result_cache import ResultCache, window_key
+
+DAY = datetime.timedelta(days=1)
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+
+
+def test_hits_and_misses():
+    """
+    Tests that a stored value is returned, and that hits and misses are counted.
+    """
+    cache = ResultCache()
+    assert cache.get(("a",)) is None
+    cache.put(("a",), "value", START, START + DAY, cache.version)
+    assert cache.get(("a",)) == "value"
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_memory_cap_evicts_least_recently_used():
+    """
+    Tests that the least recently used entries are evicted to stay within the memory cap, and that values larger than the cap are not stored.
+    """
+    value = "x" * 1000
+    cache = ResultCache(max_bytes=2500)
+    cache.put(("a",), value, START, None, cache.version)
+    cache.put(("b",), value, START, None, cache.version)
+    cache.get(("a",))
+    cache.put(("c",), value, START, None, cache.version)
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) == value
+    assert cache.get(("c",)) == value
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.n_bytes <= cache.max_bytes
+    cache.put(("d",), "x" * 3000, START, None, cache.version)
+    assert cache.get(("d",)) is None
+
+
+def test_expiry():
+    """
+    Tests that entries older than the time to live are not returned.
+    """
+    cache = ResultCache(ttl_seconds=0)
+    cache.put(("a",), "value", START, None, cache.version)
+    assert cache.get(("a",)) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_invalidate_overlapping_windows():
+    """
+    Tests that only the entries whose window contains the inserted times are dropped, with windows excluding their start and including their end.
+    """
+    cache = ResultCache()
+    cache.put(("january",), "1", START, START + 31 * DAY, cache.version)
+    cache.put(("february",), "2", START + 31 * DAY, START + 60 * DAY, cache.version)
+    cache.put(("since january",), "3", START, None, cache.version)
+    cache.invalidate(START + 31 * DAY, START + 31 * DAY)
+    assert cache.get(("january",)) is None
+    assert cache.get(("february",)) == "2"
+    assert cache.get(("since january",)) is None
+    assert cache.get_stats()["invalidations"] == 2
+
+
+def test_put_after_invalidation_is_ignored():
+    """
+    Tests that a value computed while activities were inserted is not stored, as it may miss them.
+    """
+    cache = ResultCache()
+    version = cache.version
+    cache.invalidate(START + DAY, START + DAY)
+    cache.put(("a",), "value", START, START + 2 * DAY, version)
+    assert cache.get(("a",)) is None
+
+
+def test_window_key():
+    """
+    Tests that equivalent time strings share a key, and that windows ending now are keyed by their length.
+    """
+    end = START + DAY
+    assert window_key(
+        "2020-01-01T00:00:00Z", "2020-01-02T00:00:00Z", START, end
+    ) == window_key(
+        "2020-01-01T00:00:00+00:00", "2020-01-02T00:00:00+00:00", START, end
+    )
+    assert window_key(None, None, START, end) == (DAY, None)
+    assert window_key(None, None, START + DAY, end + DAY) == (DAY, None)
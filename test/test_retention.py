@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tools.hot_window import to_microseconds
+from tools.retention import MAX_RETENTION_PERIODS, retention_cohorts
+
+
+def naive_retention(activities: pd.DataFrame, frequency: str) -> pd.DataFrame:
+    """
+    Helper function computing the retention table with plain pandas, as a reference for retention_cohorts.
+    """
+    grouped = activities.set_index("time").groupby(pd.Grouper(freq=frequency))
+    labels = grouped.size().index
+    buckets = pd.Series(grouped.ngroup().to_numpy(), index=activities.index)
+    cohorts = buckets.groupby(activities["user_id"]).transform("min")
+    pairs = pd.DataFrame(
+        {"user": activities["user_id"], "cohort": cohorts, "bucket": buckets}
+    ).drop_duplicates()
+    counts = (
+        pairs.groupby(["cohort", pairs["bucket"] - pairs["cohort"]])
+        .size()
+        .unstack(fill_value=0)
+        .reindex(columns=range(len(labels)), fill_value=0)
+    )
+    fractions = counts.div(counts[0], axis=0)
+    for cohort in fractions.index:
+        fractions.loc[cohort, len(labels) - cohort :] = np.nan
+    fractions.columns = fractions.columns.astype(str)
+    fractions.insert(0, "cohort_size", counts[0])
+    fractions.index = labels[counts.index].rename("cohort")
+    return fractions
+
+
+@pytest.mark.parametrize("frequency", ["D", "12h", "W", "MS", "2MS"])
+def test_retention_cohorts_random(frequency):
+    """
+    Tests that the vectorized retention matches a plain pandas computation, for frequencies with and without a NumPy labelling of the buckets.
+    """
+    rng = np.random.default_rng(21)
+    times = pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(
+        np.sort(rng.integers(0, 200 * 24 * 60 * 60, 5000)), unit="s"
+    )
+    activities = pd.DataFrame(
+        {"time": times, "user_id": rng.integers(0, 300, 5000).astype(np.int32)}
+    )
+    arrays = {
+        "time": times.as_unit("us").asi8,
+        "user_id": activities["user_id"].to_numpy(),
+    }
+    result = retention_cohorts(arrays, frequency)
+    pd.testing.assert_frame_equal(
+        result, naive_retention(activities, frequency), check_dtype=False
+    )
+
+
+def test_retention_cohorts_small():
+    """
+    Tests the retention of a few users, the unknown fractions of the last cohorts, and the empty and too long time periods.
+    """
+    day = 24 * 60 * 60 * 10**6
+    start = to_microseconds(pd.Timestamp("2020-04-20", tz="UTC"))
+    arrays = {
+        "time": start + np.array([0, day, day + 5, 3 * day]),
+        "user_id": np.array([1, 1, 2, 2], dtype=np.int32),
+    }
+    result = retention_cohorts(arrays, "D")
+    assert result.index.equals(
+        pd.DatetimeIndex(["2020-04-20", "2020-04-21"], tz="UTC", name="cohort")
+    )
+    assert result["cohort_size"].tolist() == [1, 1]
+    np.testing.assert_array_equal(
+        result[["0", "1", "2", "3"]].to_numpy(),
+        [[1.0, 1.0, 0.0, 0.0], [1.0, 0.0, 1.0, np.nan]],
+    )
+
+    empty = {"time": arrays["time"][:0], "user_id": arrays["user_id"][:0]}
+    assert retention_cohorts(empty, "D").empty
+
+    arrays["time"][-1] = start + MAX_RETENTION_PERIODS * day
+    with pytest.raises(ValueError):
+        retention_cohorts(arrays, "D")
@@ -0,0 +1,130 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tools.session_percentiles import (
+    DURATION_ACCURACY,
+    DURATION_BIN,
+    LOGIN_HOUR,
+    duration_bins_to_percentiles,
+    session_duration_percentiles,
+)
+
+START = datetime.datetime(2020, 3, 1, tzinfo=datetime.UTC)
+END = datetime.datetime(2020, 4, 1, tzinfo=datetime.UTC)
+
+
+@pytest.fixture
+def random_sessions(db_connection, create_test_tables):
+    """
+    Fixture filling the sessions table with 20000 sessions of random login times in March 2020, and log-normal durations, a few of them empty.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        cur.execute("SELECT setseed(0.23)")
+        cur.execute(
+            """
+            INSERT INTO sessions (user_id, login_time, logout_time, duration, n_clicks, purchased, timed_out)
+            SELECT g, login_time, login_time + duration, duration, 0, false, false
+            FROM (
+                SELECT g, %(start)s::timestamptz + random() * (%(end)s::timestamptz - %(start)s::timestamptz) AS login_time,
+                CASE WHEN random() < 0.05 THEN interval '0' ELSE make_interval(secs => exp(6 + 1.5 * sqrt(-2 * ln(random())) * cos(2 * pi() * random()))) END AS duration
+                FROM generate_series(1, 20000) g
+            ) generated
+            """,
+            {"start": START, "end": END},
+        )
+
+
+def exact_percentiles(cur, frequency: str) -> pd.DataFrame:
+    """
+    Helper function computing the percentiles of the stored session durations per time bucket of their login, from all the sessions.
+    """
+    cur.execute("SELECT login_time, extract(epoch FROM duration) FROM sessions")
+    sessions = pd.DataFrame(cur.fetchall(), columns=["time", "duration"])
+    sessions["time"] = pd.to_datetime(sessions["time"], utc=True)
+    grouped = sessions.set_index("time")["duration"].astype(float)
+    grouped = grouped.groupby(pd.Grouper(freq=frequency))
+    return pd.DataFrame(
+        {
+            f"p{p}": grouped.apply(
+                lambda x, p=p: np.percentile(x, p, method="inverted_cdf")
+            )
+            for p in [50, 90, 99]
+        }
+    ).assign(n_sessions=grouped.size())
+
+
+def assert_close_percentiles(result: pd.DataFrame, exact: pd.DataFrame):
+    """
+    Helper function checking that the estimated percentiles are within the relative accuracy of the exact ones.
+    """
+    assert result.index.equals(exact.index.rename("time"))
+    assert result["n_sessions"].tolist() == exact["n_sessions"].tolist()
+    for column in ["p50", "p90", "p99"]:
+        estimate = result[column].dt.total_seconds()
+        assert (
+            (estimate - exact[column]).abs() <= DURATION_ACCURACY * exact[column] + 1e-6
+        ).all()
+
+
+@pytest.mark.parametrize("frequency", ["D", "W", "MS", "6h"])
+def test_session_duration_percentiles(db_connection, random_sessions, frequency):
+    """
+    Tests that the percentiles merged from the hourly duration bins are within the relative accuracy of the exact ones.
+    """
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        result = session_duration_percentiles(cur, START, END, frequency)
+        assert_close_percentiles(result, exact_percentiles(cur, frequency))
+
+
+def test_duration_bins_follow_sessions(db_connection, random_sessions):
+    """
+    Tests that the duration bins are kept equal to the bins of the stored sessions when sessions are updated, upserted and deleted.
+    """
+    bins_query = "SELECT bucket, bin, count FROM session_durations_hourly WHERE count <> 0 ORDER BY 1, 2"
+    expected_query = f"SELECT {LOGIN_HOUR}, {DURATION_BIN}, count(*) FROM sessions GROUP BY 1, 2 ORDER BY 1, 2"
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        assert (
+            cur.execute(bins_query).fetchall() == cur.execute(expected_query).fetchall()
+        )
+        cur.execute("UPDATE sessions SET duration = duration * 3 WHERE user_id % 7 = 0")
+        cur.execute(
+            """
+            INSERT INTO sessions (user_id, login_time, logout_time, duration, n_clicks, purchased, timed_out)
+            SELECT user_id, login_time, logout_time, interval '1 hour', 0, false, false FROM sessions WHERE user_id % 5 = 0
+            ON CONFLICT (user_id, login_time) DO UPDATE SET duration = EXCLUDED.duration
+            """
+        )
+        cur.execute("DELETE FROM sessions WHERE user_id % 3 = 0")
+        assert (
+            cur.execute(bins_query).fetchall() == cur.execute(expected_query).fetchall()
+        )
+        result = session_duration_percentiles(cur, START, END, "D")
+        assert_close_percentiles(result, exact_percentiles(cur, "D"))
+
+
+def test_duration_bins_to_percentiles_small():
+    """
+    Tests the percentiles of a few sessions, the empty buckets between them, and an empty window.
+    """
+    hour = datetime.datetime(2020, 4, 23, 12, tzinfo=datetime.UTC)
+    # 10 sessions of about 100 seconds, 1 empty session, and 1 session of about 1000 seconds two hours later
+    rows = [
+        (hour, -32768, 1),
+        (hour, 231, 10),
+        (hour + datetime.timedelta(hours=2), 346, 1),
+    ]
+    result = duration_bins_to_percentiles(rows, "h")
+    assert result["n_sessions"].tolist() == [11, 0, 1]
+    p50 = result["p50"].dt.total_seconds()
+    assert abs(p50.iloc[0] - 100) <= 100 * DURATION_ACCURACY
+    assert np.isnan(p50.iloc[1])
+    assert abs(p50.iloc[2] - 1000) <= 1000 * DURATION_ACCURACY
+    assert result["p99"].iloc[0] == result["p50"].iloc[0]
+
+    empty = duration_bins_to_percentiles([], "h")
+    assert empty.empty
+    assert list(empty.columns) == ["n_sessions", "p50", "p90", "p99"]
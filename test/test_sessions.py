@@ -0,0 +1,248 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models import User, Activity
+from tools.db_operations import ACTIVITY_TYPES, insert_item, copy_items
+from tools.sessions import (
+    sessionize,
+    average_session_duration,
+    backfill_sessions,
+    close_sessions,
+    read_sessions,
+)
+from tools.tools import long_uuid4_generator
+
+
+def to_arrays(activities: list) -> dict:
+    """
+    Helper function converting a list of (minute, user_id, activity_type) tuples into the arrays taken by sessionize.
+    """
+    return {
+        "time": np.array(
+            [minute * 60_000_000 for minute, _, _ in activities], np.int64
+        ),
+        "user_id": np.array([user_id for _, user_id, _ in activities], np.int32),
+        "activity_type": np.array(
+            [ACTIVITY_TYPES.index(type_) for _, _, type_ in activities], np.int8
+        ),
+    }
+
+
+def reference_sessions(activities: list, timeout_minutes: int) -> list:
+    """
+    Helper function computing the sessions with a plain loop, as (user_id, login minute, end minute, n_clicks, purchased, timed_out) tuples.
+    """
+    tie_break = {"logout": 0, "login": 1, "click": 2, "purchase": 2}
+    activities = sorted(activities, key=lambda a: (a[1], a[0], tie_break[a[2]]))
+    sessions = []
+    current = None
+    for minute, user_id, type_ in activities:
+        if current is not None and (
+            user_id != current[0] or type_ == "login" or current[6]
+        ):
+            sessions.append(tuple(current[:6]))
+            current = None
+        if type_ == "login":
+            # user_id, login, end, n_clicks, purchased, timed_out, closed
+            current = [user_id, minute, minute, 0, False, True, False]
+            continue
+        if current is None or minute - current[2] > timeout_minutes:
+            if current is not None:
+                sessions.append(tuple(current[:6]))
+            current = None
+            continue
+        current[2] = minute
+        current[3] += type_ == "click"
+        current[4] |= type_ == "purchase"
+        if type_ == "logout":
+            current[5] = False
+            current[6] = True
+    if current is not None:
+        sessions.append(tuple(current[:6]))
+    return sorted(sessions)
+
+
+def session_tuples(sessions: pd.DataFrame) -> list:
+    """
+    Helper function converting the output of sessionize to the format of reference_sessions.
+    """
+    epoch = pd.Timestamp(0, tz="UTC")
+    return sorted(
+        (
+            row.user_id,
+            (row.login_time - epoch) // pd.Timedelta(minutes=1),
+            (row.logout_time - epoch) // pd.Timedelta(minutes=1),
+            row.n_clicks,
+            row.purchased,
+            row.timed_out,
+        )
+        for row in sessions.itertuples()
+    )
+
+
+def test_sessionize_interleaved_users():
+    """
+    Tests that the logins and logouts of different users are not mixed, and that missing logouts, inactivity and activities outside sessions are handled.
+    """
+    activities = [
+        (0, 1, "login"),
+        (1, 2, "login"),
+        (2, 1, "click"),
+        (3, 2, "click"),
+        (4, 2, "purchase"),
+        (5, 1, "logout"),
+        (6, 2, "logout"),
+        (7, 1, "click"),  # after the logout: not in a session
+        (10, 1, "login"),
+        (12, 1, "click"),
+        (100, 1, "click"),  # after 88 minutes of inactivity
+        (101, 1, "logout"),
+        (3, 3, "logout"),  # no login
+    ]
+    sessions = sessionize(to_arrays(activities), pd.Timedelta(minutes=30))
+    assert session_tuples(sessions) == [
+        (1, 0, 5, 1, False, False),
+        (1, 10, 12, 1, False, True),
+        (2, 1, 6, 1, True, False),
+    ]
+    assert sessions["duration"].sum() == pd.Timedelta(minutes=12)
+
+
+def test_sessionize_empty():
+    """
+    Tests that no activities give an empty session table, that can still be averaged.
+    """
+    sessions = sessionize(to_arrays([]))
+    assert len(sessions) == 0
+    assert str(sessions["login_time"].dtype) == "datetime64[ns, UTC]"
+    assert len(average_session_duration(sessions, "D")) == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sessionize_matches_reference(seed):
+    """
+    Tests the vectorized sessionization against a plain loop on random activities.
+    """
+    rng = np.random.default_rng(seed)
+    activities = list(
+        zip(
+            rng.integers(0, 2000, 500).tolist(),
+            rng.integers(1, 6, 500).tolist(),
+            rng.choice(ACTIVITY_TYPES, 500, p=[0.55, 0.15, 0.15, 0.15]).tolist(),
+        )
+    )
+    sessions = sessionize(to_arrays(activities), pd.Timedelta(minutes=45))
+    assert session_tuples(sessions) == reference_sessions(activities, 45)
+
+
+def test_average_session_duration():
+    """
+    Tests that the durations are averaged per time bucket of the login.
+    """
+    day = 24 * 60
+    activities = [
+        (0, 1, "login"),
+        (10, 1, "logout"),
+        (20, 2, "login"),
+        (50, 2, "logout"),
+        (day + 5, 1, "login"),
+        (day + 25, 1, "logout"),
+    ]
+    result = average_session_duration(sessionize(to_arrays(activities)), "D")
+    assert result["duration"].tolist() == [
+        pd.Timedelta(minutes=20),
+        pd.Timedelta(minutes=20),
+    ]
+    assert result["n_sessions"].tolist() == [2, 1]
+
+
+def random_activities(rng, user_ids: list, n: int) -> list:
+    """
+    Helper function generating n Activity objects of the given users, spread over the first week of 2020.
+    """
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+    return [
+        Activity(
+            activity_id=long_uuid4_generator(),
+            time=(start + datetime.timedelta(minutes=int(minute))).isoformat(),
+            user_id=int(user_id),
+            activity_type=activity_type,
+        )
+        for minute, user_id, activity_type in zip(
+            rng.integers(0, 7 * 24 * 60, n),
+            rng.choice(user_ids, n),
+            rng.choice(ACTIVITY_TYPES, n, p=[0.55, 0.15, 0.15, 0.15]),
+        )
+    ]
+
+
+def stored_sessions(cur) -> list:
+    """
+    Helper function reading the whole sessions table in the format of reference_sessions.
+    """
+    window = (
+        datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC),
+        datetime.datetime(2100, 1, 1, tzinfo=datetime.UTC),
+    )
+    return session_tuples(read_sessions(cur, *window))
+
+
+def test_sessions_maintained_at_logout(
+    db_connection, create_test_tables, mock_data_user, mock_data_user2
+):
+    """
+    Tests that the sessions written at each logout, and the ones rebuilt by the chunked backfill, are the same as the ones computed from all the activities.
+    """
+    rng = np.random.default_rng(7)
+    user_ids = [mock_data_user["user_id"], mock_data_user2["user_id"]]
+    activities = random_activities(rng, user_ids, 400)
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        insert_item(User(**mock_data_user2), "users", cur)
+        # activities arrive in time order, and each logout closes its sessions
+        for activity in sorted(activities, key=lambda a: a.time):
+            insert_item(activity, "activities", cur)
+            if activity.activity_type == "logout":
+                close_sessions(cur, activity.user_id, activity.time, activity.time)
+        incremental = stored_sessions(cur)
+
+        expected = [
+            (minute, user_id, type_)
+            for minute, user_id, type_ in zip(
+                (a.time.timestamp() // 60 for a in activities),
+                (a.user_id for a in activities),
+                (a.activity_type for a in activities),
+            )
+        ]
+        # the sessions table keeps one session per user and login time
+        reference = list({s[:2]: s for s in reference_sessions(expected, 30)}.values())
+        closed = [s for s in reference if not s[5]]
+        assert [s for s in incremental if not s[5]] == closed
+
+        n_sessions = backfill_sessions(conn, chunk_size=1)
+        backfilled = stored_sessions(cur)
+    assert n_sessions == len(backfilled)
+    assert backfilled == reference
+
+
+def test_close_sessions_batch(db_connection, create_test_tables, mock_data_user):
+    """
+    Tests that a batch of logouts, copied at once, closes all the sessions between the first and the last logout.
+    """
+    rng = np.random.default_rng(3)
+    activities = random_activities(rng, [mock_data_user["user_id"]], 200)
+    logout_times = [a.time for a in activities if a.activity_type == "logout"]
+    with db_connection.connection() as conn, conn.cursor() as cur:
+        cur.execute(create_test_tables)
+        insert_item(User(**mock_data_user), "users", cur)
+        copy_items(activities, "activities", cur)
+        close_sessions(
+            cur, mock_data_user["user_id"], min(logout_times), max(logout_times)
+        )
+        closed = [s for s in stored_sessions(cur) if not s[5]]
+        backfill_sessions(conn)
+        assert [s for s in stored_sessions(cur) if not s[5]] == closed
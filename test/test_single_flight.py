@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from tools.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    """
+    Tests that identical concurrent calls run the computation once and all get its result, while other keys run their own.
+    """
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name.upper()
+
+    async def main():
+        return await asyncio.gather(
+            *(single_flight.run(("a",), lambda: compute("a")) for _ in range(10)),
+            single_flight.run(("b",), lambda: compute("b")),
+        )
+
+    results = asyncio.run(main())
+    assert results == ["A"] * 10 + ["B"]
+    assert sorted(calls) == ["a", "b"]
+    assert single_flight.get_stats() == {"executions": 2, "saved": 9, "in_flight": 0}
+
+
+def test_sequential_calls_run_again():
+    """
+    Tests that nothing is kept once a computation is done.
+    """
+    single_flight = SingleFlight()
+
+    async def compute():
+        return 1
+
+    async def main():
+        await single_flight.run(("a",), compute)
+        await single_flight.run(("a",), compute)
+
+    asyncio.run(main())
+    assert single_flight.get_stats()["executions"] == 2
+
+
+def test_exception_is_shared():
+    """
+    Tests that the exception of a computation is raised to all the calls waiting for it.
+    """
+    single_flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def main():
+        return await asyncio.gather(
+            *(single_flight.run(("a",), compute) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.get_stats()["executions"] == 1
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    """
+    Tests that a caller going away does not cancel the computation shared with the others.
+    """
+    single_flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(single_flight.run(("a",), compute))
+        second = asyncio.ensure_future(single_flight.run(("a",), compute))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
@@ -1,8 +1,15 @@
+import datetime
+import uuid
+
 import pytest
 
 from tools.tools import (
     filter_time,
+    format_keyset_cursor,
+    parse_keyset_cursor,
+    resolve_time_window,
     polish_activity_types_list,
+    polish_funnel_steps,
     check_for_allowed_freq_string,
     validate_timestring,
     validate_time_entries,
@@ -28,6 +35,14 @@ def test_filter_time_period_end(mock_dataframe):
     assert len(df) == 2
 
 
+def test_resolve_time_window():
+    start, end = resolve_time_window(None, "2020-04-23T16:00:01Z", 1, 2)
+    assert end.isoformat() == "2020-04-23T16:00:01+00:00"
+    assert start.isoformat() == "2020-04-22T14:00:01+00:00"
+    start, end = resolve_time_window("2020-04-23T13:00:01Z", "2020-04-23T15:00:01Z")
+    assert (end - start).total_seconds() == 2 * 60 * 60
+
+
 def test_polish_activity_types_list():
     default = ["login", "logout", "click"]
     lists_to_test = [
@@ -69,6 +84,52 @@ def test_invalid_activity_types_list(list_to_test):
     polish_activity_types_list(list_to_test, default)
 
 
+def test_polish_funnel_steps():
+    default = ["login", "click", "purchase"]
+    assert polish_funnel_steps([None, None], default) == default
+    assert polish_funnel_steps(["login", None, "click", "click", None], default) == [
+        "login",
+        "click",
+        "click",
+    ]
+
+
+@pytest.mark.parametrize(
+    "list_to_test",
+    [
+        pytest.param(item, marks=pytest.mark.xfail)
+        for item in [["login", "Pippo"], ["login", None], ["Login", "click"]]
+    ],
+)
+def test_invalid_funnel_steps(list_to_test):
+    polish_funnel_steps(list_to_test, ["login", "click"])
+
+
+def test_keyset_cursor():
+    time = datetime.datetime(2020, 4, 23, 13, 0, 1, tzinfo=datetime.UTC)
+    activity_id = uuid.uuid4()
+    cursor = format_keyset_cursor(time, activity_id)
+    assert cursor == f"2020-04-23T13:00:01.000000Z,{activity_id}"
+    assert parse_keyset_cursor(cursor) == (time, activity_id)
+    other_timezone = time.astimezone(datetime.timezone(datetime.timedelta(hours=2)))
+    assert format_keyset_cursor(other_timezone, activity_id) == cursor
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        pytest.param(item, marks=pytest.mark.xfail)
+        for item in [
+            f"2020-04-23T13:00:01,{uuid.uuid4()}",
+            f"2020-04-23T13:00:01Z;{uuid.uuid4()}",
+            "2020-04-23T13:00:01Z,Pippo",
+        ]
+    ],
+)
+def test_invalid_keyset_cursor(cursor):
+    parse_keyset_cursor(cursor)
+
+
 def test_check_for_allowed_freq_string():
     strings_to_test = [
         "B",
@@ -162,7 +223,7 @@ def test_invalid_time_entries(input_list):
 
 
 def test_validate_time_bin():
-    strings = ["month", "day", "hour", "minute", "second"]
+    strings = ["year", "month", "day", "hour", "minute", "second"]
     for string in strings:
         assert validate_time_bin(string)
 
@@ -1,7 +1,8 @@
-import psycopg
+import asyncio
 import os
 import time
 from dotenv import dotenv_values
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
 
 env_path = ".env"
 if os.path.exists(env_path):
@@ -15,6 +16,20 @@ if os.path.exists(env_path):
     ]
     for env_variable in env_variables:
         os.environ[env_variable] = env_values.get(env_variable)
+    # optional settings, with defaults below
+    optional_env_variables = [
+        "POSTGRES_POOL_MIN_SIZE",
+        "POSTGRES_POOL_MAX_SIZE",
+        "POSTGRES_POOL_TIMEOUT",
+        "RESULT_CACHE_MAX_BYTES",
+        "RESULT_CACHE_TTL_SECONDS",
+        "HOT_WINDOW_DAYS",
+        "ANALYTICS_WORKERS",
+        "ANALYTICS_JOB_TIMEOUT_SECONDS",
+    ]
+    for env_variable in optional_env_variables:
+        if env_values.get(env_variable) is not None:
+            os.environ[env_variable] = env_values.get(env_variable)
 
 db_connection_config = {
     # "host": "localhost",  # os.getenv("POSTGRES_HOST"),
@@ -25,31 +40,57 @@ db_connection_config = {
     "password": os.getenv("POSTGRES_PASSWORD"),
 }
 
+db_pool_config = {
+    "min_size": int(os.getenv("POSTGRES_POOL_MIN_SIZE", 2)),
+    "max_size": int(os.getenv("POSTGRES_POOL_MAX_SIZE", 10)),
+    "timeout": float(os.getenv("POSTGRES_POOL_TIMEOUT", 30)),
+}
+
 
 class ConnectionManager:
     """
-    Class managing the database connection. On initiation, it takes connection details, and the connection is carried out using the connect method. Similarly, the connection is shut down with the disconnect() method.
+    Class managing a pool of database connections. On initiation, it takes connection details and the pool size, and the pool is opened using the connect method. Each request borrows a connection with the connection() context manager, and gives it back when done. The pool is shut down with the disconnect() method.
     """
 
-    def __init__(self, connection_config: dict):
+    def __init__(
+        self,
+        connection_config: dict,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+    ):
         """
         :param connection_config: dictionary. It should include the keys "host", "dbname", "user" and "password", and the relative values as strings.
+        :param min_size: int. Number of connections kept open, even when idle.
+        :param max_size: int. Maximum number of connections opened at the same time.
+        :param timeout: float. Maximum time in seconds to wait for a free connection, before a PoolTimeout is raised.
         """
         self.connection_config = connection_config
-        self.connection = None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pool = None
 
     def connect(self):
         """
-        Connects to the database using the provided connection parameters.
+        Opens the pool, and waits until min_size connections to the database are established.
         """
-        # At startup - start connection to the SQL server
+        # At startup - start connections to the SQL server
         for attempt in range(5):
+            self.pool = ConnectionPool(
+                kwargs={**self.connection_config, "autocommit": True},
+                min_size=self.min_size,
+                max_size=self.max_size,
+                timeout=self.timeout,
+                check=ConnectionPool.check_connection,
+                open=False,
+            )
             try:
-                self.connection = psycopg.connect(
-                    **self.connection_config, autocommit=True
-                )
-            except ConnectionError:
-                if attempt < 5:
+                self.pool.open(wait=True, timeout=self.timeout)
+                return
+            except PoolTimeout:
+                self.pool.close()
+                if attempt < 4:
                     print(f"attempt {attempt} failed. Retrying in 5 seconds.")
                     time.sleep(5)
                 else:
@@ -58,15 +99,108 @@ class ConnectionManager:
                     )
                     raise
 
+    def connection(self, timeout: float | None = None):
+        """
+        Context manager lending a connection of the pool. The connection is checked before being lent, and given back to the pool at the end of the block.
+        :param timeout: float (optional). Maximum time in seconds to wait for a free connection. Defaults to the timeout of the pool.
+        :return: context manager yielding a psycopg.Connection.
+        """
+        return self.pool.connection(timeout=timeout)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics of the pool (size, connections available, requests waiting, errors...) as a dictionary.
+        """
+        return self.pool.get_stats()
+
     def disconnect(self):
         """
-        disconnects from the database.
+        closes all the connections of the pool.
         """
-        self.connection.close()
+        self.pool.close()
+
+
+class AsyncConnectionManager:
+    """
+    Asynchronous version of ConnectionManager, managing a pool of psycopg AsyncConnections. It is used by the API, so that the endpoints await the database instead of blocking the event loop. The pool must be opened and closed in the event loop where it is used.
+    """
+
+    def __init__(
+        self,
+        connection_config: dict,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+    ):
+        """
+        :param connection_config: dictionary. It should include the keys "host", "dbname", "user" and "password", and the relative values as strings.
+        :param min_size: int. Number of connections kept open, even when idle.
+        :param max_size: int. Maximum number of connections opened at the same time.
+        :param timeout: float. Maximum time in seconds to wait for a free connection, before a PoolTimeout is raised.
+        """
+        self.connection_config = connection_config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pool = None
+
+    async def connect(self):
+        """
+        Opens the pool, and waits until min_size connections to the database are established.
+        """
+        for attempt in range(5):
+            self.pool = AsyncConnectionPool(
+                kwargs={**self.connection_config, "autocommit": True},
+                min_size=self.min_size,
+                max_size=self.max_size,
+                timeout=self.timeout,
+                check=AsyncConnectionPool.check_connection,
+                open=False,
+            )
+            try:
+                await self.pool.open(wait=True, timeout=self.timeout)
+                return
+            except PoolTimeout:
+                await self.pool.close()
+                if attempt < 4:
+                    print(f"attempt {attempt} failed. Retrying in 5 seconds.")
+                    await asyncio.sleep(5)
+                else:
+                    print(
+                        "Max number of attempts tried. Connection to the database could not be established."
+                    )
+                    raise
+
+    def connection(self, timeout: float | None = None):
+        """
+        Asynchronous context manager lending a connection of the pool. The connection is checked before being lent, and given back to the pool at the end of the block.
+        :param timeout: float (optional). Maximum time in seconds to wait for a free connection. Defaults to the timeout of the pool.
+        :return: asynchronous context manager yielding a psycopg.AsyncConnection.
+        """
+        return self.pool.connection(timeout=timeout)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics of the pool (size, connections available, requests waiting, errors...) as a dictionary.
+        """
+        return self.pool.get_stats()
+
+    async def disconnect(self):
+        """
+        closes all the connections of the pool.
+        """
+        await self.pool.close()
 
 
 def get_db():
-    """Helper function that instantiates the ConnectionManager class, and connects to the database. If db_connection_config is not redefined, it uses the values defined on top of this script."""
-    connection_manager = ConnectionManager(db_connection_config)
+    """Helper function that instantiates the ConnectionManager class, and connects to the database. If db_connection_config and db_pool_config are not redefined, it uses the values defined on top of this script."""
+    connection_manager = ConnectionManager(db_connection_config, **db_pool_config)
     connection_manager.connect()
     return connection_manager
+
+
+async def get_async_db():
+    """Asynchronous version of get_db, returning a connected AsyncConnectionManager."""
+    connection_manager = AsyncConnectionManager(db_connection_config, **db_pool_config)
+    await connection_manager.connect()
+    return connection_manager
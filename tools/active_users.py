@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from tools.aggregation import bucket_labels, fill_buckets
+from tools.rollup import HOUR_BUCKET, create_hour_range_filter
+
+# Each hourly sketch has 2**HLL_PRECISION one-byte registers, for a relative standard error of 1.04 / sqrt(2**HLL_PRECISION) (2.3%) on the distinct counts
+HLL_PRECISION = 11
+HLL_REGISTERS = 2**HLL_PRECISION
+HLL_RELATIVE_ERROR = 1.04 / np.sqrt(HLL_REGISTERS)
+# z-score of the error bounds reported with the counts (95% confidence)
+HLL_CONFIDENCE_Z = 1.96
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+# 2**-rank for every possible register value
+HLL_POWERS = 2.0 ** -np.arange(64 - HLL_PRECISION + 2)
+
+# (hour, register, rank) of the users of a table of activities: the 64-bit hash of the user_id picks the register with its low bits, and the rank is the position of the lowest set bit among the others
+HLL_RANKS = f"""SELECT bucket, hash & {HLL_REGISTERS - 1} AS register,
+                    max(coalesce(nullif(position('1' IN reverse((hash >> {HLL_PRECISION})::bit({64 - HLL_PRECISION})::text)), 0), {64 - HLL_PRECISION + 1})) AS rank
+                    FROM (
+                        SELECT {HOUR_BUCKET} AS bucket, hashint8extended(user_id::bigint, 0) AS hash
+                        FROM {{activities}}
+                        WHERE time IS NOT NULL AND user_id IS NOT NULL
+                    ) hashed
+                    GROUP BY 1, 2"""
+
+# Statements adding the users of a table of activities to the hourly sketches: the missing sketches are created empty, then their registers are raised where needed, each sketch being written once
+SKETCH_CREATE = f"""INSERT INTO active_users_hourly (bucket, sketch)
+                SELECT DISTINCT bucket, decode(repeat('00', {HLL_REGISTERS}), 'hex')
+                FROM ({HLL_RANKS}) ranks
+                ORDER BY bucket
+                ON CONFLICT (bucket) DO NOTHING;"""
+SKETCH_UPDATE = f"""UPDATE active_users_hourly
+                SET sketch = hll_add(active_users_hourly.sketch, added.registers, added.ranks)
+                FROM (
+                    SELECT bucket, array_agg(register::int) AS registers, array_agg(rank) AS ranks
+                    FROM ({HLL_RANKS}) ranks
+                    GROUP BY bucket
+                ) added
+                WHERE active_users_hourly.bucket = added.bucket;"""
+
+ACTIVE_USERS_QUERY = """
+                SELECT bucket, sketch FROM active_users_hourly
+                WHERE bucket > %(start_time)s::timestamptz - interval '1 hour' AND bucket <= %(end_time)s
+                ORDER BY bucket
+                """
+
+
+def sketches_to_active_users(rows: list, frequency: str) -> pd.DataFrame:
+    """
+    Function estimating the number of distinct active users per time bucket, by merging the hourly HyperLogLog sketches of each bucket (taking the maximum of each register), and applying the HyperLogLog estimator, with linear counting for the small counts.
+    :param rows: list of (hour, sketch) tuples, in order of time, as returned by ACTIVE_USERS_QUERY.
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: DataFrame indexed by time bucket, with the estimated number of active users ("active_users") and the bounds of its 95% confidence interval ("active_users_low" and "active_users_high").
+    """
+    columns = ["active_users", "active_users_low", "active_users_high"]
+    if not rows:
+        return pd.DataFrame(
+            columns=columns,
+            index=pd.DatetimeIndex([], tz="UTC", name="time"),
+            dtype="int64",
+        )
+    hours = pd.DatetimeIndex(pd.to_datetime([row[0] for row in rows], utc=True))
+    sketches = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.uint8)
+    sketches = sketches.reshape(len(rows), HLL_REGISTERS)
+
+    # merge the sketches of the hours of each bucket
+    labels = bucket_labels(hours.asi8 // 1000, frequency)
+    starts = np.flatnonzero(np.diff(labels, prepend=labels[0] - 1))
+    merged = np.maximum.reduceat(sketches, starts, axis=0)
+
+    raw = HLL_ALPHA * HLL_REGISTERS**2 / HLL_POWERS[merged].sum(axis=1)
+    zeros = (merged == 0).sum(axis=1)
+    linear = HLL_REGISTERS * np.log(HLL_REGISTERS / np.maximum(zeros, 1))
+    estimate = np.where((raw <= 2.5 * HLL_REGISTERS) & (zeros > 0), linear, raw)
+    margin = HLL_CONFIDENCE_Z * HLL_RELATIVE_ERROR * estimate
+
+    index = pd.DatetimeIndex(
+        pd.to_datetime(labels[starts], unit="us", utc=True), name="time"
+    )
+    counts = pd.DataFrame(
+        {
+            "active_users": np.round(estimate),
+            "active_users_low": np.floor(np.maximum(estimate - margin, 0)),
+            "active_users_high": np.ceil(estimate + margin),
+        },
+        index=index,
+    )
+    return fill_buckets(counts, frequency)
+
+
+def active_users_over_time(
+    cur: psycopg.Cursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Function estimating the number of distinct active users per time bucket from the hourly sketches of active_users_hourly, for the whole hours overlapping the window start_time < time <= end_time.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: DataFrame, as returned by sketches_to_active_users.
+    """
+    params = {"start_time": start_time, "end_time": end_time}
+    rows = cur.execute(ACTIVE_USERS_QUERY, params, binary=True).fetchall()
+    return sketches_to_active_users(rows, frequency)
+
+
+async def active_users_over_time_async(
+    cur: psycopg.AsyncCursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Asynchronous version of active_users_over_time. The database is awaited, and the sketches are merged in a worker thread.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: DataFrame, as returned by sketches_to_active_users.
+    """
+    params = {"start_time": start_time, "end_time": end_time}
+    await cur.execute(ACTIVE_USERS_QUERY, params, binary=True)
+    rows = await cur.fetchall()
+    return await asyncio.to_thread(sketches_to_active_users, rows, frequency)
+
+
+def rebuild_active_users(
+    conn: psycopg.Connection,
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> int:
+    """
+    Function rebuilding the hourly sketches of active_users_hourly from the raw activities, e.g. to backfill historical data, or after activities were deleted, which the sketches cannot forget on their own. Writes to activities wait until the rebuild is committed.
+    :param conn: the psycopg connection to the database.
+    :param start_time: datetime (optional). If None, the rebuild starts from the first activity.
+    :param end_time: datetime (optional). If None, the rebuild goes up to the last activity.
+    :return: the number of hourly sketches written.
+    """
+    where, params = create_hour_range_filter(start_time, end_time)
+    activities = f"(SELECT time, user_id FROM activities WHERE {where.format(column='time')}) AS activities"
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("LOCK TABLE activities IN SHARE MODE")
+        cur.execute(
+            f"DELETE FROM active_users_hourly WHERE {where.format(column='bucket')}",
+            params,
+        )
+        cur.execute(SKETCH_CREATE.format(activities=activities), params)
+        cur.execute(SKETCH_UPDATE.format(activities=activities), params)
+        cur.execute(
+            f"SELECT count(*) FROM active_users_hourly WHERE {where.format(column='bucket')}",
+            params,
+        )
+        return cur.fetchone()[0]
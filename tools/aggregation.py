@@ -0,0 +1,425 @@
+import asyncio
+import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg
+from pandas.tseries import offsets
+from pandas.tseries.frequencies import to_offset
+
+from tools.db_operations import (
+    ACTIVITY_TYPES,
+    sql_to_arrays,
+    sql_to_arrays_async,
+    arrays_to_dataframe,
+    create_activities_filter,
+)
+
+HOUR_NANOS = 60 * 60 * 10**9
+MINUTE_MICROS = 60 * 10**6
+HOUR_MICROS = 60 * MINUTE_MICROS
+DAY_MICROS = 24 * HOUR_MICROS
+
+# Calendar frequencies that Postgres can bin on its own, keyed by pandas rule code, as SQL expressions on a UTC timestamp "{ts}". Bins and labels follow the pd.Grouper conventions for the same frequency.
+CALENDAR_BUCKETS = {
+    "MS": "date_trunc('month', {ts})",
+    "QS-JAN": "date_trunc('quarter', {ts})",
+    "YS-JAN": "date_trunc('year', {ts})",
+    "ME": "date_trunc('month', {ts}) + interval '1 month' - interval '1 day'",
+    "QE-DEC": "date_trunc('quarter', {ts}) + interval '3 months' - interval '1 day'",
+    "YE-DEC": "date_trunc('year', {ts}) + interval '1 year' - interval '1 day'",
+    "W-SUN": "date_trunc('week', {ts}) + interval '6 days'",
+}
+
+
+def sql_bucket_expression(
+    frequency: str, column: str = "time", origin: str = ""
+) -> str | None:
+    """
+    Function translating a pandas offset alias into the SQL expression labelling each row with its time bucket. Fixed frequencies (e.g. "h", "D", "1h30min") are binned with date_bin, calendar frequencies with date_trunc. All arithmetic is carried out in UTC, independently of the session time zone.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param column: string. The timestamptz column to bin.
+    :param origin: string. SQL expression for the first day of the data, as a UTC timestamp without time zone. Only used by fixed frequencies, which pandas anchors at midnight of the first day.
+    :return: the SQL expression, with the placeholder %(bucket_stride)s for fixed frequencies, or None if Postgres cannot reproduce the pandas bins for this alias.
+    """
+    offset = to_offset(frequency)
+    ts = f"({column} AT TIME ZONE 'UTC')"
+    if isinstance(offset, offsets.Tick):
+        if offset.nanos <= 0 or offset.nanos % 1000:
+            return None
+        expression = f"date_bin(%(bucket_stride)s, {ts}, {origin})"
+    elif offset.n == 1 and offset.rule_code in CALENDAR_BUCKETS:
+        expression = CALENDAR_BUCKETS[offset.rule_code].format(ts=ts)
+    else:
+        return None
+    return f"({expression}) AT TIME ZONE 'UTC'"
+
+
+def create_bucket_count_query(
+    frequency: str, where: str, params: dict
+) -> tuple[str, dict] | None:
+    """
+    Helper function that generates an SQL query counting the activities per time bucket and activity type, so that only one row per bucket and type is returned by the database.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param where: string. Condition selecting the activities to count, as generated by create_activities_filter.
+    :param params: dictionary. The parameters of the condition.
+    :return: tuple with the SQL query and its parameters, or None if the frequency cannot be expressed in SQL.
+    """
+    origin = f"(SELECT date_trunc('day', min(time AT TIME ZONE 'UTC')) FROM activities WHERE {where})"
+    bucket = sql_bucket_expression(frequency, "time", origin)
+    if bucket is None:
+        return None
+    query = f"""
+                    SELECT {bucket} AS bucket, activity_type, count(*)
+                    FROM activities
+                    WHERE {where}
+                    GROUP BY bucket, activity_type
+                    """
+    offset = to_offset(frequency)
+    if isinstance(offset, offsets.Tick):
+        params = {**params, "bucket_stride": pd.Timedelta(offset).to_pytimedelta()}
+    return query, params
+
+
+def uses_hourly_rollup(frequency: str) -> bool:
+    """
+    Function checking if the activities can be counted from the hourly rollup for a frequency, i.e. if every bucket of the frequency is made of whole UTC hours.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: True if the rollup can be used.
+    """
+    if sql_bucket_expression(frequency) is None:
+        return False
+    offset = to_offset(frequency)
+    if isinstance(offset, offsets.Tick):
+        return offset.nanos % HOUR_NANOS == 0
+    return True
+
+
+def create_rollup_count_query(
+    frequency: str, where: str, params: dict
+) -> tuple[str, dict]:
+    """
+    Helper function that generates an SQL query counting the activities per time bucket and activity type, like create_bucket_count_query, but reading the whole hours of the window from the hourly rollup. Only the activities in the partial hours at the edges of the window are read from the activities table.
+    :param frequency: string. Offset alias, for which uses_hourly_rollup is True.
+    :param where: string. Condition selecting the activities to count, as generated by create_activities_filter.
+    :param params: dictionary. The parameters of the condition, with at least start_time and end_time.
+    :return: tuple with the SQL query and its parameters.
+    """
+    # the whole hours in the window start_time < time <= end_time are lo <= time < hi
+    lo = "(SELECT (date_trunc('hour', %(start_time)s::timestamptz AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') + interval '1 hour')"
+    hi = f"(SELECT greatest({lo}, date_trunc('hour', %(end_time)s::timestamptz AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'))"
+    rollup_where = f"bucket >= {lo} AND bucket < {hi} AND count > 0"
+    if "activity_types" in params:
+        rollup_where += " AND activity_type = ANY(%(activity_types)s)"
+    origin = "(SELECT date_trunc('day', min(time AT TIME ZONE 'UTC')) FROM source)"
+    bucket = sql_bucket_expression(frequency, "time", origin)
+    query = f"""
+                    WITH source AS (
+                        SELECT bucket AS time, activity_type, count
+                        FROM activity_counts_hourly
+                        WHERE {rollup_where}
+                        UNION ALL
+                        SELECT time, activity_type, 1
+                        FROM activities
+                        WHERE {where} AND time < {lo}
+                        UNION ALL
+                        SELECT time, activity_type, 1
+                        FROM activities
+                        WHERE {where} AND time >= {hi}
+                    )
+                    SELECT {bucket} AS bucket, activity_type, sum(count)::bigint
+                    FROM source
+                    GROUP BY bucket, activity_type
+                    """
+    offset = to_offset(frequency)
+    if isinstance(offset, offsets.Tick):
+        params = {**params, "bucket_stride": pd.Timedelta(offset).to_pytimedelta()}
+    return query, params
+
+
+def create_activity_count_query(
+    frequency: str, where: str, params: dict
+) -> tuple[str, dict] | None:
+    """
+    Helper function choosing the fastest SQL query counting the activities per time bucket and activity type: from the hourly rollup when possible, otherwise from the activities table.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param where: string. Condition selecting the activities to count, as generated by create_activities_filter.
+    :param params: dictionary. The parameters of the condition.
+    :return: tuple with the SQL query and its parameters, or None if the frequency cannot be expressed in SQL.
+    """
+    if uses_hourly_rollup(frequency):
+        return create_rollup_count_query(frequency, where, params)
+    return create_bucket_count_query(frequency, where, params)
+
+
+def fill_buckets(counts: pd.DataFrame, frequency: str) -> pd.DataFrame:
+    """
+    Helper function adding the empty time buckets between the first and the last one, as pd.Grouper does, and casting the counts to integers.
+    :param counts: DataFrame of counts, indexed by time bucket, one column per activity type.
+    :param frequency: string. Offset alias used for the buckets.
+    :return: the DataFrame with one row per bucket.
+    """
+    if len(counts):
+        buckets = pd.date_range(
+            counts.index.min(), counts.index.max(), freq=frequency, name="time"
+        )
+        counts = counts.reindex(buckets, fill_value=0)
+    return counts.astype("int64")
+
+
+def bucket_counts_to_dataframe(rows: list, frequency: str) -> pd.DataFrame:
+    """
+    Function building the activity count table from the rows returned by the query of create_bucket_count_query.
+    :param rows: list of (bucket, activity_type, count) tuples.
+    :param frequency: string. Offset alias used for the buckets.
+    :return: DataFrame indexed by time bucket, with one column of counts per activity type.
+    """
+    df = pd.DataFrame(rows, columns=["time", "activity_type", "count"])
+    df["time"] = pd.to_datetime(df["time"], utc=True)
+    counts = df.pivot(index="time", columns="activity_type", values="count")
+    return fill_buckets(counts.fillna(0), frequency)
+
+
+def count_activities_per_bucket(df: pd.DataFrame, frequency: str) -> pd.DataFrame:
+    """
+    Function counting the activities per time bucket and activity type with pandas. Fallback for the frequencies that create_bucket_count_query cannot express.
+    :param df: DataFrame of activities, with at least the columns "time" and "activity_type".
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by time bucket, with one column of counts per activity type.
+    """
+    subset = (
+        df.groupby(["time", "activity_type"], observed=True)
+        .size()
+        .reset_index(name="count")
+    )
+    # plain column labels, as in bucket_counts_to_dataframe
+    subset["activity_type"] = subset["activity_type"].astype(str)
+    subset = subset.pivot(index="time", columns="activity_type", values="count").fillna(
+        0
+    )
+    subset = subset.groupby(pd.Grouper(freq=frequency)).sum()
+    return subset.astype("int64")
+
+
+def activity_counts_over_time(
+    cur: psycopg.Cursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    activity_types: list,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Function counting the activities of the given types per time bucket, in the window start_time < time <= end_time. The counting is done by the database whenever the frequency can be expressed in SQL (from the hourly rollup, if the frequency is made of whole hours), otherwise the activities are extracted and counted with pandas. All ways return the same table.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param activity_types: list of strings. The activity types to count.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by time bucket, with one column of counts per activity type.
+    """
+    where, params = create_activities_filter(start_time, end_time, activity_types)
+    query = create_activity_count_query(frequency, where, params)
+    if query is not None:
+        rows = cur.execute(*query).fetchall()
+        return bucket_counts_to_dataframe(rows, frequency)
+    arrays = sql_to_arrays("activities", cur, ["time", "activity_type"], where, params)
+    return count_activities_per_bucket(arrays_to_dataframe(arrays), frequency)
+
+
+async def activity_counts_over_time_async(
+    cur: psycopg.AsyncCursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    activity_types: list,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Asynchronous version of activity_counts_over_time. The database is awaited, and the pandas work is done in a worker thread.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param activity_types: list of strings. The activity types to count.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by time bucket, with one column of counts per activity type.
+    """
+    where, params = create_activities_filter(start_time, end_time, activity_types)
+    query = create_activity_count_query(frequency, where, params)
+    if query is not None:
+        await cur.execute(*query)
+        rows = await cur.fetchall()
+        return await asyncio.to_thread(bucket_counts_to_dataframe, rows, frequency)
+    arrays = await sql_to_arrays_async(
+        "activities", cur, ["time", "activity_type"], where, params
+    )
+    df = await asyncio.to_thread(arrays_to_dataframe, arrays)
+    return await asyncio.to_thread(count_activities_per_bucket, df, frequency)
+
+
+def bucket_labels(
+    times: np.ndarray, frequency: str, first_time: int | None = None
+) -> np.ndarray | None:
+    """
+    Function labelling each time with its time bucket, with the same bins and labels as sql_bucket_expression. The arithmetic is vectorized with NumPy.
+    :param times: array of microseconds since the epoch, in UTC.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param first_time: int (optional). Time of the first activity counted, in microseconds since the epoch, whose day anchors the fixed frequencies. Defaults to the earliest of times.
+    :return: array of the bucket labels, in microseconds since the epoch, or None if the frequency is not supported.
+    """
+    offset = to_offset(frequency)
+    if isinstance(offset, offsets.Tick):
+        if offset.nanos <= 0 or offset.nanos % 1000:
+            return None
+        if not len(times):
+            return times
+        if first_time is None:
+            first_time = times.min()
+        # anchored at midnight of the first day, as pandas does
+        stride = offset.nanos // 1000
+        origin = first_time // DAY_MICROS * DAY_MICROS
+        return origin + (times - origin) // stride * stride
+    if offset.n != 1 or offset.rule_code not in CALENDAR_BUCKETS:
+        return None
+    code = offset.rule_code
+    if code == "W-SUN":
+        days = times // DAY_MICROS
+        # 1970-01-01 was a thursday: the monday starting the week is 3 days before
+        return (days - (days + 3) % 7 + 6) * DAY_MICROS
+    months = times.astype("datetime64[us]").astype("datetime64[M]").astype(np.int64)
+    if code.startswith("Q"):
+        months -= months % 3
+    elif code.startswith("Y"):
+        months -= months % 12
+    if code.split("-")[0].endswith("E"):
+        # end of the period: the first day of the next one, minus a day
+        months += {"M": 1, "Q": 3, "Y": 12}[code[0]]
+        labels = months.astype("datetime64[M]").astype(
+            "datetime64[D]"
+        ) - np.timedelta64(1, "D")
+    else:
+        labels = months.astype("datetime64[M]").astype("datetime64[D]")
+    return labels.astype("datetime64[us]").astype(np.int64)
+
+
+def activity_type_mask(codes: np.ndarray, activity_types: list) -> np.ndarray:
+    """
+    Helper function selecting the activities of the given types, with a lookup table indexed by code, which is faster than np.isin.
+    :param codes: array of the activity type codes (position in ACTIVITY_TYPES, -1 if unknown).
+    :param activity_types: list of strings. The activity types to select.
+    :return: boolean array, True for the activities of the given types.
+    """
+    selected = np.zeros(len(ACTIVITY_TYPES) + 1, dtype=bool)
+    selected[[ACTIVITY_TYPES.index(name) + 1 for name in activity_types]] = True
+    return selected[codes.astype(np.intp) + 1]
+
+
+def count_codes(keys: np.ndarray, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper function counting the activities per key (e.g. time bucket) and activity type code, with a single np.bincount. Sorted keys, such as the buckets of activities sorted by time, are grouped in one pass instead of being sorted again.
+    :param keys: array of keys, one per activity.
+    :param codes: array of the activity type codes (position in ACTIVITY_TYPES, -1 if unknown), one per activity.
+    :return: tuple with the sorted unique keys, and the matrix of counts, one row per key and one column per code, starting from -1.
+    """
+    if len(keys) and np.all(keys[1:] >= keys[:-1]):
+        new_key = np.empty(len(keys), dtype=bool)
+        new_key[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=new_key[1:])
+        unique_keys = keys[new_key]
+        inverse = np.cumsum(new_key) - 1
+    else:
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+    n_codes = len(ACTIVITY_TYPES) + 1
+    counts = np.bincount(
+        inverse.ravel() * n_codes + codes + 1, minlength=len(unique_keys) * n_codes
+    )
+    return unique_keys, counts.reshape(len(unique_keys), n_codes)
+
+
+def select_counts(
+    index: np.ndarray, counts: np.ndarray, activity_types: list
+) -> tuple[np.ndarray, np.ndarray, pd.Index]:
+    """
+    Helper function keeping the counts of the given activity types from the matrix of count_codes. Only the rows and the columns with some activities are kept, the columns in alphabetical order, as a pivot does.
+    :param index: array of the keys, as returned by count_codes.
+    :param counts: matrix of counts, as returned by count_codes.
+    :param activity_types: list of strings. The activity types counted.
+    :return: tuple with the kept keys, the matrix of counts (one row per kept key), and the names of its columns.
+    """
+    names = sorted(activity_types)
+    counts = counts[:, [ACTIVITY_TYPES.index(name) + 1 for name in names]]
+    rows = counts.any(axis=1)
+    columns = counts.any(axis=0)
+    counts = counts[rows][:, columns].astype("int64")
+    names = [name for name, kept in zip(names, columns) if kept]
+    return index[rows], counts, pd.Index(names, name="activity_type")
+
+
+def count_arrays_per_bucket(
+    arrays: dict, activity_types: list, frequency: str
+) -> pd.DataFrame:
+    """
+    Function counting the activities of the given types per time bucket from arrays of activities, e.g. held in memory by HotWindowStore. It returns the same table as activity_counts_over_time.
+    :param arrays: dictionary of arrays, as returned by sql_to_arrays, with at least the columns "time" and "activity_type".
+    :param activity_types: list of strings. The activity types to count.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by time bucket, with one column of counts per activity type.
+    """
+    times, codes = arrays["time"], arrays["activity_type"]
+    mask = activity_type_mask(codes, activity_types)
+    if not mask.any():
+        return bucket_counts_to_dataframe([], frequency)
+    first_time = np.min(times, where=mask, initial=np.iinfo(np.int64).max)
+    labels = bucket_labels(times, frequency, first_time)
+    if labels is None:
+        df = arrays_to_dataframe({"time": times[mask], "activity_type": codes[mask]})
+        return count_activities_per_bucket(df, frequency)
+    buckets, counts, columns = select_counts(
+        *count_codes(labels, codes), activity_types
+    )
+    index = pd.DatetimeIndex(pd.to_datetime(buckets, unit="us", utc=True), name="time")
+    return fill_buckets(pd.DataFrame(counts, index=index, columns=columns), frequency)
+
+
+def time_bin_values(times: np.ndarray, time_bin: str) -> np.ndarray:
+    """
+    Helper function extracting a calendar field from times, like the pandas .dt accessor.
+    :param times: array of microseconds since the epoch, in UTC.
+    :param time_bin: string. The field: "second", "minute", "hour", "day", "month" or "year", as accepted by tools.tools.validate_time_bin.
+    :return: array of the values of the field, as int32.
+    """
+    if time_bin == "second":
+        values = times // 10**6 % 60
+    elif time_bin == "minute":
+        values = times // MINUTE_MICROS % 60
+    elif time_bin == "hour":
+        values = times // HOUR_MICROS % 24
+    elif time_bin in ("day", "month", "year"):
+        days = times // DAY_MICROS
+        months = days.astype("datetime64[D]").astype("datetime64[M]")
+        if time_bin == "day":
+            values = days - months.astype("datetime64[D]").astype(np.int64) + 1
+        elif time_bin == "month":
+            values = months.astype(np.int64) % 12 + 1
+        else:
+            values = months.astype(np.int64) // 12 + 1970
+    else:
+        raise ValueError(f"Unknown time bin: {time_bin}.")
+    return values.astype(np.int32)
+
+
+def count_arrays_per_time_bin(
+    arrays: dict, activity_types: list, time_bin: str
+) -> pd.DataFrame:
+    """
+    Function counting the activities of the given types per value of a calendar field of their time (e.g. per hour of the day, all days together).
+    :param arrays: dictionary of arrays, as returned by sql_to_arrays, with at least the columns "time" and "activity_type".
+    :param activity_types: list of strings. The activity types to count.
+    :param time_bin: string. The field: "second", "minute", "hour", "day", "month" or "year", as accepted by tools.tools.validate_time_bin.
+    :return: DataFrame indexed by the values of the field, with one column of counts per activity type.
+    """
+    values, counts, columns = select_counts(
+        *count_codes(
+            time_bin_values(arrays["time"], time_bin), arrays["activity_type"]
+        ),
+        activity_types,
+    )
+    return pd.DataFrame(counts, index=pd.Index(values, name=time_bin), columns=columns)
@@ -1,21 +1,52 @@
+import asyncio
+
+import numpy as np
 import psycopg
 from pydantic import BaseModel
 import pandas as pd
 
+from src.models import ActivityTypes
+
+ACTIVITY_TYPES = [activity.value for activity in ActivityTypes]
+
+# dtype of the activity types in the DataFrames of arrays_to_dataframe
+ACTIVITY_TYPE_DTYPE = pd.CategoricalDtype(ACTIVITY_TYPES)
+
+# Columns that sql_to_arrays can export, as (SQL expression, big-endian dtype of its binary COPY representation). activity_type is exported as its position in ACTIVITY_TYPES, -1 if unknown.
+ARRAY_COLUMNS = {
+    "time": ("time", ">i8"),
+    "user_id": ("user_id", ">i4"),
+    "activity_type": (
+        f"(coalesce(array_position(ARRAY{ACTIVITY_TYPES}::text[], activity_type), 0) - 1)::int2",
+        ">i2",
+    ),
+}
+
+# Postgres stores timestamps as microseconds since 2000-01-01 UTC
+POSTGRES_EPOCH_US = 946684800 * 1000000
+BINARY_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
 
-def create_insert_query(obj: BaseModel, table: str) -> str:
+
+def create_insert_query(
+    obj: BaseModel, table: str, conflict_key: str | None = None
+) -> str:
     """
     helper function that generates an SQL query in order to add a row to an SQL table.
     :param obj: the Pydantic model from which to generate a database row. In this API, it can be a User or Activity object.
     :param table: string. The name of the table where to add the row. In this API, it could be either "users" or "activities".
+    :param conflict_key: string (optional). A column with a UNIQUE constraint. If given, the row is silently skipped when its value is already present in the table.
     :return: the SQL query.
     """
     obj_keys = [key for key, _ in obj.__dict__.items()]
     col_string = ", ".join(obj_keys)
     val_string = "%(" + ")s, %(".join(obj_keys) + ")s"
+    conflict_string = ""
+    if conflict_key is not None:
+        conflict_string = f"ON CONFLICT ({conflict_key}) DO NOTHING"
     query = f"""
                     INSERT INTO {table}({col_string})
-                    VALUES ({val_string});
+                    VALUES ({val_string})
+                    {conflict_string};
                     """
     return query
 
@@ -32,6 +63,96 @@ def insert_item(obj: BaseModel, table: str, cur: psycopg.Cursor) -> None:
     return None
 
 
+async def insert_item_async(
+    obj: BaseModel, table: str, cur: psycopg.AsyncCursor
+) -> None:
+    """
+    Asynchronous version of insert_item.
+    :param obj: the Pydantic model from which to generate a database row. In this API, it can be a User or Activity object.
+    :param table: string. The name of the table where to add the row. In this API, it could be either "users" or "activities".
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    """
+    query = create_insert_query(obj, table)
+    await cur.execute(query, obj.__dict__)
+    return None
+
+
+def insert_item_if_absent(
+    obj: BaseModel, table: str, conflict_key: str, cur: psycopg.Cursor
+) -> bool:
+    """
+    Helper function inserting a row, unless the value of a unique column is already taken. The check is done by the database through the UNIQUE constraint and its index, in the same statement as the insertion.
+    :param obj: the Pydantic model from which to generate a database row. In this API, it can be a User or Activity object.
+    :param table: string. The name of the table where to add the row. In this API, it could be either "users" or "activities".
+    :param conflict_key: string. The column with a UNIQUE constraint, e.g. "email" in "users".
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :return: True if the row was inserted, False if the value was already present.
+    """
+    query = create_insert_query(obj, table, conflict_key)
+    cur.execute(query, obj.__dict__)
+    return cur.rowcount == 1
+
+
+async def insert_item_if_absent_async(
+    obj: BaseModel, table: str, conflict_key: str, cur: psycopg.AsyncCursor
+) -> bool:
+    """
+    Asynchronous version of insert_item_if_absent.
+    :param obj: the Pydantic model from which to generate a database row. In this API, it can be a User or Activity object.
+    :param table: string. The name of the table where to add the row. In this API, it could be either "users" or "activities".
+    :param conflict_key: string. The column with a UNIQUE constraint, e.g. "email" in "users".
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :return: True if the row was inserted, False if the value was already present.
+    """
+    query = create_insert_query(obj, table, conflict_key)
+    await cur.execute(query, obj.__dict__)
+    return cur.rowcount == 1
+
+
+def create_copy_query(obj: BaseModel, table: str) -> str:
+    """
+    Helper function that generates the COPY statement used to write many rows like obj at once.
+    :param obj: a Pydantic model of the type of the rows to write.
+    :param table: string. The name of the table where to add the rows.
+    :return: the SQL statement.
+    """
+    obj_keys = [key for key, _ in obj.__dict__.items()]
+    col_string = ", ".join(obj_keys)
+    return f"COPY {table} ({col_string}) FROM STDIN"
+
+
+def copy_items(objs: list[BaseModel], table: str, cur: psycopg.Cursor) -> None:
+    """
+    Helper function writing many rows at once, using the COPY protocol instead of one INSERT per row.
+    :param objs: list of Pydantic models of the same type, from which to generate the database rows. In this API, they can be User or Activity objects.
+    :param table: string. The name of the table where to add the rows. In this API, it could be either "users" or "activities".
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    """
+    if not objs:
+        return None
+    with cur.copy(create_copy_query(objs[0], table)) as copy:
+        for obj in objs:
+            copy.write_row(tuple(obj.__dict__.values()))
+    return None
+
+
+async def copy_items_async(
+    objs: list[BaseModel], table: str, cur: psycopg.AsyncCursor
+) -> None:
+    """
+    Asynchronous version of copy_items.
+    :param objs: list of Pydantic models of the same type, from which to generate the database rows. In this API, they can be User or Activity objects.
+    :param table: string. The name of the table where to add the rows. In this API, it could be either "users" or "activities".
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    """
+    if not objs:
+        return None
+    async with cur.copy(create_copy_query(objs[0], table)) as copy:
+        for obj in objs:
+            await copy.write_row(tuple(obj.__dict__.values()))
+    return None
+
+
 def create_retrieve_query(key: str, table: str, where: str | None) -> str:
     """
     Helper function that generates a query to retrieve the entries in an SQL table column, given the table name, and the column key.
@@ -62,12 +183,158 @@ def retrieve_items(
     return [item[0] for item in tuples]
 
 
-def sql_to_dataframe(table, cur: psycopg.Cursor, where=None):
-    query = create_retrieve_query("*", table, where)
-    tuples = cur.execute(query).fetchall()
-    colnames = [desc[0] for desc in cur.description]
-    # Now we need to transform the list into a pandas DataFrame:
-    df = pd.DataFrame(tuples)
-    for i, colname in enumerate(colnames):
-        df.rename(columns={i: colname}, inplace=True)
-    return df
+def create_activities_filter(
+    start_time, end_time, activity_types: list | None = None
+) -> tuple[str, dict]:
+    """
+    Helper function that generates the WHERE condition selecting the activities in a time window, and optionally of given types. The values are not written in the condition, but returned as parameters to be bound by psycopg, so that Postgres can use them when planning the query.
+    :param start_time: datetime. Start of the time window (excluded), as returned by tools.tools.resolve_time_window.
+    :param end_time: datetime. End of the time window (included).
+    :param activity_types: list of strings (optional). The activity types to keep. If None, all types are kept.
+    :return: tuple with the condition in SQL syntax, and the dictionary of parameters to be passed along with the query.
+    """
+    where = "time > %(start_time)s AND time <= %(end_time)s"
+    params = {"start_time": start_time, "end_time": end_time}
+    if activity_types is not None:
+        where += " AND activity_type = ANY(%(activity_types)s)"
+        params["activity_types"] = list(activity_types)
+    return where, params
+
+
+def create_user_activities_query(
+    user_id: int, after: tuple | None = None, limit: int | None = None
+) -> tuple[str, dict]:
+    """
+    Helper function that generates the query reading the activities of a user in order of (time, activity_id), starting after a keyset cursor. Each page is a range scan of the index on (user_id, time, activity_id), so its cost does not depend on how many activities come before it.
+    :param user_id: the user_id of the user.
+    :param after: tuple (optional). The (time, activity_id) of the last activity already read. If None, the activities are read from the first one.
+    :param limit: int (optional). Maximum number of activities to read. If None, all are read.
+    :return: tuple with the SQL query, and the dictionary of parameters to be passed along with the query.
+    """
+    where = "user_id = %(user_id)s"
+    params = {"user_id": user_id}
+    if after is not None:
+        # the plain condition on time lets Postgres skip the partitions before the cursor
+        where += " AND time >= %(after_time)s AND (time, activity_id) > (%(after_time)s, %(after_activity_id)s)"
+        params["after_time"], params["after_activity_id"] = after
+    query = f"""
+                    SELECT activity_id, user_id, time, activity_type, activity_details
+                    FROM activities WHERE {where}
+                    ORDER BY time, activity_id
+                    """
+    if limit is not None:
+        query += "LIMIT %(limit)s"
+        params["limit"] = limit
+    return query, params
+
+
+def create_binary_export_query(
+    table: str, columns: list, where: str | None = None
+) -> str:
+    """
+    Helper function that generates the COPY statement exporting some columns of an SQL table, or of the part of it satisfying a condition, in the binary format of Postgres. All the exported columns have a fixed size, so that all the rows have the same length: the rows with a NULL in one of them (e.g. written to the database without going through the API) are left out.
+    :param table: string. The name of the table to extract.
+    :param columns: list of strings. The columns to extract, among the keys of ARRAY_COLUMNS.
+    :param where: string (optional): possible logical conditions to apply for the extraction. Must be written in SQL syntax.
+    :return: the SQL statement.
+    """
+    key = ", ".join(ARRAY_COLUMNS[column][0] for column in columns)
+    not_null = " AND ".join(f"{column} IS NOT NULL" for column in columns)
+    where = not_null if where is None else f"({where}) AND {not_null}"
+    query = create_retrieve_query(key, table, where)
+    return f"COPY ({query}) TO STDOUT (FORMAT BINARY)"
+
+
+def binary_copy_to_arrays(data: bytes | bytearray, columns: list) -> dict:
+    """
+    Function decoding the output of the statement of create_binary_export_query into one NumPy array per column. Since the rows have a fixed length, the whole payload is read at once as a structured array, and no Python object is created per row.
+    :param data: the bytes received from COPY TO STDOUT.
+    :param columns: list of strings. The exported columns, in the same order as in the statement.
+    :return: dictionary of arrays. "time" is in microseconds since the epoch (int64), "activity_type" is the position in ACTIVITY_TYPES (int8), "user_id" is int32.
+    """
+    if data[: len(BINARY_COPY_SIGNATURE)] != BINARY_COPY_SIGNATURE:
+        raise ValueError("Not a binary COPY output.")
+    # header: signature, flags (int32), length of the header extension (int32), header extension
+    extension_length = int.from_bytes(data[15:19], "big")
+    body = memoryview(data)[19 + extension_length : -2]  # the trailer is a -1 (int16)
+    fields = [("n_fields", ">i2")]
+    for column in columns:
+        fields += [(f"{column}_length", ">i4"), (column, ARRAY_COLUMNS[column][1])]
+    row_dtype = np.dtype(fields)
+    if len(body) % row_dtype.itemsize:
+        raise ValueError("Rows of variable length (NULL values?) cannot be decoded.")
+    rows = np.frombuffer(body, dtype=row_dtype)
+    arrays = {}
+    for column in columns:
+        if (rows[f"{column}_length"] != row_dtype[column].itemsize).any():
+            raise ValueError(f"NULL values in column {column}.")
+        arrays[column] = rows[column].astype(row_dtype[column].newbyteorder("="))
+    if "time" in arrays:
+        arrays["time"] += POSTGRES_EPOCH_US
+    if "activity_type" in arrays:
+        arrays["activity_type"] = arrays["activity_type"].astype(np.int8)
+    return arrays
+
+
+def sql_to_arrays(
+    table,
+    cur: psycopg.Cursor,
+    columns: list,
+    where=None,
+    params: dict | None = None,
+) -> dict:
+    """
+    Helper function extracting some columns of an SQL table, or of the part of it satisfying a condition, into NumPy arrays. It is the fastest way to pull large amounts of activities, as the data is streamed in binary and decoded in one go.
+    :param table: string. The name of the table to extract.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param columns: list of strings. The columns to extract, among the keys of ARRAY_COLUMNS.
+    :param where: string (optional): possible logical conditions to apply for the extraction. Must be written in SQL syntax, and may contain placeholders (e.g. as generated by create_activities_filter).
+    :param params: dictionary (optional). The values for the placeholders in where.
+    :return: dictionary of arrays, as returned by binary_copy_to_arrays.
+    """
+    data = bytearray()
+    with cur.copy(create_binary_export_query(table, columns, where), params) as copy:
+        for chunk in copy:
+            data += chunk
+    return binary_copy_to_arrays(data, columns)
+
+
+async def sql_to_arrays_async(
+    table,
+    cur: psycopg.AsyncCursor,
+    columns: list,
+    where=None,
+    params: dict | None = None,
+) -> dict:
+    """
+    Asynchronous version of sql_to_arrays. The data is awaited, and decoded in a worker thread.
+    :param table: string. The name of the table to extract.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param columns: list of strings. The columns to extract, among the keys of ARRAY_COLUMNS.
+    :param where: string (optional): possible logical conditions to apply for the extraction. Must be written in SQL syntax, and may contain placeholders (e.g. as generated by create_activities_filter).
+    :param params: dictionary (optional). The values for the placeholders in where.
+    :return: dictionary of arrays, as returned by binary_copy_to_arrays.
+    """
+    data = bytearray()
+    async with cur.copy(
+        create_binary_export_query(table, columns, where), params
+    ) as copy:
+        async for chunk in copy:
+            data += chunk
+    return await asyncio.to_thread(binary_copy_to_arrays, data, columns)
+
+
+def arrays_to_dataframe(arrays: dict) -> pd.DataFrame:
+    """
+    Helper function wrapping the arrays of sql_to_arrays into a pandas DataFrame, with UTC timestamps for "time" and a categorical "activity_type". The arrays are converted as a whole, without creating a Python object per row.
+    :param arrays: dictionary of arrays, as returned by sql_to_arrays.
+    :return: pandas DataFrame, one column per array.
+    """
+    columns = {}
+    for column, values in arrays.items():
+        if column == "time":
+            values = pd.to_datetime(values, unit="us", utc=True)
+        elif column == "activity_type":
+            values = pd.Categorical.from_codes(values, dtype=ACTIVITY_TYPE_DTYPE)
+        columns[column] = values
+    return pd.DataFrame(columns)
@@ -0,0 +1,75 @@
+import pandas as pd
+
+from tools.aggregation import DAY_MICROS, bucket_labels, count_arrays_per_bucket
+from tools.db_operations import ACTIVITY_TYPES
+from tools.sessions import SESSION_TIMEOUT, sessionize
+
+
+def session_durations_per_bucket(
+    sessions: pd.DataFrame, frequency: str, first_time: int
+) -> pd.DataFrame:
+    """
+    Function averaging the duration of the sessions per time bucket of their login, like tools.sessions.average_session_duration, but with the buckets of the activities they were found in, whose first day anchors the fixed frequencies.
+    :param sessions: DataFrame of sessions, as returned by sessionize.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param first_time: int. Time of the first activity, in microseconds since the epoch.
+    :return: DataFrame indexed by time bucket, with the mean duration ("duration") and the number of sessions ("n_sessions"), for the buckets with sessions.
+    """
+    login_times = sessions["login_time"].dt.as_unit("us").astype("int64").to_numpy()
+    labels = bucket_labels(login_times, frequency, first_time)
+    if labels is None:
+        origin = pd.Timestamp(
+            first_time // DAY_MICROS * DAY_MICROS, unit="us", tz="UTC"
+        )
+        keys = pd.Grouper(key="login_time", freq=frequency, origin=origin)
+    else:
+        keys = pd.DatetimeIndex(
+            pd.to_datetime(labels, unit="us", utc=True), name="time"
+        )
+    grouped = sessions.groupby(keys)["duration"]
+    durations = pd.DataFrame({"duration": grouped.mean(), "n_sessions": grouped.size()})
+    return durations.rename_axis("time")
+
+
+def summarize_engagement(
+    counts: pd.DataFrame, sessions: pd.DataFrame, frequency: str
+) -> pd.DataFrame:
+    """
+    Function gathering the main engagement metrics per time bucket in one table: the counts per activity type, the purchases per login, and the mean duration of the sessions with a login in each bucket.
+    :param counts: DataFrame indexed by time bucket, with one column of counts per activity type, as returned by activity_counts_over_time or count_arrays_per_bucket for all the ACTIVITY_TYPES.
+    :param sessions: DataFrame of sessions, as returned by sessionize or read_sessions, with their logins among the counted activities.
+    :param frequency: string. Offset alias used for the buckets of counts.
+    :return: DataFrame indexed by time bucket ("time"), with one column of counts per activity type, the purchases per login ("avg_purchases_per_login"), the mean duration of the sessions ("duration") and their number ("n_sessions").
+    """
+    summary = counts.reindex(columns=ACTIVITY_TYPES, fill_value=0).rename_axis(
+        columns=None
+    )
+    summary["avg_purchases_per_login"] = summary["purchase"] / summary["login"]
+    durations = pd.DataFrame(
+        {
+            "duration": pd.Series(dtype="timedelta64[ns]"),
+            "n_sessions": pd.Series(dtype="int64"),
+        }
+    )
+    if len(sessions) and len(summary):
+        # the first bucket starts on the day of the first activity, which anchors the fixed frequencies
+        first_time = summary.index.min().value // 1000
+        durations = session_durations_per_bucket(sessions, frequency, first_time)
+    # the logins are activities, so their buckets are among the buckets of the counts
+    summary = summary.join(durations)
+    summary["n_sessions"] = summary["n_sessions"].fillna(0).astype("int64")
+    return summary
+
+
+def engagement_summary(
+    arrays: dict, frequency: str, timeout: pd.Timedelta = SESSION_TIMEOUT
+) -> pd.DataFrame:
+    """
+    Function computing the main engagement metrics per time bucket from a single extraction of the activities: the counts per activity type, as activity_counts_over_time, the purchases per login, and the sessions found with sessionize, with their mean duration.
+    :param arrays: dictionary of arrays with the keys "time" (microseconds since the epoch), "user_id" and "activity_type" (position in ACTIVITY_TYPES), as returned by sql_to_arrays.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :return: DataFrame, as returned by summarize_engagement.
+    """
+    counts = count_arrays_per_bucket(arrays, ACTIVITY_TYPES, frequency)
+    return summarize_engagement(counts, sessionize(arrays, timeout), frequency)
@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow as pa
+
+from src.models import ResponseFormats
+
+MEDIA_TYPES = {
+    ResponseFormats.json: "application/json",
+    ResponseFormats.arrow: "application/vnd.apache.arrow.stream",
+    ResponseFormats.html: "text/html; charset=utf-8",
+}
+
+
+def column_values(values: pd.Series | pd.Index):
+    """
+    Helper function converting a column or an index into values that orjson serializes without a Python loop: NumPy arrays for numbers, booleans and times, with times in UTC and durations in seconds. Other columns are converted to lists, with null for missing values.
+    :param values: pd.Series or pd.Index.
+    :return: NumPy array or list.
+    """
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        values = values.dt.tz_convert("UTC").dt.tz_localize(None)
+    elif pd.api.types.is_timedelta64_dtype(values.dtype):
+        values = values.dt.total_seconds()
+    if (
+        pd.api.types.is_numeric_dtype(values.dtype)
+        or pd.api.types.is_bool_dtype(values.dtype)
+        or pd.api.types.is_datetime64_dtype(values.dtype)
+    ):
+        # orjson only serializes contiguous arrays
+        return np.ascontiguousarray(values.to_numpy())
+    values = values.astype(object)
+    return values.where(values.notna(), None).tolist()
+
+
+def dataframe_to_columnar(df: pd.DataFrame) -> dict:
+    """
+    Function converting a DataFrame into a columnar dictionary, {"index": [...], "columns": {name: [...]}}, where each column is a list aligned with the index.
+    :param df: the DataFrame.
+    :return: dictionary of NumPy arrays and lists, to be serialized with orjson.
+    """
+    return {
+        "index": column_values(df.index),
+        "columns": {str(name): column_values(df[name]) for name in df.columns},
+    }
+
+
+def dataframe_to_json(df: pd.DataFrame) -> bytes:
+    """
+    Function serializing a DataFrame as columnar JSON with orjson. Times are written in the ISO 8601 format, in UTC, and durations as seconds.
+    :param df: the DataFrame.
+    :return: the JSON document, as UTF-8 bytes.
+    """
+    return orjson.dumps(
+        dataframe_to_columnar(df),
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC,
+    )
+
+
+def dataframe_to_arrow(df: pd.DataFrame) -> bytes:
+    """
+    Function serializing a DataFrame, with its index, as an Arrow IPC stream. Clients read it without parsing, e.g. with pyarrow.ipc.open_stream(body).read_pandas().
+    :param df: the DataFrame.
+    :return: the Arrow IPC stream.
+    """
+    table = pa.Table.from_pandas(df.rename(columns=str), preserve_index=True)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def render_dataframe(df: pd.DataFrame, format: ResponseFormats) -> bytes:
+    """
+    Function serializing the answer of an analytics endpoint in the format requested.
+    :param df: the DataFrame.
+    :param format: ResponseFormats. "json", "arrow" or "html".
+    :return: the body of the response.
+    """
+    if format == ResponseFormats.json:
+        return dataframe_to_json(df)
+    if format == ResponseFormats.arrow:
+        return dataframe_to_arrow(df)
+    return df.to_html().encode()
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from tools.db_operations import ACTIVITY_TYPES
+from tools.sessions import LOGIN, LOGOUT, SESSION_TIMEOUT, TIE_BREAK
+
+
+def funnel_conversion(
+    arrays: dict,
+    steps: list,
+    within: pd.Timedelta | None = None,
+    same_session: bool = False,
+    timeout: pd.Timedelta = SESSION_TIMEOUT,
+) -> pd.DataFrame:
+    """
+    Function computing the conversion of the users through an ordered list of activity types, e.g. login, click and purchase. The activities are sorted by (user_id, time) once, and every activity of the first step starts an attempt. For each step, all the attempts move at once to the next activity of the step type of the same user, found with np.searchsorted in the positions of that type: taking the earliest one is never worse for the following steps. An attempt stops when there is no such activity, when it comes more than within after the start of the attempt, or, with same_session, after a logout, a login or a period of inactivity longer than timeout. A user reaches a step if any of their attempts does.
+    :param arrays: dictionary of arrays with the keys "time" (microseconds since the epoch), "user_id" and "activity_type" (position in ACTIVITY_TYPES), as returned by sql_to_arrays.
+    :param steps: list of at least one activity type of ACTIVITY_TYPES, in the order of the funnel. A type may appear more than once.
+    :param within: pd.Timedelta (optional). Maximum time between the first and the last step of an attempt.
+    :param same_session: bool. If True, all the steps of an attempt must belong to the same user session.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session, used with same_session.
+    :return: DataFrame indexed by step number ("step", from 1), with the activity type of the step ("activity_type"), the number of users reaching it ("users"), their fraction of the users of the first step ("conversion") and of the previous step ("step_conversion").
+    """
+    order = np.lexsort(
+        (TIE_BREAK[arrays["activity_type"]], arrays["time"], arrays["user_id"])
+    )
+    time = arrays["time"][order]
+    user_id = arrays["user_id"][order]
+    activity_type = arrays["activity_type"][order]
+
+    # attempts must stay within the activities of a user, or of a session
+    group = user_id
+    if same_session:
+        group_start = np.ones(len(time), dtype=bool)
+        group_start[1:] = (
+            (user_id[1:] != user_id[:-1])
+            | (activity_type[1:] == LOGIN)
+            | (activity_type[:-1] == LOGOUT)
+            | (np.diff(time) > timeout // pd.Timedelta(microseconds=1))
+        )
+        group = np.cumsum(group_start)
+
+    codes = [ACTIVITY_TYPES.index(step) for step in steps]
+    current = np.flatnonzero(activity_type == codes[0])
+    if within is None and not same_session:
+        # without a limit, the first attempt of each user goes the furthest
+        first = np.ones(len(current), dtype=bool)
+        first[1:] = user_id[current[1:]] != user_id[current[:-1]]
+        current = current[first]
+    if within is None:
+        deadline = np.full(len(current), np.iinfo(np.int64).max)
+    else:
+        deadline = time[current] + within // pd.Timedelta(microseconds=1)
+
+    users = []
+    for step, code in enumerate(codes):
+        if step:
+            # a sentinel after the last position ends the attempts without a following activity
+            positions = np.append(np.flatnonzero(activity_type == code), 0)
+            following = np.searchsorted(positions[:-1], current, side="right")
+            reached = following < len(positions) - 1
+            following = positions[following]
+            reached &= group[following] == group[current]
+            reached &= time[following] <= deadline
+            current = following[reached]
+            deadline = deadline[reached]
+        # the attempts stay sorted by user, so each user is counted once
+        reached_users = user_id[current]
+        users.append(
+            np.count_nonzero(np.diff(reached_users)) + 1 if len(current) else 0
+        )
+
+    users = np.array(users, dtype=np.int64)
+    previous = np.concatenate([users[:1], users[:-1]])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        conversion = users / users[0]
+        step_conversion = users / previous
+    return pd.DataFrame(
+        {
+            "activity_type": steps,
+            "users": users,
+            "conversion": conversion,
+            "step_conversion": step_conversion,
+        },
+        index=pd.RangeIndex(1, len(steps) + 1, name="step"),
+    )
@@ -0,0 +1,219 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from tools.db_operations import (
+    ACTIVITY_TYPES,
+    sql_to_arrays,
+    sql_to_arrays_async,
+)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC)
+COLUMNS = ["time", "user_id", "activity_type"]
+DTYPES = {"time": np.int64, "user_id": np.int32, "activity_type": np.int8}
+MIN_CAPACITY = 1024
+
+
+def to_microseconds(time: datetime.datetime) -> int:
+    """
+    Helper function converting a timezone-aware datetime into integer microseconds since the epoch, without going through floats.
+    """
+    return (time - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+class HotWindowStore:
+    """
+    Class keeping the activities of the recent time window in memory, as NumPy arrays sorted by time, so that the analytics on that window are computed without querying the database. It is loaded once with the load() method, and kept up to date with append() when activities are posted. Activities older than the window are evicted as time goes by. Only the writes done through the same process are seen, as for UserIdCache. The arrays handed out by window_arrays are never modified afterwards, so they can be used from other threads.
+    """
+
+    def __init__(self, window: datetime.timedelta = datetime.timedelta(days=30)):
+        """
+        :param window: timedelta. Length of the window kept in memory, back from now.
+        """
+        self.window_us = window // datetime.timedelta(microseconds=1)
+        self.arrays = {
+            column: np.empty(MIN_CAPACITY, dtype) for column, dtype in DTYPES.items()
+        }
+        # the activities are in arrays[head:end], sorted by time up to sorted_end
+        self.head = 0
+        self.end = 0
+        self.sorted_end = 0
+        # activities after this time (in microseconds since the epoch) are all in the store. None until loaded
+        self.covered_from = None
+
+    def __len__(self) -> int:
+        return self.end - self.head
+
+    def load(self, cur: psycopg.Cursor, now: datetime.datetime | None = None):
+        """
+        Loads the activities of the window ending now from the activities table.
+        :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+        :param now: datetime (optional). End of the window. Defaults to the current time.
+        """
+        covered_from = self._window_start(now)
+        where, params = "time > %(start_time)s", {"start_time": covered_from}
+        self._replace(sql_to_arrays("activities", cur, COLUMNS, where, params))
+        self.covered_from = to_microseconds(covered_from)
+
+    async def load_async(
+        self, cur: psycopg.AsyncCursor, now: datetime.datetime | None = None
+    ):
+        """
+        Asynchronous version of load.
+        :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+        :param now: datetime (optional). End of the window. Defaults to the current time.
+        """
+        covered_from = self._window_start(now)
+        where, params = "time > %(start_time)s", {"start_time": covered_from}
+        arrays = await sql_to_arrays_async("activities", cur, COLUMNS, where, params)
+        self._replace(arrays)
+        self.covered_from = to_microseconds(covered_from)
+
+    def append(self, activities: list):
+        """
+        Adds newly stored activities. Activities older than the window are skipped, as they are not needed.
+        :param activities: list of Activity objects, already written to the database.
+        """
+        if self.covered_from is None:
+            return
+        times = np.array([to_microseconds(a.time) for a in activities], np.int64)
+        keep = times > self.covered_from
+        n_new = int(keep.sum())
+        if not n_new:
+            return
+        if self.end + n_new > len(self.arrays["time"]):
+            self._reallocate(n_new)
+        new = slice(self.end, self.end + n_new)
+        self.arrays["time"][new] = times[keep]
+        self.arrays["user_id"][new] = [
+            a.user_id for a, kept in zip(activities, keep) if kept
+        ]
+        self.arrays["activity_type"][new] = [
+            ACTIVITY_TYPES.index(a.activity_type) if a.activity_type else -1
+            for a, kept in zip(activities, keep)
+            if kept
+        ]
+        previous = self.arrays["time"][self.end - 1] if self.end > self.head else None
+        self.end += n_new
+        if self.sorted_end == new.start and (
+            previous is None or previous <= times[keep][0]
+        ):
+            # still sorted if the batch is, which is the common case of activities posted as they happen
+            if np.all(np.diff(self.arrays["time"][new]) >= 0):
+                self.sorted_end = self.end
+
+    def covers(
+        self, start_time: datetime.datetime, now: datetime.datetime | None = None
+    ) -> bool:
+        """
+        Checks if all the activities after start_time are in the store, evicting the ones older than the window first.
+        :param start_time: datetime. Start of the time window (excluded).
+        :param now: datetime (optional). The current time, used for the eviction.
+        :return: True if the window can be answered from the store. Always False if the window of the store is empty, e.g. when disabled with HOT_WINDOW_DAYS=0.
+        """
+        if self.covered_from is None or not self.window_us:
+            return False
+        self.evict(now)
+        return to_microseconds(start_time) >= self.covered_from
+
+    def evict(self, now: datetime.datetime | None = None):
+        """
+        Drops the activities older than the window. The arrays are compacted when more than half of them is unused.
+        :param now: datetime (optional). The current time.
+        """
+        if self.covered_from is None:
+            return
+        covered_from = to_microseconds(self._window_start(now))
+        if covered_from <= self.covered_from:
+            return
+        self._sort()
+        self.head += int(
+            np.searchsorted(
+                self.arrays["time"][self.head : self.end], covered_from, "right"
+            )
+        )
+        self.sorted_end = max(self.sorted_end, self.head)
+        self.covered_from = covered_from
+        if self.head > len(self.arrays["time"]) // 2:
+            self._reallocate(0)
+
+    def window_arrays(
+        self, start_time: datetime.datetime, end_time: datetime.datetime
+    ) -> dict:
+        """
+        Returns the activities in the window start_time < time <= end_time, found by binary search on the sorted times. Check with covers() first that the window is in the store.
+        :param start_time: datetime. Start of the time window (excluded).
+        :param end_time: datetime. End of the time window (included).
+        :return: dictionary of arrays, as returned by tools.db_operations.sql_to_arrays for the columns "time", "user_id" and "activity_type".
+        """
+        self._sort()
+        times = self.arrays["time"][self.head : self.end]
+        lo, hi = np.searchsorted(
+            times, [to_microseconds(start_time), to_microseconds(end_time)], "right"
+        )
+        return {
+            column: values[self.head + lo : self.head + hi]
+            for column, values in self.arrays.items()
+        }
+
+    def get_stats(self) -> dict:
+        """
+        Returns the number of activities in the store, the memory used by the arrays, and the start of the covered window, as a dictionary.
+        """
+        covered_from = None
+        if self.covered_from is not None:
+            covered_from = pd.Timestamp(self.covered_from, unit="us", tz="UTC")
+        return {
+            "n_activities": len(self),
+            "n_bytes": sum(values.nbytes for values in self.arrays.values()),
+            "covered_from": covered_from,
+        }
+
+    def _window_start(self, now: datetime.datetime | None) -> datetime.datetime:
+        if now is None:
+            now = datetime.datetime.now(datetime.UTC)
+        return now - datetime.timedelta(microseconds=self.window_us)
+
+    def _replace(self, arrays: dict):
+        order = np.argsort(arrays["time"], kind="stable")
+        n = len(order)
+        self.arrays = {
+            column: np.empty(max(MIN_CAPACITY, 2 * n), dtype)
+            for column, dtype in DTYPES.items()
+        }
+        for column in DTYPES:
+            self.arrays[column][:n] = arrays[column][order]
+        self.head, self.end, self.sorted_end = 0, n, n
+
+    def _reallocate(self, n_new: int):
+        # new arrays, so that the arrays handed out before are not modified
+        n = len(self)
+        capacity = max(MIN_CAPACITY, 2 * (n + n_new))
+        arrays = {}
+        for column, dtype in DTYPES.items():
+            arrays[column] = np.empty(capacity, dtype)
+            arrays[column][:n] = self.arrays[column][self.head : self.end]
+        self.sorted_end -= self.head
+        self.arrays, self.head, self.end = arrays, 0, n
+
+    def _sort(self):
+        if self.sorted_end == self.end:
+            return
+        live = slice(self.head, self.end)
+        order = np.argsort(self.arrays["time"][live], kind="stable")
+        arrays = {}
+        for column, dtype in DTYPES.items():
+            arrays[column] = np.empty(len(self.arrays[column]), dtype)
+            arrays[column][: len(order)] = self.arrays[column][live][order]
+        self.arrays = arrays
+        self.head, self.end, self.sorted_end = 0, len(order), len(order)
+
+
+def get_hot_window_store() -> HotWindowStore:
+    """Helper function that instantiates the HotWindowStore class, with the length of the window set by the HOT_WINDOW_DAYS environment variable (30 days by default)."""
+    return HotWindowStore(
+        window=datetime.timedelta(days=float(os.getenv("HOT_WINDOW_DAYS", 30)))
+    )
@@ -0,0 +1,121 @@
+import argparse
+import datetime
+
+import pandas as pd
+
+from tools.ConnectionManager import get_db
+from tools.partitions import (
+    PARTITION_MONTHS_AHEAD,
+    create_future_partitions,
+    detach_partitions,
+)
+from tools.rollup import rebuild_hourly_rollup
+from tools.active_users import rebuild_active_users
+from tools.sessions import backfill_sessions
+
+
+def main(argv: list | None = None):
+    """
+    Command line entry point for the maintenance tasks of the database. Run it with "python -m tools.maintenance --help" for the list of commands.
+    """
+    parser = argparse.ArgumentParser(
+        description="Maintenance tasks for the User-engagement database."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser(
+        "rebuild-rollup",
+        help="recount the hourly activity counts from the raw activities.",
+    )
+    rebuild.add_argument(
+        "--start",
+        type=datetime.datetime.fromisoformat,
+        help="first hour to rebuild, in iso8601 format. Default: the first activity.",
+    )
+    rebuild.add_argument(
+        "--end",
+        type=datetime.datetime.fromisoformat,
+        help="last hour to rebuild, in iso8601 format. Default: the last activity.",
+    )
+    rebuild_users = subparsers.add_parser(
+        "rebuild-active-users",
+        help="rebuild the hourly sketches of the active users from the raw activities.",
+    )
+    rebuild_users.add_argument(
+        "--start",
+        type=datetime.datetime.fromisoformat,
+        help="first hour to rebuild, in iso8601 format. Default: the first activity.",
+    )
+    rebuild_users.add_argument(
+        "--end",
+        type=datetime.datetime.fromisoformat,
+        help="last hour to rebuild, in iso8601 format. Default: the last activity.",
+    )
+    backfill = subparsers.add_parser(
+        "backfill-sessions",
+        help="rebuild the sessions table from the raw activities.",
+    )
+    backfill.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="number of users processed at once. Default: 1000.",
+    )
+    backfill.add_argument(
+        "--timeout-minutes",
+        type=int,
+        default=30,
+        help="maximum inactivity inside a session. Default: 30.",
+    )
+    partitions = subparsers.add_parser(
+        "create-partitions",
+        help="create the monthly partitions of activities for the coming months.",
+    )
+    partitions.add_argument(
+        "--months-ahead",
+        type=int,
+        default=PARTITION_MONTHS_AHEAD,
+        help=f"number of months after the current one to create. Default: {PARTITION_MONTHS_AHEAD}.",
+    )
+    detach = subparsers.add_parser(
+        "detach-partitions",
+        help="remove the activities of old months, by detaching their partitions.",
+    )
+    detach.add_argument(
+        "--before",
+        type=datetime.datetime.fromisoformat,
+        required=True,
+        help="the months ending before this time, in iso8601 format, are detached.",
+    )
+    detach.add_argument(
+        "--drop",
+        action="store_true",
+        help="drop the detached partitions, instead of keeping them as standalone tables.",
+    )
+    args = parser.parse_args(argv)
+
+    connection_manager = get_db()
+    try:
+        with connection_manager.connection() as conn:
+            if args.command == "rebuild-rollup":
+                n_counts = rebuild_hourly_rollup(conn, args.start, args.end)
+                print(f"{n_counts} hourly counts written.")
+            elif args.command == "rebuild-active-users":
+                n_sketches = rebuild_active_users(conn, args.start, args.end)
+                print(f"{n_sketches} hourly sketches written.")
+            elif args.command == "backfill-sessions":
+                timeout = pd.Timedelta(minutes=args.timeout_minutes)
+                n_sessions = backfill_sessions(conn, args.chunk_size, timeout)
+                print(f"{n_sessions} sessions written.")
+            elif args.command == "create-partitions":
+                with conn.cursor() as cur:
+                    n_partitions = create_future_partitions(cur, args.months_ahead)
+                print(f"{n_partitions} partitions created.")
+            elif args.command == "detach-partitions":
+                detached = detach_partitions(conn, args.before, args.drop)
+                print(f"{len(detached)} partitions detached: {', '.join(detached)}")
+    finally:
+        connection_manager.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import psycopg
+
+# Key of the advisory lock taken while migrating, so that concurrent workers do not apply the same migration twice
+MIGRATION_LOCK_ID = 74201
+# Key of the advisory lock taken while creating partitions of activities
+PARTITION_LOCK_ID = 74202
+
+# Versioned changes of the database schema, as (version, name, SQL). Applied versions are recorded in schema_migrations, so that each change runs once per database. Never edit an applied migration: add a new one instead. The SQL is written out in full, not built from the queries of the other modules, so that changing those does not change the applied migrations.
+MIGRATIONS = [
+    (
+        1,
+        "create users and activities",
+        """
+        CREATE TABLE IF NOT EXISTS users (
+        user_id INT PRIMARY KEY,
+        username TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        age SMALLINT,
+        country VARCHAR(2)
+        );
+        CREATE TABLE IF NOT EXISTS activities (
+        activity_id UUID PRIMARY KEY,
+        user_id INT REFERENCES users (user_id),
+        time TIMESTAMPTZ,
+        activity_type TEXT,
+        activity_details TEXT
+        );
+        """,
+    ),
+    (
+        2,
+        "analytics indexes on activities",
+        """
+        CREATE INDEX IF NOT EXISTS activities_user_id_time_idx ON activities (user_id, time);
+        CREATE INDEX IF NOT EXISTS activities_activity_type_time_idx ON activities (activity_type, time);
+        CREATE INDEX IF NOT EXISTS activities_time_brin_idx ON activities USING brin (time);
+        """,
+    ),
+    (
+        3,
+        "hourly rollup of the activity counts",
+        """
+        LOCK TABLE activities IN SHARE ROW EXCLUSIVE MODE;
+        CREATE TABLE IF NOT EXISTS activity_counts_hourly (
+        bucket TIMESTAMPTZ NOT NULL,
+        activity_type TEXT NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (bucket, activity_type)
+        );
+        CREATE OR REPLACE FUNCTION activity_counts_hourly_update() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO activity_counts_hourly (bucket, activity_type, count)
+                SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, activity_type, -count(*)
+                FROM old_activities
+                WHERE time IS NOT NULL AND activity_type IS NOT NULL
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, activity_type)
+                DO UPDATE SET count = activity_counts_hourly.count + EXCLUDED.count;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO activity_counts_hourly (bucket, activity_type, count)
+                SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, activity_type, count(*)
+                FROM new_activities
+                WHERE time IS NOT NULL AND activity_type IS NOT NULL
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, activity_type)
+                DO UPDATE SET count = activity_counts_hourly.count + EXCLUDED.count;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS activities_rollup_insert ON activities;
+        CREATE TRIGGER activities_rollup_insert AFTER INSERT ON activities
+        REFERENCING NEW TABLE AS new_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        DROP TRIGGER IF EXISTS activities_rollup_update ON activities;
+        CREATE TRIGGER activities_rollup_update AFTER UPDATE ON activities
+        REFERENCING OLD TABLE AS old_activities NEW TABLE AS new_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        DROP TRIGGER IF EXISTS activities_rollup_delete ON activities;
+        CREATE TRIGGER activities_rollup_delete AFTER DELETE ON activities
+        REFERENCING OLD TABLE AS old_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        INSERT INTO activity_counts_hourly (bucket, activity_type, count)
+                SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, activity_type, count(*)
+                FROM activities
+                WHERE time IS NOT NULL AND activity_type IS NOT NULL
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, activity_type)
+                DO UPDATE SET count = activity_counts_hourly.count + EXCLUDED.count;
+        """,
+    ),
+    (
+        4,
+        "sessions",
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+        user_id INT NOT NULL,
+        login_time TIMESTAMPTZ NOT NULL,
+        logout_time TIMESTAMPTZ NOT NULL,
+        duration INTERVAL NOT NULL,
+        n_clicks INT NOT NULL,
+        purchased BOOLEAN NOT NULL,
+        timed_out BOOLEAN NOT NULL,
+        PRIMARY KEY (user_id, login_time)
+        );
+        CREATE INDEX IF NOT EXISTS sessions_login_time_idx ON sessions (login_time);
+        """,
+    ),
+    (
+        5,
+        "keyset pagination index on activities",
+        """
+        CREATE INDEX IF NOT EXISTS activities_user_id_time_activity_id_idx ON activities (user_id, time, activity_id);
+        DROP INDEX IF EXISTS activities_user_id_time_idx;
+        """,
+    ),
+    (
+        6,
+        "monthly partitions of activities",
+        f"""
+        LOCK TABLE activities IN ACCESS EXCLUSIVE MODE;
+        -- time becomes the partition key, so it cannot be NULL: such rows must be fixed or deleted by hand before migrating
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM activities WHERE time IS NULL) THEN
+                RAISE EXCEPTION 'Activities without time cannot be partitioned: set or delete them before migrating (SELECT * FROM activities WHERE time IS NULL).';
+            END IF;
+        END;
+        $$;
+        ALTER TABLE activities RENAME TO activities_unpartitioned;
+        ALTER INDEX activities_pkey RENAME TO activities_unpartitioned_pkey;
+        DROP INDEX IF EXISTS activities_user_id_time_activity_id_idx, activities_activity_type_time_idx, activities_time_brin_idx;
+        CREATE TABLE activities (
+        activity_id UUID NOT NULL,
+        user_id INT REFERENCES users (user_id),
+        time TIMESTAMPTZ NOT NULL,
+        activity_type TEXT,
+        activity_details TEXT,
+        -- the key of a partitioned table must contain the partition key, so activity_id alone is no longer unique in the database: the API relies on it being a random UUID4 generated by the server (long_uuid4_generator)
+        PRIMARY KEY (activity_id, time)
+        ) PARTITION BY RANGE (time);
+        CREATE TABLE activities_default PARTITION OF activities DEFAULT;
+        CREATE OR REPLACE FUNCTION create_activity_partitions(first_time TIMESTAMPTZ, last_time TIMESTAMPTZ) RETURNS INT AS $$
+        DECLARE
+            month_start TIMESTAMP := date_trunc('month', first_time AT TIME ZONE 'UTC');
+            month_end TIMESTAMP;
+            partition_name TEXT;
+            n_created INT := 0;
+        BEGIN
+            PERFORM pg_advisory_xact_lock({PARTITION_LOCK_ID});
+            WHILE month_start <= last_time AT TIME ZONE 'UTC' LOOP
+                month_end := month_start + interval '1 month';
+                partition_name := 'activities_' || to_char(month_start, 'YYYY_MM');
+                IF to_regclass(partition_name) IS NULL THEN
+                    EXECUTE format('CREATE TABLE %I (LIKE activities INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+                    EXECUTE format(
+                        'WITH moved AS (DELETE FROM activities_default WHERE time >= %L AND time < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                        month_start AT TIME ZONE 'UTC', month_end AT TIME ZONE 'UTC', partition_name
+                    );
+                    EXECUTE format(
+                        'ALTER TABLE activities ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, month_start AT TIME ZONE 'UTC', month_end AT TIME ZONE 'UTC'
+                    );
+                    n_created := n_created + 1;
+                END IF;
+                month_start := month_end;
+            END LOOP;
+            RETURN n_created;
+        END;
+        $$ LANGUAGE plpgsql;
+        SELECT create_activity_partitions(min(time), max(time)) FROM activities_unpartitioned;
+        SELECT create_activity_partitions(now(), now() + interval '3 months');
+        INSERT INTO activities SELECT activity_id, user_id, time, activity_type, activity_details FROM activities_unpartitioned;
+        DROP TABLE activities_unpartitioned;
+        CREATE INDEX activities_user_id_time_activity_id_idx ON activities (user_id, time, activity_id);
+        CREATE INDEX activities_activity_type_time_idx ON activities (activity_type, time);
+        CREATE INDEX activities_time_brin_idx ON activities USING brin (time);
+        CREATE TRIGGER activities_rollup_insert AFTER INSERT ON activities
+        REFERENCING NEW TABLE AS new_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        CREATE TRIGGER activities_rollup_update AFTER UPDATE ON activities
+        REFERENCING OLD TABLE AS old_activities NEW TABLE AS new_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        CREATE TRIGGER activities_rollup_delete AFTER DELETE ON activities
+        REFERENCING OLD TABLE AS old_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION activity_counts_hourly_update();
+        """,
+    ),
+    (
+        7,
+        "hourly sketches of the active users",
+        """
+        LOCK TABLE activities IN SHARE ROW EXCLUSIVE MODE;
+        CREATE TABLE IF NOT EXISTS active_users_hourly (
+        bucket TIMESTAMPTZ PRIMARY KEY,
+        sketch BYTEA NOT NULL
+        );
+        -- sketches are small and incompressible: keep them inline, without TOAST
+        ALTER TABLE active_users_hourly ALTER COLUMN sketch SET STORAGE PLAIN;
+        CREATE OR REPLACE FUNCTION hll_add(sketch BYTEA, registers INT[], ranks INT[]) RETURNS BYTEA AS $$
+        BEGIN
+            FOR i IN 1 .. coalesce(cardinality(registers), 0) LOOP
+                IF get_byte(sketch, registers[i]) < ranks[i] THEN
+                    sketch := set_byte(sketch, registers[i], ranks[i]);
+                END IF;
+            END LOOP;
+            RETURN sketch;
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE;
+        CREATE OR REPLACE FUNCTION active_users_hourly_update() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO active_users_hourly (bucket, sketch)
+                SELECT DISTINCT bucket, decode(repeat('00', 2048), 'hex')
+                FROM (SELECT bucket, hash & 2047 AS register,
+                    max(coalesce(nullif(position('1' IN reverse((hash >> 11)::bit(53)::text)), 0), 54)) AS rank
+                    FROM (
+                        SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, hashint8extended(user_id::bigint, 0) AS hash
+                        FROM new_activities
+                        WHERE time IS NOT NULL AND user_id IS NOT NULL
+                    ) hashed
+                    GROUP BY 1, 2) ranks
+                ORDER BY bucket
+                ON CONFLICT (bucket) DO NOTHING;
+            UPDATE active_users_hourly
+                SET sketch = hll_add(active_users_hourly.sketch, added.registers, added.ranks)
+                FROM (
+                    SELECT bucket, array_agg(register::int) AS registers, array_agg(rank) AS ranks
+                    FROM (SELECT bucket, hash & 2047 AS register,
+                    max(coalesce(nullif(position('1' IN reverse((hash >> 11)::bit(53)::text)), 0), 54)) AS rank
+                    FROM (
+                        SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, hashint8extended(user_id::bigint, 0) AS hash
+                        FROM new_activities
+                        WHERE time IS NOT NULL AND user_id IS NOT NULL
+                    ) hashed
+                    GROUP BY 1, 2) ranks
+                    GROUP BY bucket
+                ) added
+                WHERE active_users_hourly.bucket = added.bucket;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS activities_active_users_insert ON activities;
+        CREATE TRIGGER activities_active_users_insert AFTER INSERT ON activities
+        REFERENCING NEW TABLE AS new_activities
+        FOR EACH STATEMENT EXECUTE FUNCTION active_users_hourly_update();
+        INSERT INTO active_users_hourly (bucket, sketch)
+                SELECT DISTINCT bucket, decode(repeat('00', 2048), 'hex')
+                FROM (SELECT bucket, hash & 2047 AS register,
+                    max(coalesce(nullif(position('1' IN reverse((hash >> 11)::bit(53)::text)), 0), 54)) AS rank
+                    FROM (
+                        SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, hashint8extended(user_id::bigint, 0) AS hash
+                        FROM activities
+                        WHERE time IS NOT NULL AND user_id IS NOT NULL
+                    ) hashed
+                    GROUP BY 1, 2) ranks
+                ORDER BY bucket
+                ON CONFLICT (bucket) DO NOTHING;
+        UPDATE active_users_hourly
+                SET sketch = hll_add(active_users_hourly.sketch, added.registers, added.ranks)
+                FROM (
+                    SELECT bucket, array_agg(register::int) AS registers, array_agg(rank) AS ranks
+                    FROM (SELECT bucket, hash & 2047 AS register,
+                    max(coalesce(nullif(position('1' IN reverse((hash >> 11)::bit(53)::text)), 0), 54)) AS rank
+                    FROM (
+                        SELECT date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, hashint8extended(user_id::bigint, 0) AS hash
+                        FROM activities
+                        WHERE time IS NOT NULL AND user_id IS NOT NULL
+                    ) hashed
+                    GROUP BY 1, 2) ranks
+                    GROUP BY bucket
+                ) added
+                WHERE active_users_hourly.bucket = added.bucket;
+        """,
+    ),
+    (
+        8,
+        "hourly duration bins of the sessions",
+        """
+        LOCK TABLE sessions IN SHARE ROW EXCLUSIVE MODE;
+        CREATE TABLE IF NOT EXISTS session_durations_hourly (
+        bucket TIMESTAMPTZ NOT NULL,
+        bin SMALLINT NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (bucket, bin)
+        );
+        CREATE OR REPLACE FUNCTION session_durations_hourly_update() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO session_durations_hourly (bucket, bin, count)
+                SELECT date_trunc('hour', login_time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, CASE WHEN extract(epoch FROM duration) < 0.001 THEN -32768
+                ELSE ceil(ln(extract(epoch FROM duration)) / ln(1.02020202020202))::smallint END AS bin, -count(*)
+                FROM old_sessions
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, bin)
+                DO UPDATE SET count = session_durations_hourly.count + EXCLUDED.count;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO session_durations_hourly (bucket, bin, count)
+                SELECT date_trunc('hour', login_time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, CASE WHEN extract(epoch FROM duration) < 0.001 THEN -32768
+                ELSE ceil(ln(extract(epoch FROM duration)) / ln(1.02020202020202))::smallint END AS bin, count(*)
+                FROM new_sessions
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, bin)
+                DO UPDATE SET count = session_durations_hourly.count + EXCLUDED.count;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS sessions_durations_insert ON sessions;
+        CREATE TRIGGER sessions_durations_insert AFTER INSERT ON sessions
+        REFERENCING NEW TABLE AS new_sessions
+        FOR EACH STATEMENT EXECUTE FUNCTION session_durations_hourly_update();
+        DROP TRIGGER IF EXISTS sessions_durations_update ON sessions;
+        CREATE TRIGGER sessions_durations_update AFTER UPDATE ON sessions
+        REFERENCING OLD TABLE AS old_sessions NEW TABLE AS new_sessions
+        FOR EACH STATEMENT EXECUTE FUNCTION session_durations_hourly_update();
+        DROP TRIGGER IF EXISTS sessions_durations_delete ON sessions;
+        CREATE TRIGGER sessions_durations_delete AFTER DELETE ON sessions
+        REFERENCING OLD TABLE AS old_sessions
+        FOR EACH STATEMENT EXECUTE FUNCTION session_durations_hourly_update();
+        INSERT INTO session_durations_hourly (bucket, bin, count)
+                SELECT date_trunc('hour', login_time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket, CASE WHEN extract(epoch FROM duration) < 0.001 THEN -32768
+                ELSE ceil(ln(extract(epoch FROM duration)) / ln(1.02020202020202))::smallint END AS bin, count(*)
+                FROM sessions
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT (bucket, bin)
+                DO UPDATE SET count = session_durations_hourly.count + EXCLUDED.count;
+        """,
+    ),
+]
+
+CREATE_MIGRATIONS_TABLE = """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                """
+RECORD_MIGRATION = (
+    "INSERT INTO schema_migrations (version, name) VALUES (%(version)s, %(name)s)"
+)
+
+
+def migration_script(migrations: list = MIGRATIONS) -> str:
+    """
+    Function returning all the migrations as a single SQL script, recording their versions. Used to build a new database in one go, e.g. in tests.
+    :param migrations: list of (version, name, SQL) tuples.
+    :return: the SQL script.
+    """
+    script = CREATE_MIGRATIONS_TABLE
+    for version, name, sql in migrations:
+        script += sql
+        script += f"INSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}');\n"
+    return script
+
+
+def apply_migrations(conn: psycopg.Connection, migrations: list = MIGRATIONS) -> list:
+    """
+    Function applying the migrations that are not recorded in schema_migrations yet, in order of version. Each migration runs in its own transaction, together with its record, so that a failed migration leaves no trace and is tried again at the next start.
+    :param conn: the psycopg connection to the database.
+    :param migrations: list of (version, name, SQL) tuples.
+    :return: list of the versions applied.
+    """
+    applied_now = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            cur.execute(CREATE_MIGRATIONS_TABLE)
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+            for version, name, sql in sorted(migrations):
+                if version in applied:
+                    continue
+                with conn.transaction():
+                    cur.execute(sql)
+                    cur.execute(RECORD_MIGRATION, {"version": version, "name": name})
+                applied_now.append(version)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    return applied_now
+
+
+async def apply_migrations_async(
+    conn: psycopg.AsyncConnection, migrations: list = MIGRATIONS
+) -> list:
+    """
+    Asynchronous version of apply_migrations.
+    :param conn: the psycopg AsyncConnection to the database.
+    :param migrations: list of (version, name, SQL) tuples.
+    :return: list of the versions applied.
+    """
+    applied_now = []
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            await cur.execute(CREATE_MIGRATIONS_TABLE)
+            await cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in await cur.fetchall()}
+            for version, name, sql in sorted(migrations):
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await cur.execute(sql)
+                    await cur.execute(
+                        RECORD_MIGRATION, {"version": version, "name": name}
+                    )
+                applied_now.append(version)
+        finally:
+            await cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    return applied_now
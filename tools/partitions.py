@@ -0,0 +1,97 @@
+import datetime
+import re
+
+import psycopg
+
+# Number of months after the current one that always have a partition, so that new activities do not land in activities_default
+PARTITION_MONTHS_AHEAD = 3
+
+CREATE_PARTITIONS_QUERY = "SELECT create_activity_partitions(now(), now() + make_interval(months => %(months_ahead)s))"
+LIST_PARTITIONS_QUERY = """
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'activities'::regclass
+                """
+PARTITION_NAME = re.compile(r"^activities_(\d{4})_(\d{2})$")
+
+
+def create_future_partitions(
+    cur: psycopg.Cursor, months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> int:
+    """
+    Function creating the monthly partitions of activities from the current month to months_ahead months later, if missing. The activities of those months already stored in activities_default are moved to their partition. Safe to run concurrently, e.g. by several workers at startup.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param months_ahead: int. Number of months after the current one to create.
+    :return: the number of partitions created.
+    """
+    cur.execute(CREATE_PARTITIONS_QUERY, {"months_ahead": months_ahead})
+    return cur.fetchone()[0]
+
+
+async def create_future_partitions_async(
+    cur: psycopg.AsyncCursor, months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> int:
+    """
+    Asynchronous version of create_future_partitions.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param months_ahead: int. Number of months after the current one to create.
+    :return: the number of partitions created.
+    """
+    await cur.execute(CREATE_PARTITIONS_QUERY, {"months_ahead": months_ahead})
+    return (await cur.fetchone())[0]
+
+
+def list_partitions(cur: psycopg.Cursor) -> list:
+    """
+    Function listing the monthly partitions attached to activities, in order of time. activities_default is not included.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :return: list of (name, start, end) tuples, with the activities of the partition satisfying start <= time < end.
+    """
+    partitions = []
+    for (name,) in cur.execute(LIST_PARTITIONS_QUERY).fetchall():
+        match = PARTITION_NAME.match(name)
+        if match is None:
+            continue
+        year, month = int(match[1]), int(match[2])
+        start = datetime.datetime(year, month, 1, tzinfo=datetime.UTC)
+        end = datetime.datetime(
+            year + month // 12, month % 12 + 1, 1, tzinfo=datetime.UTC
+        )
+        partitions.append((name, start, end))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def detach_partitions(
+    conn: psycopg.Connection, before: datetime.datetime, drop: bool = False
+) -> list:
+    """
+    Function removing the activities of the months ending before a given time, by detaching their partitions, which is much faster than deleting the rows. The hourly counts, the sessions and the active user sketches of those months are deleted too, so that they stay consistent with the activities. Each partition is processed in its own transaction.
+    :param conn: the psycopg connection to the database.
+    :param before: datetime. The partitions whose months end before this time (or at it) are detached.
+    :param drop: bool. If True, the detached partitions are dropped. Otherwise, they are kept as standalone tables, e.g. to be archived.
+    :return: list of the names of the partitions detached.
+    """
+    detached = []
+    with conn.cursor() as cur:
+        for name, start, end in list_partitions(cur):
+            if end > before:
+                break
+            params = {"start": start, "end": end}
+            with conn.transaction():
+                cur.execute(f'ALTER TABLE activities DETACH PARTITION "{name}"')
+                cur.execute(
+                    "DELETE FROM activity_counts_hourly WHERE bucket >= %(start)s AND bucket < %(end)s",
+                    params,
+                )
+                cur.execute(
+                    "DELETE FROM sessions WHERE login_time >= %(start)s AND login_time < %(end)s",
+                    params,
+                )
+                cur.execute(
+                    "DELETE FROM active_users_hourly WHERE bucket >= %(start)s AND bucket < %(end)s",
+                    params,
+                )
+                if drop:
+                    cur.execute(f'DROP TABLE "{name}"')
+            detached.append(name)
+    return detached
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+# Activities below which a job runs in a thread of the API process, as copying them to a worker costs more than the time saved
+MIN_OFFLOAD_ROWS = 100_000
+# Alignment of the arrays in the shared memory block, in bytes
+ARRAY_ALIGNMENT = 64
+
+
+class JobTimeout(Exception):
+    """
+    Exception raised when an aggregation job does not finish within the timeout of the pool.
+    """
+
+
+def arrays_to_shared_memory(arrays: dict) -> tuple[shared_memory.SharedMemory, list]:
+    """
+    Helper function copying a dictionary of 1-dimensional arrays into a single new shared memory block, one after the other.
+    :param arrays: dictionary of arrays, as returned by tools.db_operations.sql_to_arrays.
+    :return: tuple with the shared memory block, to be closed and unlinked by the caller, and the layout of the arrays in it, as a list of (key, dtype string, offset, length) tuples.
+    """
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append((key, array.dtype.str, offset, len(array)))
+        offset += -(-array.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (key, dtype, offset, length), array in zip(layout, arrays.values()):
+        np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset)[:] = array
+    return block, layout
+
+
+def shared_memory_to_arrays(block: shared_memory.SharedMemory, layout: list) -> dict:
+    """
+    Helper function giving the arrays stored in a shared memory block by arrays_to_shared_memory, without copying them.
+    :param block: the shared memory block.
+    :param layout: list of (key, dtype string, offset, length) tuples, as returned by arrays_to_shared_memory.
+    :return: dictionary of read-only arrays viewing the block, which must not be used once the block is closed.
+    """
+    arrays = {}
+    for key, dtype, offset, length in layout:
+        array = np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[key] = array
+    return arrays
+
+
+def run_on_shared_arrays(name: str, layout: list, func: Callable, args: tuple):
+    """
+    Function run by the worker processes: it attaches to the shared memory block of a job, and calls func on views of its arrays. Only the result of func is pickled back to the API process, so it must not be a view of the arrays.
+    :param name: string. Name of the shared memory block.
+    :param layout: list of (key, dtype string, offset, length) tuples, as returned by arrays_to_shared_memory.
+    :param func: module-level function taking a dictionary of arrays and then args.
+    :param args: tuple of the other arguments of func.
+    :return: the result of func.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = shared_memory_to_arrays(block, layout)
+        result = func(arrays, *args)
+        del arrays
+        return result
+    finally:
+        block.close()
+
+
+class AnalyticsPool:
+    """
+    Class running the CPU-heavy aggregations of activities in a pool of worker processes, so that they use several cores and leave the GIL of the API process to the requests. The arrays of a job are copied once into a shared memory block that the worker reads in place, instead of being pickled, and only the (small) aggregated result comes back. Jobs on fewer than min_rows activities, and all the jobs when workers is 0, run in a thread of the API process instead. A job not done within timeout_seconds raises JobTimeout; a job already running in a worker process cannot be interrupted, and keeps its worker until it ends. It is meant to be used from the event loop.
+    """
+
+    def __init__(
+        self,
+        workers: int = 0,
+        timeout_seconds: float = 60.0,
+        min_rows: int = MIN_OFFLOAD_ROWS,
+    ):
+        """
+        :param workers: int. Number of worker processes, or 0 to run all the jobs in threads.
+        :param timeout_seconds: float. Maximum duration of a job, waiting time included, in seconds.
+        :param min_rows: int. Number of activities from which a job is sent to the worker processes.
+        """
+        self.workers = workers
+        self.timeout_seconds = timeout_seconds
+        self.min_rows = min_rows
+        self.executor = None
+        if workers > 0:
+            # the workers are started fresh, as forking a process running threads is unsafe
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context("spawn")
+            )
+        self.offloaded = 0
+        self.in_threads = 0
+        self.timeouts = 0
+        self.running = 0
+        self.seconds = 0.0
+
+    async def run(self, func: Callable, arrays: dict, *args):
+        """
+        Runs func(arrays, *args) in a worker process, or in a thread for the small jobs, and awaits its result.
+        :param func: module-level function taking a dictionary of arrays and then args, and returning a result that does not view the arrays, e.g. a DataFrame of aggregates.
+        :param arrays: dictionary of 1-dimensional arrays of the same length, as returned by tools.db_operations.sql_to_arrays.
+        :param args: the other arguments of func, which are pickled.
+        :return: the result of func.
+        """
+        n_rows = len(next(iter(arrays.values()), ()))
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            if self.executor is None or n_rows < self.min_rows:
+                self.in_threads += 1
+                # unlike a job of the pool, a thread is left running, not waited for, on timeout
+                return await self._wait(asyncio.to_thread(func, arrays, *args))
+            self.offloaded += 1
+            block, layout = arrays_to_shared_memory(arrays)
+            try:
+                future = self.executor.submit(
+                    run_on_shared_arrays, block.name, layout, func, args
+                )
+                return await self._wait(asyncio.wrap_future(future))
+            finally:
+                # a worker still attached keeps the memory until it closes the block
+                block.close()
+                block.unlink()
+        finally:
+            self.running -= 1
+            self.seconds += time.perf_counter() - started
+
+    async def _wait(self, job):
+        try:
+            return await asyncio.wait_for(job, self.timeout_seconds)
+        except TimeoutError:
+            self.timeouts += 1
+            raise JobTimeout(
+                f"The job did not finish within {self.timeout_seconds} seconds."
+            ) from None
+
+    def shutdown(self):
+        """
+        Stops the worker processes, without waiting for the running jobs.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics of the pool (worker processes, jobs sent to them, jobs run in threads, timeouts, running jobs, total duration of the jobs in seconds) as a dictionary.
+        """
+        return {
+            "workers": self.workers,
+            "offloaded": self.offloaded,
+            "in_threads": self.in_threads,
+            "timeouts": self.timeouts,
+            "running": self.running,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+def get_analytics_pool() -> AnalyticsPool:
+    """Helper function that instantiates the AnalyticsPool class, with the number of worker processes and the timeout of the jobs set by the ANALYTICS_WORKERS and ANALYTICS_JOB_TIMEOUT_SECONDS environment variables (the number of CPUs up to 4, and 60 seconds by default)."""
+    return AnalyticsPool(
+        workers=int(os.getenv("ANALYTICS_WORKERS", min(os.cpu_count() or 1, 4))),
+        timeout_seconds=float(os.getenv("ANALYTICS_JOB_TIMEOUT_SECONDS", 60)),
+    )
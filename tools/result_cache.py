@@ -0,0 +1,146 @@
+import datetime
+import os
+import sys
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Class keeping the answers of the analytics endpoints in memory, so that the same query coming from many dashboards runs once. Entries are dropped when they are older than ttl_seconds, the least recently used ones are evicted when the total size goes beyond max_bytes, and the entries whose time window contains a newly inserted activity are invalidated by invalidate(). The cache lives in the process, so it is only aware of the writes done through the same process. It is not thread-safe, and is meant to be used from the event loop.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 60.0):
+        """
+        :param max_bytes: int. Maximum total size of the cached values, in bytes.
+        :param ttl_seconds: float. Maximum age of an entry, in seconds. It also bounds how far behind "now" the answer of a window ending now can be.
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # key -> (value, size, expiry, start, end)
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        # number of invalidations so far, used to discard results computed while the data changed
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple):
+        """
+        Returns the cached value of a key, and marks it as recently used.
+        :param key: tuple identifying the query, e.g. built with window_key.
+        :return: the cached value, or None if missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(
+        self,
+        key: tuple,
+        value,
+        start: datetime.datetime,
+        end: datetime.datetime | None,
+        version: int,
+    ):
+        """
+        Stores a value, unless activities were inserted since it started being computed. The least recently used entries are evicted to stay within max_bytes.
+        :param key: tuple identifying the query.
+        :param value: the answer to cache. Its size is measured with sys.getsizeof, so it should be a flat object such as a string.
+        :param start: datetime. Start of the time window the value depends on (excluded).
+        :param end: datetime (optional). End of the time window the value depends on (included). None if the value depends on all the activities after start, e.g. for windows ending "now".
+        :param version: the value of the version attribute read before computing the value.
+        """
+        if version != self.version:
+            return
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        while self.n_bytes + size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        expiry = time.monotonic() + self.ttl_seconds
+        self.entries[key] = (value, size, expiry, start, end)
+        self.n_bytes += size
+
+    def invalidate(self, first_time: datetime.datetime, last_time: datetime.datetime):
+        """
+        Drops the entries whose time window overlaps the times of newly inserted activities, and prevents the results being computed from being stored.
+        :param first_time: datetime. Time of the earliest inserted activity.
+        :param last_time: datetime. Time of the latest inserted activity. Same as first_time for a single activity.
+        """
+        self.version += 1
+        stale = [
+            key
+            for key, (_, _, _, start, end) in self.entries.items()
+            if start < last_time and (end is None or first_time <= end)
+        ]
+        for key in stale:
+            self._remove(key)
+        self.invalidations += len(stale)
+
+    def clear(self):
+        """
+        Drops all the entries.
+        """
+        self.version += 1
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics of the cache (entries, size, hits, misses, evictions, invalidations) as a dictionary.
+        """
+        return {
+            "entries": len(self.entries),
+            "n_bytes": self.n_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key: tuple):
+        value, size, _, _, _ = self.entries.pop(key)
+        self.n_bytes -= size
+
+
+def window_key(
+    start_time: str | None,
+    end_time: str | None,
+    start: datetime.datetime,
+    end: datetime.datetime,
+) -> tuple:
+    """
+    Helper function normalizing a time window for cache keys. Windows given by their times are keyed by the resolved datetimes, so that equivalent time strings share an entry. Windows ending "now" are keyed by their length instead, as their resolved end changes at each request.
+    :param start_time: start time (optional) in iso8601 format, as given to the API.
+    :param end_time: end time (optional) in iso8601 format, as given to the API.
+    :param start: datetime. Start of the window, as returned by tools.tools.resolve_time_window.
+    :param end: datetime. End of the window, as returned by tools.tools.resolve_time_window.
+    :return: tuple (start or period, end or None).
+    """
+    if end_time is not None:
+        return (start, end)
+    if start_time is not None:
+        return (start, None)
+    return (end - start, None)
+
+
+def get_result_cache() -> ResultCache:
+    """Helper function that instantiates the ResultCache class, with the size and time to live set by the RESULT_CACHE_MAX_BYTES and RESULT_CACHE_TTL_SECONDS environment variables (64 MiB and 60 seconds by default)."""
+    return ResultCache(
+        max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        ttl_seconds=float(os.getenv("RESULT_CACHE_TTL_SECONDS", 60)),
+    )
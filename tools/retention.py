@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+from tools.aggregation import bucket_labels
+
+# Largest number of time buckets in a retention table, which has one row and one column per bucket
+MAX_RETENTION_PERIODS = 1000
+
+
+def period_codes(
+    times: np.ndarray, frequency: str
+) -> tuple[np.ndarray, pd.DatetimeIndex]:
+    """
+    Function numbering the time bucket of each time, so that consecutive buckets have consecutive numbers, whether they have activities or not. The buckets are the ones of tools.aggregation.count_activities_per_bucket.
+    :param times: array of microseconds since the epoch, in UTC.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: tuple with the array of the bucket numbers, starting from 0, and the labels of all the buckets from the first to the last one.
+    """
+    labels = bucket_labels(times, frequency)
+    if labels is None:
+        # frequencies without a NumPy labelling are binned by pandas, which numbers the empty bins too
+        index = pd.to_datetime(times, unit="us", utc=True)
+        grouped = pd.Series(times, index=index).groupby(pd.Grouper(freq=frequency))
+        periods = grouped.size().index.rename("time")
+        return grouped.ngroup().to_numpy(), periods
+    periods = pd.date_range(
+        pd.Timestamp(labels.min(), unit="us", tz="UTC"),
+        pd.Timestamp(labels.max(), unit="us", tz="UTC"),
+        freq=frequency,
+        name="time",
+    )
+    return np.searchsorted(periods.asi8 // 1000, labels), periods
+
+
+def retention_cohorts(arrays: dict, frequency: str) -> pd.DataFrame:
+    """
+    Function computing the retention of users, grouped in cohorts by the time bucket of their first activity. The active (user, bucket) pairs are found with a single sort of integer-coded pairs (np.sort and a comparison with the previous pair, as np.unique is much slower on large arrays), the first bucket of each user is the first pair of the user, and the pairs are counted per cohort and number of buckets since the first one with np.bincount.
+    :param arrays: dictionary of arrays, as returned by tools.db_operations.sql_to_arrays, with at least the columns "time" and "user_id".
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by the bucket of the cohort ("cohort"), with the number of users in the cohort ("cohort_size"), and the fraction of them active 0, 1, 2... buckets later (columns "0", "1", "2"...). The fractions of buckets after the end of the data are NaN.
+    """
+    if not len(arrays["time"]):
+        return pd.DataFrame(
+            {"cohort_size": pd.Series(dtype="int64")},
+            index=pd.DatetimeIndex([], tz="UTC", name="cohort"),
+        )
+    codes, periods = period_codes(arrays["time"], frequency)
+    n_periods = len(periods)
+    if n_periods > MAX_RETENTION_PERIODS:
+        raise ValueError(
+            f"{n_periods} time buckets, more than {MAX_RETENTION_PERIODS}."
+        )
+
+    # active (user, bucket) pairs, sorted by user and then bucket
+    pairs = np.sort(arrays["user_id"].astype(np.int64) * n_periods + codes)
+    pairs = pairs[np.diff(pairs, prepend=pairs[0] - 1) != 0]
+    users, active = np.divmod(pairs, n_periods)
+    first_pair = np.ones(len(pairs), dtype=bool)
+    first_pair[1:] = users[1:] != users[:-1]
+    cohorts = active[first_pair][np.cumsum(first_pair) - 1]
+
+    counts = np.bincount(
+        cohorts * n_periods + (active - cohorts), minlength=n_periods**2
+    ).reshape(n_periods, n_periods)
+    sizes = counts[:, 0]
+    kept = np.flatnonzero(sizes)
+    fractions = counts[kept] / sizes[kept, None]
+    # the buckets after the last one are not known yet
+    observed = np.arange(n_periods) < (n_periods - kept)[:, None]
+    retention = pd.DataFrame(
+        np.where(observed, fractions, np.nan),
+        index=periods[kept].rename("cohort"),
+        columns=[str(offset) for offset in range(n_periods)],
+    )
+    retention.insert(0, "cohort_size", sizes[kept])
+    return retention
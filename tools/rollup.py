@@ -0,0 +1,77 @@
+import datetime
+
+import psycopg
+
+# Hour of an activity, as a UTC-aligned timestamptz
+HOUR_BUCKET = "date_trunc('hour', time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+
+
+def create_hour_range_filter(
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> tuple[str, dict]:
+    """
+    Helper function that generates the SQL condition selecting the whole hours overlapping start_time <= time < end_time, with a placeholder "{column}" for the timestamptz column to filter.
+    :param start_time: datetime (optional). If None, there is no lower bound.
+    :param end_time: datetime (optional). If None, there is no upper bound.
+    :return: tuple with the condition and its parameters.
+    """
+    conditions = ["TRUE"]
+    params = {}
+    if start_time is not None:
+        conditions.append(
+            "{column} >= date_trunc('hour', %(start_time)s::timestamptz AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+        )
+        params["start_time"] = start_time
+    if end_time is not None:
+        conditions.append(
+            "{column} < (date_trunc('hour', %(end_time)s::timestamptz AT TIME ZONE 'UTC') AT TIME ZONE 'UTC') + interval '1 hour'"
+        )
+        params["end_time"] = end_time
+    return " AND ".join(conditions), params
+
+
+def create_rollup_rebuild_queries(
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> tuple[str, str, dict]:
+    """
+    Helper function that generates the SQL queries recounting the hourly rollup from the activities table, for the whole hours overlapping start_time <= time < end_time.
+    :param start_time: datetime (optional). If None, the rebuild starts from the first activity.
+    :param end_time: datetime (optional). If None, the rebuild goes up to the last activity.
+    :return: tuple with the query deleting the old counts, the query inserting the new ones, and their parameters.
+    """
+    where, params = create_hour_range_filter(start_time, end_time)
+    delete_query = (
+        f"DELETE FROM activity_counts_hourly WHERE {where.format(column='bucket')}"
+    )
+    insert_query = f"""
+                    INSERT INTO activity_counts_hourly (bucket, activity_type, count)
+                    SELECT {HOUR_BUCKET} AS bucket, activity_type, count(*)
+                    FROM activities
+                    WHERE time IS NOT NULL AND activity_type IS NOT NULL AND {where.format(column="time")}
+                    GROUP BY 1, 2
+                    """
+    return delete_query, insert_query, params
+
+
+def rebuild_hourly_rollup(
+    conn: psycopg.Connection,
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+) -> int:
+    """
+    Function recounting the hourly rollup activity_counts_hourly from the raw activities, e.g. to backfill historical data or to repair the counts. Writes to activities wait until the rebuild is committed, so that no activity is counted twice or missed.
+    :param conn: the psycopg connection to the database.
+    :param start_time: datetime (optional). If None, the rebuild starts from the first activity.
+    :param end_time: datetime (optional). If None, the rebuild goes up to the last activity.
+    :return: the number of hourly counts written.
+    """
+    delete_query, insert_query, params = create_rollup_rebuild_queries(
+        start_time, end_time
+    )
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("LOCK TABLE activities IN SHARE MODE")
+        cur.execute(delete_query, params)
+        cur.execute(insert_query, params)
+        return cur.rowcount
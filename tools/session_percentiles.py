@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg
+from pandas.tseries.frequencies import to_offset
+from pandas.tseries import offsets
+
+from tools.aggregation import sql_bucket_expression
+
+# Relative accuracy of the percentiles: the durations are counted in logarithmic bins, bin i holding the durations in (DURATION_GAMMA**(i-1), DURATION_GAMMA**i] seconds, and estimated by the value at relative distance DURATION_ACCURACY from both bounds
+DURATION_ACCURACY = 0.01
+DURATION_GAMMA = (1 + DURATION_ACCURACY) / (1 - DURATION_ACCURACY)
+# Durations under a millisecond (e.g. a login followed by nothing) are counted in ZERO_BIN, and estimated as 0
+MIN_DURATION_SECONDS = 0.001
+ZERO_BIN = -32768
+PERCENTILES = [50, 90, 99]
+
+# Hour of the login of a session, as a UTC-aligned timestamptz
+LOGIN_HOUR = "date_trunc('hour', login_time AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+DURATION_BIN = f"""CASE WHEN extract(epoch FROM duration) < {MIN_DURATION_SECONDS} THEN {ZERO_BIN}
+                ELSE ceil(ln(extract(epoch FROM duration)) / ln({DURATION_GAMMA!r}))::smallint END"""
+
+
+def create_duration_bins_query(frequency: str) -> tuple[str, dict]:
+    """
+    Helper function that generates the SQL query merging the hourly duration bins of the sessions per time bucket, for the whole hours overlapping the window start_time < login_time <= end_time. Only one row per bucket and bin is returned by the database.
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: tuple with the SQL query, with the placeholders %(start_time)s and %(end_time)s, and the parameters of the frequency.
+    """
+    window = "bucket > %(start_time)s::timestamptz - interval '1 hour' AND bucket <= %(end_time)s AND count > 0"
+    origin = f"(SELECT date_trunc('day', min(bucket) AT TIME ZONE 'UTC') FROM session_durations_hourly WHERE {window})"
+    bucket = sql_bucket_expression(frequency, "bucket", origin)
+    query = f"""
+                    SELECT {bucket} AS bucket, bin, sum(count)::bigint
+                    FROM session_durations_hourly
+                    WHERE {window}
+                    GROUP BY 1, 2
+                    ORDER BY 1, 2
+                    """
+    params = {}
+    offset = to_offset(frequency)
+    if isinstance(offset, offsets.Tick):
+        params["bucket_stride"] = pd.Timedelta(offset).to_pytimedelta()
+    return query, params
+
+
+def bin_values(bins: np.ndarray) -> np.ndarray:
+    """
+    Helper function giving the estimated duration of the sessions of each bin, in seconds.
+    :param bins: array of bin numbers.
+    :return: array of durations, within DURATION_ACCURACY of the durations of the bins.
+    """
+    values = 2 * DURATION_GAMMA ** bins.astype(np.float64) / (DURATION_GAMMA + 1)
+    return np.where(bins == ZERO_BIN, 0.0, values)
+
+
+def duration_bins_to_percentiles(rows: list, frequency: str) -> pd.DataFrame:
+    """
+    Function estimating the percentiles of the session durations per time bucket from the merged duration bins. The p-th percentile is the duration of rank ceil(p / 100 * n) among the n sorted durations of the bucket (nearest-rank, as np.percentile with method="inverted_cdf"), found for all the buckets at once with np.searchsorted in the cumulated counts.
+    :param rows: list of (bucket, bin, count) tuples, sorted by bucket and bin, as returned by the query of create_duration_bins_query.
+    :param frequency: string. Offset alias used for the buckets.
+    :return: DataFrame indexed by time bucket, with the number of sessions ("n_sessions") and one column of durations per percentile ("p50", "p90", "p99"), empty buckets having 0 sessions and no durations.
+    """
+    columns = ["n_sessions"] + [f"p{percentile}" for percentile in PERCENTILES]
+    if not rows:
+        dtypes = ["int64"] + ["timedelta64[ns]"] * len(PERCENTILES)
+        return pd.DataFrame(
+            {column: pd.Series(dtype=dtype) for column, dtype in zip(columns, dtypes)},
+            index=pd.DatetimeIndex([], tz="UTC", name="time"),
+        )
+    buckets = pd.DatetimeIndex(pd.to_datetime([row[0] for row in rows], utc=True))
+    bins = np.array([row[1] for row in rows], dtype=np.int64)
+    counts = np.array([row[2] for row in rows], dtype=np.int64)
+
+    starts = np.flatnonzero(np.diff(buckets.asi8, prepend=buckets.asi8[0] - 1))
+    cumulated = np.cumsum(counts)
+    n_sessions = np.add.reduceat(counts, starts)
+    before = cumulated[starts] - counts[starts]
+    result = pd.DataFrame(
+        {"n_sessions": n_sessions},
+        index=pd.DatetimeIndex(buckets[starts], name="time"),
+    )
+    for percentile in PERCENTILES:
+        rank = np.maximum((percentile * n_sessions + 99) // 100 - 1, 0)
+        position = np.searchsorted(cumulated, before + rank, side="right")
+        result[f"p{percentile}"] = pd.to_timedelta(bin_values(bins[position]), unit="s")
+    labels = pd.date_range(
+        result.index.min(), result.index.max(), freq=frequency, name="time"
+    )
+    result = result.reindex(labels)
+    result["n_sessions"] = result["n_sessions"].fillna(0).astype("int64")
+    return result
+
+
+def session_duration_percentiles(
+    cur: psycopg.Cursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Function estimating the percentiles of the session durations per time bucket of their login, from the hourly duration bins of session_durations_hourly, for the whole hours overlapping the window start_time < login_time <= end_time.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: DataFrame, as returned by duration_bins_to_percentiles.
+    """
+    query, params = create_duration_bins_query(frequency)
+    params = {**params, "start_time": start_time, "end_time": end_time}
+    rows = cur.execute(query, params).fetchall()
+    return duration_bins_to_percentiles(rows, frequency)
+
+
+async def session_duration_percentiles_async(
+    cur: psycopg.AsyncCursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    frequency: str,
+) -> pd.DataFrame:
+    """
+    Asynchronous version of session_duration_percentiles. The database is awaited, and the percentiles are computed in a worker thread.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :param frequency: string. Offset alias, for which tools.aggregation.uses_hourly_rollup is True.
+    :return: DataFrame, as returned by duration_bins_to_percentiles.
+    """
+    query, params = create_duration_bins_query(frequency)
+    params = {**params, "start_time": start_time, "end_time": end_time}
+    await cur.execute(query, params)
+    rows = await cur.fetchall()
+    return await asyncio.to_thread(duration_bins_to_percentiles, rows, frequency)
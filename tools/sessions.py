@@ -0,0 +1,320 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from tools.db_operations import ACTIVITY_TYPES, sql_to_arrays, sql_to_arrays_async
+
+# Default maximum inactivity inside a session: a session without logout ends at its last activity before such a gap
+SESSION_TIMEOUT = pd.Timedelta(minutes=30)
+
+LOGIN = ACTIVITY_TYPES.index("login")
+LOGOUT = ACTIVITY_TYPES.index("logout")
+CLICK = ACTIVITY_TYPES.index("click")
+PURCHASE = ACTIVITY_TYPES.index("purchase")
+
+# Order of the activity types happening at the same time: a logout closes the previous session before a login opens the next one, and the login comes before the activities of its session
+TIE_BREAK = np.full(len(ACTIVITY_TYPES), 2)
+TIE_BREAK[LOGOUT] = 0
+TIE_BREAK[LOGIN] = 1
+
+SESSION_COLUMNS = [
+    "user_id",
+    "login_time",
+    "logout_time",
+    "duration",
+    "n_clicks",
+    "purchased",
+    "timed_out",
+]
+
+SESSION_UPSERT = """
+                INSERT INTO sessions (user_id, login_time, logout_time, duration, n_clicks, purchased, timed_out)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id, login_time) DO UPDATE SET
+                logout_time = EXCLUDED.logout_time,
+                duration = EXCLUDED.duration,
+                n_clicks = EXCLUDED.n_clicks,
+                purchased = EXCLUDED.purchased,
+                timed_out = EXCLUDED.timed_out
+                """
+
+# Activities of a user from their last login before a first logout, up to a last logout
+OPEN_SESSIONS_FILTER = """
+                user_id = %(user_id)s AND time <= %(last_logout_time)s AND time >= (
+                SELECT max(time) FROM activities
+                WHERE user_id = %(user_id)s AND activity_type = 'login' AND time <= %(first_logout_time)s
+                )
+                """
+
+
+def sessionize(arrays: dict, timeout: pd.Timedelta = SESSION_TIMEOUT) -> pd.DataFrame:
+    """
+    Function grouping activities into user sessions. The activities are sorted by (user_id, time) once, and each login is paired with the next logout of the same user, before their next login. If the logout is missing, or comes after a period of inactivity longer than timeout, the session ends at its last activity before the gap, and is flagged as timed out. Activities that are not preceded by a login of the same user are ignored. The whole computation is vectorized with NumPy.
+    :param arrays: dictionary of arrays with the keys "time" (microseconds since the epoch), "user_id" and "activity_type" (position in ACTIVITY_TYPES), as returned by sql_to_arrays.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :return: DataFrame with one row per session, and the columns SESSION_COLUMNS: user_id, login_time and logout_time (UTC timestamps), duration (timedelta), n_clicks (int), purchased (bool) and timed_out (bool).
+    """
+    order = np.lexsort(
+        (TIE_BREAK[arrays["activity_type"]], arrays["time"], arrays["user_id"])
+    )
+    time = arrays["time"][order]
+    user_id = arrays["user_id"][order]
+    activity_type = arrays["activity_type"][order]
+    n_activities = len(time)
+
+    # each login, and each first activity of a user, starts a new segment, lasting until the next one
+    new_user = np.ones(n_activities, dtype=bool)
+    new_user[1:] = user_id[1:] != user_id[:-1]
+    segment_start = (activity_type == LOGIN) | new_user
+    starts = np.flatnonzero(segment_start)
+    segment = np.cumsum(segment_start) - 1
+
+    # activities after a gap longer than timeout do not belong to the session anymore
+    gap = np.zeros(n_activities, dtype=time.dtype)
+    gap[1:] = np.diff(time)
+    breaks = np.cumsum((gap > timeout // pd.Timedelta(microseconds=1)) & ~segment_start)
+    active = breaks == breaks[starts][segment]
+
+    # the session ends at the first logout of the segment, if active
+    position = np.arange(n_activities)
+    logout_position = np.minimum.reduceat(
+        np.where((activity_type == LOGOUT) & active, position, n_activities), starts
+    )
+    in_session = active & (position <= logout_position[segment])
+
+    login_time = time[starts]
+    logout_time = np.maximum.reduceat(
+        np.where(in_session, time, login_time[segment]), starts
+    )
+    n_clicks = np.add.reduceat(
+        ((activity_type == CLICK) & in_session).astype(np.int64), starts
+    )
+    purchased = np.logical_or.reduceat((activity_type == PURCHASE) & in_session, starts)
+
+    is_session = activity_type[starts] == LOGIN
+    return pd.DataFrame(
+        {
+            "user_id": user_id[starts][is_session],
+            "login_time": pd.to_datetime(login_time[is_session], unit="us", utc=True),
+            "logout_time": pd.to_datetime(logout_time[is_session], unit="us", utc=True),
+            "duration": pd.to_timedelta(
+                (logout_time - login_time)[is_session], unit="us"
+            ),
+            "n_clicks": n_clicks[is_session],
+            "purchased": purchased[is_session],
+            "timed_out": (logout_position == n_activities)[is_session],
+        }
+    )
+
+
+def average_session_duration(sessions: pd.DataFrame, frequency: str) -> pd.DataFrame:
+    """
+    Function averaging the duration of the sessions per time bucket of their login.
+    :param sessions: DataFrame of sessions, as returned by sessionize.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame indexed by time bucket, with the mean duration and the number of sessions.
+    """
+    grouped = sessions.set_index("login_time")["duration"].groupby(
+        pd.Grouper(freq=frequency)
+    )
+    return pd.DataFrame({"duration": grouped.mean(), "n_sessions": grouped.size()})
+
+
+def average_activity_session_duration(
+    arrays: dict, timeout: pd.Timedelta, frequency: str
+) -> pd.DataFrame:
+    """
+    Function grouping activities into sessions with sessionize, and averaging their duration per time bucket of their login with average_session_duration, so that only the averages come out of a worker process.
+    :param arrays: dictionary of arrays with the keys "time" (microseconds since the epoch), "user_id" and "activity_type" (position in ACTIVITY_TYPES), as returned by sql_to_arrays.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :param frequency: string. Offset alias, already validated by check_for_allowed_freq_string.
+    :return: DataFrame, as returned by average_session_duration.
+    """
+    return average_session_duration(sessionize(arrays, timeout), frequency)
+
+
+def session_rows(sessions: pd.DataFrame) -> list:
+    """
+    Helper function converting a session table into rows for the sessions SQL table, in the order of SESSION_COLUMNS. Sessions are keyed by user and login time: of two logins of a user at the same time, only the session of the last one is kept, since the first one ends immediately.
+    :param sessions: DataFrame of sessions, as returned by sessionize.
+    :return: list of tuples of Python objects.
+    """
+    sessions = sessions.drop_duplicates(["user_id", "login_time"], keep="last")
+    return list(
+        zip(
+            sessions["user_id"].tolist(),
+            sessions["login_time"].tolist(),
+            sessions["logout_time"].tolist(),
+            sessions["duration"].tolist(),
+            sessions["n_clicks"].tolist(),
+            sessions["purchased"].tolist(),
+            sessions["timed_out"].tolist(),
+        )
+    )
+
+
+def rows_to_sessions(rows: list) -> pd.DataFrame:
+    """
+    Helper function converting rows of the sessions SQL table into a session table, with the same dtypes as the output of sessionize.
+    :param rows: list of tuples, in the order of SESSION_COLUMNS.
+    :return: DataFrame of sessions.
+    """
+    sessions = pd.DataFrame(rows, columns=SESSION_COLUMNS)
+    return sessions.astype(
+        {
+            "user_id": "int32",
+            "login_time": "datetime64[ns, UTC]",
+            "logout_time": "datetime64[ns, UTC]",
+            "duration": "timedelta64[ns]",
+            "n_clicks": "int64",
+            "purchased": "bool",
+            "timed_out": "bool",
+        }
+    )
+
+
+def create_sessions_query() -> str:
+    """
+    Helper function that generates the query reading the sessions with a login in the window start_time < login_time <= end_time, through the index on login_time.
+    :return: the SQL query, with the placeholders %(start_time)s and %(end_time)s.
+    """
+    columns = ", ".join(SESSION_COLUMNS)
+    return f"""
+                    SELECT {columns} FROM sessions
+                    WHERE login_time > %(start_time)s AND login_time <= %(end_time)s
+                    """
+
+
+def read_sessions(
+    cur: psycopg.Cursor, start_time: datetime.datetime, end_time: datetime.datetime
+) -> pd.DataFrame:
+    """
+    Function reading the materialized sessions with a login in the window start_time < login_time <= end_time.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :return: DataFrame of sessions, as returned by sessionize.
+    """
+    params = {"start_time": start_time, "end_time": end_time}
+    rows = cur.execute(create_sessions_query(), params).fetchall()
+    return rows_to_sessions(rows)
+
+
+async def read_sessions_async(
+    cur: psycopg.AsyncCursor,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+) -> pd.DataFrame:
+    """
+    Asynchronous version of read_sessions.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+    :param start_time: datetime. Start of the time window (excluded).
+    :param end_time: datetime. End of the time window (included).
+    :return: DataFrame of sessions, as returned by sessionize.
+    """
+    params = {"start_time": start_time, "end_time": end_time}
+    await cur.execute(create_sessions_query(), params)
+    rows = await cur.fetchall()
+    return rows_to_sessions(rows)
+
+
+def close_sessions(
+    cur: psycopg.Cursor,
+    user_id: int,
+    first_logout_time: datetime.datetime,
+    last_logout_time: datetime.datetime,
+    timeout: pd.Timedelta = SESSION_TIMEOUT,
+) -> int:
+    """
+    Function writing to the sessions table the sessions of a user that are closed by new logouts. The activities of the user from their last login before the first logout, up to the last logout, are read through the index on (user_id, time), and grouped with sessionize, so that the stored sessions are the same as the ones computed from the raw activities.
+    :param cur: the cursor for the psycopg connection to be used to execute the SQL queries.
+    :param user_id: the user_id of the logouts.
+    :param first_logout_time: datetime. The time of the first new logout, already stored in activities.
+    :param last_logout_time: datetime. The time of the last new logout. Same as first_logout_time for a single logout.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :return: the number of sessions written.
+    """
+    params = {
+        "user_id": user_id,
+        "first_logout_time": first_logout_time,
+        "last_logout_time": last_logout_time,
+    }
+    columns = ["time", "user_id", "activity_type"]
+    arrays = sql_to_arrays("activities", cur, columns, OPEN_SESSIONS_FILTER, params)
+    rows = session_rows(sessionize(arrays, timeout))
+    if rows:
+        cur.executemany(SESSION_UPSERT, rows)
+    return len(rows)
+
+
+async def close_sessions_async(
+    cur: psycopg.AsyncCursor,
+    user_id: int,
+    first_logout_time: datetime.datetime,
+    last_logout_time: datetime.datetime,
+    timeout: pd.Timedelta = SESSION_TIMEOUT,
+) -> int:
+    """
+    Asynchronous version of close_sessions.
+    :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL queries.
+    :param user_id: the user_id of the logouts.
+    :param first_logout_time: datetime. The time of the first new logout, already stored in activities.
+    :param last_logout_time: datetime. The time of the last new logout. Same as first_logout_time for a single logout.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :return: the number of sessions written.
+    """
+    params = {
+        "user_id": user_id,
+        "first_logout_time": first_logout_time,
+        "last_logout_time": last_logout_time,
+    }
+    columns = ["time", "user_id", "activity_type"]
+    arrays = await sql_to_arrays_async(
+        "activities", cur, columns, OPEN_SESSIONS_FILTER, params
+    )
+    rows = session_rows(sessionize(arrays, timeout))
+    if rows:
+        await cur.executemany(SESSION_UPSERT, rows)
+    return len(rows)
+
+
+def backfill_sessions(
+    conn: psycopg.Connection,
+    chunk_size: int = 1000,
+    timeout: pd.Timedelta = SESSION_TIMEOUT,
+) -> int:
+    """
+    Function rebuilding the sessions table from the existing activities. Sessions never span two users, so the users are processed in chunks of chunk_size, each in its own transaction: the memory used is bounded by the activities of a chunk, and the sessions of the other users stay available.
+    :param conn: the psycopg connection to the database.
+    :param chunk_size: int. Number of users processed at once.
+    :param timeout: pd.Timedelta. Maximum inactivity inside a session.
+    :return: the number of sessions written.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT user_id FROM activities ORDER BY user_id")
+        user_ids = [row[0] for row in cur.fetchall()]
+        n_sessions = 0
+        for first in range(0, len(user_ids), chunk_size):
+            params = {"user_ids": user_ids[first : first + chunk_size]}
+            with conn.transaction():
+                # sessions closed by new logouts wait for the chunk to be written
+                cur.execute("LOCK TABLE sessions IN SHARE ROW EXCLUSIVE MODE")
+                cur.execute(
+                    "DELETE FROM sessions WHERE user_id = ANY(%(user_ids)s)", params
+                )
+                arrays = sql_to_arrays(
+                    "activities",
+                    cur,
+                    ["time", "user_id", "activity_type"],
+                    "user_id = ANY(%(user_ids)s) AND time IS NOT NULL",
+                    params,
+                )
+                rows = session_rows(sessionize(arrays, timeout))
+                columns = ", ".join(SESSION_COLUMNS)
+                with cur.copy(f"COPY sessions ({columns}) FROM STDIN") as copy:
+                    for row in rows:
+                        copy.write_row(row)
+            n_sessions += len(rows)
+    return n_sessions
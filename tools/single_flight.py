@@ -0,0 +1,41 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    Class coalescing identical concurrent computations: while a computation for a key is running, the requests for the same key wait for it and share its result (or its exception), instead of starting their own. Nothing is kept once the computation is done: caching the results is the job of ResultCache. It must be used from a single event loop.
+    """
+
+    def __init__(self):
+        # key -> task of the running computation
+        self.flights = {}
+        self.executions = 0
+        self.saved = 0
+
+    async def run(self, key: tuple, compute: Callable[[], Awaitable]):
+        """
+        Runs compute, unless a computation for the same key is already running, in which case its result is awaited. The computation is shielded from the cancellation of the requests waiting for it, so that a client going away does not fail the others.
+        :param key: tuple identifying the computation. It must include everything the result depends on.
+        :param compute: function without arguments returning the awaitable computing the result.
+        :return: the result of the computation.
+        """
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self.flights[key] = task
+            self.executions += 1
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            self.saved += 1
+        return await asyncio.shield(task)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the number of computations run, the number saved by sharing a running one, and the number running now, as a dictionary.
+        """
+        return {
+            "executions": self.executions,
+            "saved": self.saved,
+            "in_flight": len(self.flights),
+        }
@@ -1,4 +1,4 @@
-from uuid import uuid4
+from uuid import UUID, uuid4
 import pandas as pd
 import datetime
 from fastapi import HTTPException
@@ -15,26 +15,24 @@ def short_uuid4_generator(bits: int = 30) -> int:
 
 def long_uuid4_generator():
     """
-    Small function generating a normal UUID4.
+    Small function generating a normal UUID4. It gives the activity_id of the new activities, which the database only keeps unique together with their time, as activities is partitioned by time: the ids must never come from the clients.
     """
     return uuid4()
 
 
-def filter_time(
-    df: pd.DataFrame,
+def resolve_time_window(
     start_time: str = None,
     end_time: str = None,
     period_days: int = 0,
     period_hours: int = 0,
 ):
     """
-    Helper function to filter a Pandas dataframe with pd.Timestamp objects stored in a column called "time". It will either select the times between a start_time and an end_time, or using an end_time and a time period backwards. If no end_time is selected, "now" is chosen. If no start_time or period is selected, 30 days is chosen as interval.
-    :param df: the Pandas dataframe. It must have a column of pd.Timestamps called "time".
+    Helper function translating the time entries accepted by the API into a (start, end) pair of timezone-aware datetimes. It will either use a start_time and an end_time, or an end_time and a time period backwards. If no end_time is selected, "now" is chosen.
     :param start_time: start time (optional) in iso8601 format.
     :param end_time: end time (optional) in iso8601 format.
     :param period_days: time period (optional) in int.
     :param period_hours: time period (optional) in int.
-    :return: the filtered dataframe
+    :return: tuple (start, end). Activities in the window satisfy start < time <= end.
     """
 
     assert validate_time_entries(period_days, period_hours, start_time, end_time)
@@ -53,6 +51,60 @@ def filter_time(
     else:
         start_time = datetime.datetime.fromisoformat(start_time)
 
+    return start_time, end_time
+
+
+def parse_keyset_cursor(after: str) -> tuple[datetime.datetime, UUID]:
+    """
+    Helper function reading the keyset cursor of the paginated endpoints, in the form "<time>,<activity_id>" (as returned by format_keyset_cursor).
+    :param after: the cursor string.
+    :return: tuple (time, activity_id).
+    """
+    try:
+        time, activity_id = after.split(",")
+        time = datetime.datetime.fromisoformat(time)
+        if time.tzinfo is None:
+            raise ValueError("The time of the cursor has no timezone.")
+        return time, UUID(activity_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid cursor. It should have the format <time>,<activity_id>, as given in the X-Next-After header of the previous page.",
+        )
+
+
+def format_keyset_cursor(time: datetime.datetime, activity_id: UUID) -> str:
+    """
+    Helper function writing the keyset cursor pointing after an activity, to be read by parse_keyset_cursor. The time is written in UTC with a "Z" suffix, so that the cursor can be pasted in a query string as it is (a "+" would be read as a space).
+    :param time: the time of the activity, with a timezone.
+    :param activity_id: the activity_id of the activity.
+    :return: the cursor string.
+    """
+    time = time.astimezone(datetime.UTC).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return f"{time},{activity_id}"
+
+
+def filter_time(
+    df: pd.DataFrame,
+    start_time: str = None,
+    end_time: str = None,
+    period_days: int = 0,
+    period_hours: int = 0,
+):
+    """
+    Helper function to filter a Pandas dataframe with pd.Timestamp objects stored in a column called "time". It will either select the times between a start_time and an end_time, or using an end_time and a time period backwards. If no end_time is selected, "now" is chosen. If no start_time or period is selected, 30 days is chosen as interval.
+    :param df: the Pandas dataframe. It must have a column of pd.Timestamps called "time".
+    :param start_time: start time (optional) in iso8601 format.
+    :param end_time: end time (optional) in iso8601 format.
+    :param period_days: time period (optional) in int.
+    :param period_hours: time period (optional) in int.
+    :return: the filtered dataframe
+    """
+
+    start_time, end_time = resolve_time_window(
+        start_time, end_time, period_days, period_hours
+    )
+
     return df[(df["time"] > start_time) & (df["time"] <= end_time)]
 
 
@@ -82,6 +134,26 @@ def polish_activity_types_list(activity_types_input, default):
     return activity_types
 
 
+def polish_funnel_steps(steps_input, default):
+    """
+    Helper function that cleans from None, and validates the ordered list of the steps of a funnel, which must be at least two activity types permitted in the ActivityTypes Enum model. The order and repetitions of the steps are kept. If no step is given, the default is returned.
+    """
+
+    steps = [step for step in steps_input if step is not None]
+    if not steps:
+        return default
+    for step in steps:
+        if step not in ActivityTypes._value2member_map_:
+            raise HTTPException(
+                status_code=400, detail=f"{step}: No such activity type."
+            )
+    if len(steps) < 2:
+        raise HTTPException(
+            status_code=400, detail="A funnel needs at least two steps."
+        )
+    return steps
+
+
 def check_for_allowed_freq_string(string):
     """
     Validating function that checks if the string corresponds to an Offset alias as defined by the Pandas documentation.
@@ -152,10 +224,10 @@ def validate_time_bin(time_bin):
     Check if the time string conforms to a set of allowed strings.
     """
 
-    if time_bin in ["month", "day", "hour", "minute", "second"]:
+    if time_bin in ["year", "month", "day", "hour", "minute", "second"]:
         return True
     else:
         raise HTTPException(
             status_code=400,
-            detail=f"{time_bin} not a valid time bin to group by. Allowed time bins are 'month', 'day', 'hour', 'minute', 'second'",
+            detail=f"{time_bin} not a valid time bin to group by. Allowed time bins are 'year', 'month', 'day', 'hour', 'minute', 'second'",
         )
@@ -0,0 +1,105 @@
+import psycopg
+
+LOAD_QUERY = "SELECT user_id FROM users"
+EXISTS_QUERY = "SELECT 1 FROM users WHERE user_id = %(user_id)s"
+FILTER_QUERY = "SELECT user_id FROM users WHERE user_id = ANY(%(user_ids)s)"
+
+
+class UserIdCache:
+    """
+    Class keeping the registered user_ids in memory, so that checking if a user exists does not cost a database query. It is loaded once with the load() method, and kept up to date with add() when a user is posted. A user_id missing from the cache is still looked up in the database, so users added by other processes are found, and then cached.
+    """
+
+    def __init__(self):
+        self.user_ids = set()
+
+    def load(self, cur: psycopg.Cursor):
+        """
+        Loads all the user_ids present in the users table.
+        :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+        """
+        cur.execute(LOAD_QUERY)
+        self.user_ids = {row[0] for row in cur}
+
+    async def load_async(self, cur: psycopg.AsyncCursor):
+        """
+        Asynchronous version of load.
+        :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+        """
+        await cur.execute(LOAD_QUERY)
+        self.user_ids = {row[0] async for row in cur}
+
+    def add(self, user_id: int):
+        """
+        Adds a user_id to the cache.
+        """
+        self.user_ids.add(user_id)
+
+    def discard(self, user_id: int):
+        """
+        Removes a user_id from the cache, if present.
+        """
+        self.user_ids.discard(user_id)
+
+    def exists(self, user_id: int, cur: psycopg.Cursor) -> bool:
+        """
+        Checks if a user_id is registered. The database is only queried (through the primary key index) if the user_id is not in the cache.
+        :param user_id: the user_id to check.
+        :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+        :return: True if the user exists.
+        """
+        if user_id in self.user_ids:
+            return True
+        if cur.execute(EXISTS_QUERY, {"user_id": user_id}).fetchone() is None:
+            return False
+        self.add(user_id)
+        return True
+
+    async def exists_async(self, user_id: int, cur: psycopg.AsyncCursor) -> bool:
+        """
+        Asynchronous version of exists.
+        :param user_id: the user_id to check.
+        :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+        :return: True if the user exists.
+        """
+        if user_id in self.user_ids:
+            return True
+        await cur.execute(EXISTS_QUERY, {"user_id": user_id})
+        if await cur.fetchone() is None:
+            return False
+        self.add(user_id)
+        return True
+
+    def filter_existing(self, user_ids: set, cur: psycopg.Cursor) -> set:
+        """
+        Checks many user_ids at once. The ones that are not in the cache are looked up in the database with a single query, and then cached.
+        :param user_ids: set of user_ids to check.
+        :param cur: the cursor for the psycopg connection to be used to execute the SQL query.
+        :return: the set of the user_ids that exist.
+        """
+        existing = user_ids & self.user_ids
+        missing = list(user_ids - existing)
+        if missing:
+            cur.execute(FILTER_QUERY, {"user_ids": missing})
+            found = {row[0] for row in cur}
+            self.user_ids |= found
+            existing |= found
+        return existing
+
+    async def filter_existing_async(
+        self, user_ids: set, cur: psycopg.AsyncCursor
+    ) -> set:
+        """
+        Asynchronous version of filter_existing.
+        :param user_ids: set of user_ids to check.
+        :param cur: the cursor for the psycopg AsyncConnection to be used to execute the SQL query.
+        :return: the set of the user_ids that exist.
+        """
+        existing = user_ids & self.user_ids
+        missing = list(user_ids - existing)
+        if missing:
+            await cur.execute(FILTER_QUERY, {"user_ids": missing})
+            found = {row[0] async for row in cur}
+            self.user_ids |= found
+            existing |= found
+        return existing